@@ -0,0 +1,424 @@
+'''
+Microbenchmarks of the backend hot paths
+
+Usage (from the backend folder):
+    python bench_api.py                              # run and print
+    python bench_api.py --save baseline.json         # save the results
+    python bench_api.py --compare baseline.json      # flag regressions
+    python bench_api.py --filter auth                # subset by name
+
+Tokens are signed with a locally generated RS256 key and verified against a
+local JWKS file, so no network access is needed. The routes run against a
+temporary database through the Flask test client.
+'''
+from statistics import median, stdev
+from src.auth.local_keys import LocalSigner
+from src.auth.jwks import build_keys
+from src.auth import auth
+from src.database.models import Drink, db, create_drink_writer
+from src.schemas import create_drinks_schema, update_drinks_schema, \
+    is_valid_create, is_valid_update
+from src.validation import expects_json as compiled_expects_json
+from src.api import create_app
+from flask_expects_json import expects_json
+from concurrent.futures import ThreadPoolExecutor
+
+import subprocess
+import tempfile
+import argparse
+import platform
+import time
+import json
+import sys
+import os
+
+
+DIRECTORY = tempfile.mkdtemp(prefix='coffee-bench-')
+JWKS_PATH = os.path.join(DIRECTORY, 'jwks.json')
+DATABASE_PATH = os.path.join(DIRECTORY, 'bench.db')
+
+SIGNER = LocalSigner()
+SIGNER.write_jwks(JWKS_PATH)
+
+app = create_app({
+    'SQLALCHEMY_DATABASE_URI': f'sqlite:///{DATABASE_PATH}',
+    'AUTH0_JWKS_FILE': JWKS_PATH,
+    'SHARED_CACHE_DIR': os.path.join(DIRECTORY, 'shared'),
+    'DATABASE_INIT': False,
+    # Measures the routes, not the admission control
+    'RATE_LIMIT_ENABLED': False
+})
+
+# --------------------------------------------------------------------------- #
+# Harness
+# --------------------------------------------------------------------------- #
+
+BENCHMARKS = {}
+
+
+def benchmark(name, setup=None):
+    '''
+    Registers a benchmark
+
+    Arguments:
+        - name: unique name of the benchmark
+        - setup: optional function called before every timed call, its
+        return value is passed to the benchmark
+    '''
+    def decorator(func):
+        BENCHMARKS[name] = (func, setup)
+        return func
+    return decorator
+
+
+def measure(func, setup, rounds, round_time):
+    '''
+    Returns:
+        - list of seconds per call, one value per round
+    '''
+    if setup is None:
+        # Calibrate the loop count of a round
+        loops = 1
+        while True:
+            start = time.perf_counter()
+            for _ in range(loops):
+                func()
+            elapsed = time.perf_counter() - start
+            if elapsed >= round_time / 10 or loops >= 1 << 20:
+                break
+            loops *= 10
+        loops = max(1, int(loops * round_time / max(elapsed, 1e-9)))
+
+        samples = []
+        for _ in range(rounds):
+            start = time.perf_counter()
+            for _ in range(loops):
+                func()
+            samples.append((time.perf_counter() - start) / loops)
+        return samples
+
+    # Calls with a setup are timed one by one
+    samples = []
+    for _ in range(rounds):
+        elapsed = 0
+        calls = 0
+        while elapsed < round_time:
+            argument = setup()
+            start = time.perf_counter()
+            func(argument)
+            elapsed += time.perf_counter() - start
+            calls += 1
+        samples.append(elapsed / calls)
+    return samples
+
+
+def run(names, rounds, round_time):
+    '''
+    Returns:
+        - dictionary of benchmark name -> statistics in seconds
+    '''
+    results = {}
+    for name in names:
+        func, setup = BENCHMARKS[name]
+        samples = measure(func, setup, rounds, round_time)
+        results[name] = {
+            'median': median(samples),
+            'min': min(samples),
+            'mean': sum(samples) / len(samples),
+            'stdev': stdev(samples) if len(samples) > 1 else 0,
+            'rounds': len(samples)
+        }
+        print(f"{name:<48} {format_time(results[name]['median']):>10}")
+    return results
+
+
+def compare(results, baseline, threshold):
+    '''
+    Arguments:
+        - results: statistics of the current run
+        - baseline: statistics of a saved run
+        - threshold: tolerated relative slowdown of the median (0.1 = 10%)
+
+    Returns:
+        - list of the names of the regressed benchmarks
+    '''
+    regressions = []
+    print(f"\n{'benchmark':<48} {'baseline':>10} {'current':>10} "
+          f"{'change':>8}")
+    for name, stats in results.items():
+        if name not in baseline:
+            continue
+        before = baseline[name]['median']
+        change = stats['median'] / before - 1
+        flag = ''
+        if change > threshold:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print(f"{name:<48} {format_time(before):>10} "
+              f"{format_time(stats['median']):>10} {change:>+8.1%}{flag}")
+    return regressions
+
+
+def format_time(seconds):
+    for unit, scale in (('s', 1), ('ms', 1e-3), ('us', 1e-6)):
+        if seconds >= scale:
+            return f'{seconds / scale:.2f} {unit}'
+    return f'{seconds / 1e-9:.0f} ns'
+
+# --------------------------------------------------------------------------- #
+# Model serialization
+# --------------------------------------------------------------------------- #
+
+
+def make_drink(parts):
+    recipe = [{'name': f'ingredient {i}', 'color': 'brown', 'parts': 1}
+              for i in range(parts)]
+    return Drink(id=1, title=f'Drink {parts}', recipe=json.dumps(recipe))
+
+
+for size in (1, 10, 100):
+    drink = make_drink(size)
+    benchmark(f'Drink.short() recipe={size}')(drink.short)
+    benchmark(f'Drink.long() recipe={size}')(drink.long)
+
+# --------------------------------------------------------------------------- #
+# Authentication
+# --------------------------------------------------------------------------- #
+
+PERMISSIONS = ['get:drinks-detail', 'post:drinks', 'patch:drinks',
+               'delete:drinks']
+TOKEN = SIGNER.token(permissions=PERMISSIONS)
+HEADERS = {'Authorization': f'Bearer {TOKEN}'}
+KEY = build_keys(SIGNER.jwks(), auth.ALGORITHMS[0])[SIGNER.kid]
+PAYLOAD = auth.decode_token(TOKEN, KEY)
+CACHED_CLAIMS = auth.ClaimsCache().set(TOKEN, PAYLOAD)
+
+
+@benchmark('auth get_token_auth_header')
+def bench_get_token_auth_header():
+    auth.get_token_auth_header(HEADERS)
+
+
+@benchmark('auth decode_token')
+def bench_decode_token():
+    auth.decode_token(TOKEN, KEY)
+
+
+@benchmark('auth verify_jwt')
+def bench_verify_jwt():
+    auth.verify_jwt(TOKEN)
+
+
+@benchmark('auth check_permissions (list)')
+def bench_check_permissions():
+    auth.check_permissions('delete:drinks', PAYLOAD)
+
+
+@benchmark('auth check_permissions (cached frozenset)')
+def bench_check_permissions_cached():
+    auth.check_permissions('delete:drinks', CACHED_CLAIMS)
+
+# --------------------------------------------------------------------------- #
+# Validation
+# --------------------------------------------------------------------------- #
+
+
+DRINK_BODY = {
+    'title': 'Bench Drink',
+    'recipe': [{'name': 'milk', 'color': 'white', 'parts': 1},
+               {'name': 'coffee', 'color': 'brown', 'parts': 2}]
+}
+
+UPDATE_BODY = {'recipe': DRINK_BODY['recipe']}
+
+
+def validate_body(decorator, body):
+    view = decorator(lambda: None)
+
+    def request():
+        with app.test_request_context(method='POST', json=body):
+            view()
+    return request
+
+
+# flask_expects_json, the compiled schema and the fast path
+for name, schema, fast_check, body in (
+        ('create_drinks_schema', create_drinks_schema, is_valid_create,
+         DRINK_BODY),
+        ('update_drinks_schema', update_drinks_schema, is_valid_update,
+         UPDATE_BODY)):
+    benchmark(f'expects_json {name}')(
+        validate_body(expects_json(schema), body))
+    benchmark(f'expects_json {name} (compiled)')(
+        validate_body(compiled_expects_json(schema), body))
+    benchmark(f'expects_json {name} (fast path)')(
+        validate_body(compiled_expects_json(schema, fast_check), body))
+
+# --------------------------------------------------------------------------- #
+# Routes
+# --------------------------------------------------------------------------- #
+
+
+def setup_app():
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        db.session.bulk_insert_mappings(Drink, [
+            {'title': f'Menu Drink {i}',
+             'recipe': json.dumps(DRINK_BODY['recipe'])}
+            for i in range(100)])
+        db.session.commit()
+
+
+client = app.test_client()
+titles = (f'Bench Drink {i}' for i in range(sys.maxsize))
+
+
+def with_cache(enabled, func):
+    def wrapper(*args):
+        app.config['MENU_CACHE_ENABLED'] = enabled
+        return func(*args)
+    return wrapper
+
+
+def get(path):
+    def request():
+        response = client.get(path, headers=HEADERS)
+        assert response.status_code == 200, response.status_code
+    return request
+
+
+for path in ('/drinks', '/drinks-detail', '/drinks?stream=1'):
+    benchmark(f'GET {path} (uncached)')(with_cache(False, get(path)))
+for path in ('/drinks', '/drinks-detail'):
+    benchmark(f'GET {path} (cached)')(with_cache(True, get(path)))
+
+
+@benchmark('POST /drinks')
+def bench_post_drinks():
+    body = dict(DRINK_BODY, title=next(titles))
+    response = client.post('/drinks', json=body, headers=HEADERS)
+    assert response.status_code == 200, response.status_code
+
+
+@benchmark('PATCH /drinks/<id>')
+def bench_patch_drinks():
+    body = {'title': next(titles)}
+    response = client.patch('/drinks/1', json=body, headers=HEADERS)
+    assert response.status_code == 200, response.status_code
+
+
+def create_drink():
+    response = client.post('/drinks', json=dict(
+        DRINK_BODY, title=next(titles)), headers=HEADERS)
+    return response.get_json()['drinks'][0]['id']
+
+
+@benchmark('DELETE /drinks/<id>', setup=create_drink)
+def bench_delete_drinks(drink_id):
+    response = client.delete(f'/drinks/{drink_id}', headers=HEADERS)
+    assert response.status_code == 200, response.status_code
+
+
+@benchmark('POST /drinks/batch (10 creates)')
+def bench_batch_drinks():
+    operations = [{'op': 'create', 'data': dict(DRINK_BODY, title=title)}
+                  for title, _ in zip(titles, range(10))]
+    response = client.post('/drinks/batch', json={
+        'operations': operations}, headers=HEADERS)
+    assert response.status_code == 200, response.status_code
+
+
+# Admin traffic: request threads posting at the same time, each one
+# committing its own write or handing it to the group committing writer
+CONCURRENT_WRITES = 16
+write_pool = ThreadPoolExecutor(CONCURRENT_WRITES)
+drink_writer = create_drink_writer(app)
+
+
+def post_drink(title):
+    response = app.test_client().post('/drinks', json=dict(
+        DRINK_BODY, title=title), headers=HEADERS)
+    assert response.status_code == 200, response.status_code
+
+
+def concurrent_posts(writer):
+    def request():
+        if writer is None:
+            app.extensions.pop('drink_writer', None)
+        else:
+            app.extensions['drink_writer'] = writer
+        try:
+            list(write_pool.map(post_drink, [
+                next(titles) for _ in range(CONCURRENT_WRITES)]))
+        finally:
+            app.extensions.pop('drink_writer', None)
+    return request
+
+
+benchmark(f'POST /drinks x{CONCURRENT_WRITES} concurrent')(
+    concurrent_posts(None))
+benchmark(f'POST /drinks x{CONCURRENT_WRITES} concurrent (group commit)')(
+    concurrent_posts(drink_writer))
+
+# --------------------------------------------------------------------------- #
+# Cold start
+# --------------------------------------------------------------------------- #
+
+# A worker booting against an existing database: imports, create_app and
+# the migration check, in a fresh interpreter (its startup included)
+COLD_START = (
+    'from src.api import create_app; create_app({{'
+    '"SQLALCHEMY_DATABASE_URI": "sqlite:///{}"}})'.format(
+        os.path.join(DIRECTORY, 'cold_start.db')))
+
+
+@benchmark('cold start (python -c, import + create_app)')
+def bench_cold_start():
+    subprocess.run([sys.executable, '-c', COLD_START], check=True,
+                   cwd=os.path.dirname(os.path.abspath(__file__)))
+
+# --------------------------------------------------------------------------- #
+# Command line
+# --------------------------------------------------------------------------- #
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--filter', default='',
+                        help='run only the benchmarks containing this text')
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--round-time', type=float, default=0.2,
+                        help='seconds per round')
+    parser.add_argument('--save', help='write the results to this file')
+    parser.add_argument('--compare', help='baseline results to compare to')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='tolerated slowdown of the median (0.1 = 10%%)')
+    args = parser.parse_args()
+
+    setup_app()
+    names = [name for name in BENCHMARKS if args.filter in name]
+    results = run(names, args.rounds, args.round_time)
+
+    if args.save:
+        with open(args.save, 'w') as results_file:
+            json.dump({
+                'machine': {
+                    'python': platform.python_version(),
+                    'platform': platform.platform()
+                },
+                'benchmarks': results
+            }, results_file, indent=2)
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)['benchmarks']
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f'\n{len(regressions)} regression(s) above '
+                  f'{args.threshold:.0%}')
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
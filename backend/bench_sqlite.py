@@ -0,0 +1,134 @@
+'''
+Read throughput of the drinks table while writes are running, with the
+SQLite defaults (before) and with the engine profile of setup_db (after)
+
+Usage (from the backend folder):
+    python bench_sqlite.py --seconds 5 --readers 8 --writers 2
+
+The profile is read from the same SQLITE_* environment variables as the
+application, see src/database/models.py get_engine_profile.
+'''
+from src.database.models import Drink, get_engine_profile, engine_options, \
+    apply_pragmas
+from sqlalchemy import create_engine, event, select
+from sqlalchemy.exc import OperationalError
+
+import threading
+import tempfile
+import argparse
+import random
+import json
+import time
+import os
+
+
+RECIPE = json.dumps([{'name': 'water', 'color': 'blue', 'parts': 1}])
+
+
+def create_engines(url, profile):
+    '''
+    Arguments:
+        - url: database url
+        - profile: engine profile or None for the SQLite defaults
+
+    Returns:
+        - (write_engine, read_engine) tuple
+    '''
+    if profile is None:
+        engine = create_engine(url)
+        return engine, engine
+
+    def connect_listener(read_only):
+        return lambda dbapi_connection, _: apply_pragmas(
+            dbapi_connection, profile, read_only=read_only)
+
+    write_engine = create_engine(url, **engine_options(profile))
+    event.listen(write_engine, 'connect', connect_listener(False))
+    read_engine = create_engine(url, **engine_options(profile))
+    event.listen(read_engine, 'connect', connect_listener(True))
+    return write_engine, read_engine
+
+
+def run(url, profile, rows, seconds, readers, writers):
+    '''
+    Runs <readers> threads paging through the drinks table and <writers>
+    threads updating random drinks for <seconds> seconds
+
+    Returns:
+        - dictionary with the read and write throughput and lock errors
+    '''
+    write_engine, read_engine = create_engines(url, profile)
+    table = Drink.__table__
+    table.create(write_engine)
+    with write_engine.begin() as connection:
+        connection.execute(table.insert(), [
+            {'title': f'Drink {i}', 'recipe': RECIPE} for i in range(rows)])
+
+    counters = {'reads': 0, 'writes': 0, 'errors': 0}
+    lock = threading.Lock()
+    deadline = time.monotonic() + seconds
+
+    def count(name):
+        with lock:
+            counters[name] += 1
+
+    def reader():
+        while time.monotonic() < deadline:
+            after_id = random.randint(0, rows)
+            query = select(table).where(table.c.id > after_id).order_by(
+                table.c.id).limit(50)
+            try:
+                with read_engine.connect() as connection:
+                    connection.execute(query).fetchall()
+                count('reads')
+            except OperationalError:
+                count('errors')
+
+    def writer():
+        while time.monotonic() < deadline:
+            drink_id = random.randint(1, rows)
+            query = table.update().where(table.c.id == drink_id).values(
+                recipe=RECIPE)
+            try:
+                with write_engine.begin() as connection:
+                    connection.execute(query)
+                count('writes')
+            except OperationalError:
+                count('errors')
+
+    threads = [threading.Thread(target=reader) for _ in range(readers)]
+    threads += [threading.Thread(target=writer) for _ in range(writers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    write_engine.dispose()
+    read_engine.dispose()
+    return {
+        'reads/s': round(counters['reads'] / seconds),
+        'writes/s': round(counters['writes'] / seconds),
+        'lock errors': counters['errors']
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--readers', type=int, default=8)
+    parser.add_argument('--writers', type=int, default=2)
+    parser.add_argument('--rows', type=int, default=1000)
+    args = parser.parse_args()
+
+    profiles = {'before': None, 'after': get_engine_profile()}
+    for name, profile in profiles.items():
+        with tempfile.TemporaryDirectory() as directory:
+            url = 'sqlite:///' + os.path.join(directory, 'bench.db')
+            result = run(url, profile, args.rows, args.seconds,
+                         args.readers, args.writers)
+        print(f'{name:>6}: ' + ', '.join(
+            f'{key} {value}' for key, value in result.items()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,377 @@
+'''
+End-to-end load test replaying the Postman collection per role
+
+Usage (from the backend folder):
+    python load_api.py --seconds 10 --concurrency 16 --read-ratio 0.9
+    python load_api.py --roles manager=1 --json results.json
+
+The app is served over HTTP on a local port against a temporary database.
+Tokens are signed with a locally generated RS256 key, carry the
+permissions of the tokens in the collection and are verified against a
+local JWKS file, so no network access (and no Auth0 account) is needed.
+Every request is checked against the status code the collection tests
+expect.
+'''
+from src.auth.local_keys import LocalSigner
+from src.database.models import Drink, db
+from src.api import create_app
+from werkzeug.serving import WSGIRequestHandler, make_server
+from urllib.parse import urlsplit
+from jose import jwt
+
+import http.client
+import collections
+import itertools
+import threading
+import tempfile
+import argparse
+import random
+import json
+import time
+import re
+import os
+
+
+COLLECTION_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    'udacity-fsnd-udaspicelatte.postman_collection.json')
+
+# Drink of the "request_body" variable, the pre-request script of the
+# collection builds the same one with a random title
+REQUEST_BODY = {
+    'title': 'Manager Coffee',
+    'recipe': [{'name': 'Milk', 'color': 'white', 'parts': 1},
+               {'name': 'Coffee', 'color': 'brown', 'parts': 2}]
+}
+
+# Expected status in the test script, i.e. pm.response.to.have.status(200)
+EXPECTED_STATUS = re.compile(r'have\.status\((\d+)\)')
+# The id of /drinks/<id>
+DRINK_ID = re.compile(r'^/drinks/\d+$')
+
+# A collection request: the route is the path with the drink id replaced,
+# the latencies of a route are reported together
+CollectionRequest = collections.namedtuple('CollectionRequest', [
+    'role', 'method', 'path', 'route', 'body', 'expected'])
+
+# --------------------------------------------------------------------------- #
+# Collection
+# --------------------------------------------------------------------------- #
+
+
+def folder_token(folder):
+    auth = folder.get('auth') or {}
+    for item in auth.get('bearer', ()):
+        if item.get('key') == 'token':
+            return item['value']
+    return None
+
+
+def load_collection(path=COLLECTION_PATH):
+    '''
+    Arguments:
+        - path: Postman collection (v2.1) with a folder per role
+
+    Returns:
+        - (requests, permissions) tuple: the CollectionRequests and the
+        dictionary of role -> permissions of the bearer token of the role
+        folder (decoded without verification), None for a public role
+    '''
+    with open(path) as collection_file:
+        collection = json.load(collection_file)
+
+    requests = []
+    permissions = {}
+    for folder in collection['item']:
+        role = folder['name']
+        token = folder_token(folder)
+        permissions[role] = None if token is None else \
+            jwt.get_unverified_claims(token).get('permissions', [])
+
+        for item in folder['item']:
+            request = item['request']
+            path = urlsplit(request['url']['raw']).path
+            raw = (request.get('body') or {}).get('raw') or None
+            if raw is not None:
+                raw = raw.replace('{{request_body}}', json.dumps(REQUEST_BODY))
+            expected = None
+            for event in item.get('event', ()):
+                if event['listen'] == 'test':
+                    match = EXPECTED_STATUS.search(
+                        '\n'.join(event['script']['exec']))
+                    if match:
+                        expected = int(match.group(1))
+            route = '/drinks/<id>' if DRINK_ID.match(path) else path
+            requests.append(CollectionRequest(
+                role, request['method'], path, route,
+                json.loads(raw) if raw else None, expected))
+    return requests, permissions
+
+
+def percentile(values, q):
+    '''
+    Arguments:
+        - values: sorted list
+        - q: percentile (i.e. 99)
+
+    Returns:
+        - the nearest-rank percentile of <values>
+    '''
+    if not values:
+        return 0
+    rank = max(1, -(-len(values) * q // 100))
+    return values[int(rank) - 1]
+
+# --------------------------------------------------------------------------- #
+# Load
+# --------------------------------------------------------------------------- #
+
+
+class LoadTest:
+    """
+    Replays the collection requests from <concurrency> threads, each over
+    its own keep-alive connection
+
+    - A request is a role picked by the <roles> weights, then one of its
+    reads (GET) with the <read_ratio> probability, otherwise one of its
+    writes
+    - Writes go to drinks of their own: patches to the drinks seeded at
+    start, deletes to the drinks created by the test, titles are unique
+    """
+
+    def __init__(self, host, port, requests, tokens, roles, read_ratio,
+                 seeded_ids, seed=0):
+        self.host = host
+        self.port = port
+        self.tokens = tokens
+        self.read_ratio = read_ratio
+        self.roles = [role for role in roles if roles[role] > 0]
+        self.weights = [roles[role] for role in self.roles]
+        self.reads = {role: [request for request in requests
+                             if request.role == role and
+                             request.method == 'GET']
+                      for role in self.roles}
+        self.writes = {role: [request for request in requests
+                              if request.role == role and
+                              request.method != 'GET']
+                       for role in self.roles}
+        self.patch_ids = list(seeded_ids)
+        self.delete_ids = collections.deque()
+        self.titles = itertools.count()
+        self.latencies = collections.defaultdict(list)
+        self.errors = collections.Counter()
+        self.seed = seed
+        self._lock = threading.Lock()
+
+    def pick(self, rng):
+        role = rng.choices(self.roles, self.weights)[0]
+        requests = self.reads[role]
+        if not requests or (self.writes[role] and
+                                rng.random() >= self.read_ratio):
+            requests = self.writes[role]
+        return rng.choice(requests)
+
+    def prepare(self, request, rng):
+        '''
+        Returns:
+            - (path, body) of <request>, or None if there is no drink left
+            to delete
+        '''
+        path, body = request.path, request.body
+        if body is not None and 'title' in body:
+            body = dict(body, title=f"{body['title']} {next(self.titles)}")
+        if request.expected == 200 and request.method == 'PATCH':
+            path = f'/drinks/{rng.choice(self.patch_ids)}'
+        elif request.expected == 200 and request.method == 'DELETE':
+            try:
+                path = f'/drinks/{self.delete_ids.popleft()}'
+            except IndexError:
+                return None
+        return path, body
+
+    def send(self, connection, request, path, body):
+        headers = {}
+        token = self.tokens.get(request.role)
+        if token is not None:
+            headers['Authorization'] = f'Bearer {token}'
+        data = None
+        if body is not None:
+            data = json.dumps(body)
+            headers['Content-Type'] = 'application/json'
+        connection.request(request.method, path, data, headers)
+        response = connection.getresponse()
+        return response.status, response.read()
+
+    def worker(self, number, deadline):
+        rng = random.Random(self.seed + number)
+        connection = http.client.HTTPConnection(self.host, self.port)
+        while time.monotonic() < deadline:
+            request = self.pick(rng)
+            prepared = self.prepare(request, rng)
+            if prepared is None:
+                continue
+            start = time.perf_counter()
+            try:
+                status, data = self.send(connection, request, *prepared)
+            except (OSError, http.client.HTTPException) as error:
+                print(error)
+                connection.close()
+                connection = http.client.HTTPConnection(self.host, self.port)
+                status, data = None, None
+            seconds = time.perf_counter() - start
+
+            key = (request.role, request.method, request.route)
+            with self._lock:
+                self.latencies[key].append(seconds)
+                if status != request.expected:
+                    self.errors[key] += 1
+            if status == 200 and request.method == 'POST':
+                self.delete_ids.append(
+                    json.loads(data)['drinks'][0]['id'])
+        connection.close()
+
+    def run(self, concurrency, seconds):
+        deadline = time.monotonic() + seconds
+        threads = [threading.Thread(target=self.worker,
+                                    args=(number, deadline))
+                   for number in range(concurrency)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return self.report(time.perf_counter() - start)
+
+    def report(self, elapsed):
+        '''
+        Returns:
+            - list of per endpoint and role results, then the total, with
+            the throughput in requests per second and the latency
+            percentiles in milliseconds
+        '''
+        rows = []
+        keys = sorted(self.latencies)
+        for key in keys + [None]:
+            if key is None:
+                latencies = sorted(itertools.chain.from_iterable(
+                    self.latencies.values()))
+                errors = sum(self.errors.values())
+                role, method, route = 'all', '', 'total'
+            else:
+                latencies = sorted(self.latencies[key])
+                errors = self.errors[key]
+                role, method, route = key
+            rows.append({
+                'role': role,
+                'endpoint': f'{method} {route}'.strip(),
+                'requests': len(latencies),
+                'errors': errors,
+                'throughput': round(len(latencies) / elapsed, 1),
+                'p50': round(percentile(latencies, 50) * 1000, 2),
+                'p95': round(percentile(latencies, 95) * 1000, 2),
+                'p99': round(percentile(latencies, 99) * 1000, 2)
+            })
+        return rows
+
+# --------------------------------------------------------------------------- #
+# Command line
+# --------------------------------------------------------------------------- #
+
+
+def parse_roles(value):
+    '''
+    Returns:
+        - dictionary of role -> weight of "public=1,manager=2"
+    '''
+    roles = {}
+    for item in value.split(','):
+        role, _, weight = item.partition('=')
+        roles[role.strip()] = float(weight or 1)
+    return roles
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    # One access log line per request would slow the server down
+    def log_request(self, *args):
+        pass
+
+
+def serve(directory, seed_drinks, config):
+    '''
+    Returns:
+        - (server, signer, seeded drink ids) tuple: the app served on a
+        free local port and the signer of the keys its JWKS file holds
+    '''
+    signer = LocalSigner()
+    jwks_path = os.path.join(directory, 'jwks.json')
+    signer.write_jwks(jwks_path)
+    app = create_app(dict({
+        'SQLALCHEMY_DATABASE_URI':
+            'sqlite:///' + os.path.join(directory, 'load.db'),
+        'AUTH0_JWKS_FILE': jwks_path,
+        'SHARED_CACHE_DIR': os.path.join(directory, 'shared')
+    }, **config))
+    with app.app_context():
+        ids = [Drink.create(f'Load Drink {i}', json.dumps(
+            REQUEST_BODY['recipe'])) for i in range(seed_drinks)]
+        db.session.remove()
+    server = make_server('127.0.0.1', 0, app, threaded=True,
+                         request_handler=QuietRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, signer, ids
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--read-ratio', type=float, default=0.9,
+                        help='share of reads (GET) of every role')
+    parser.add_argument('--roles', type=parse_roles,
+                        default='public=1,barista=1,manager=1',
+                        help='role weights, i.e. public=4,manager=1')
+    parser.add_argument('--seed-drinks', type=int, default=100)
+    parser.add_argument('--rate-limits', action='store_true',
+                        help='keep the rate limits and load shedding on')
+    parser.add_argument('--write-coalescing', action='store_true')
+    parser.add_argument('--collection', default=COLLECTION_PATH)
+    parser.add_argument('--json', help='write the results to this file')
+    args = parser.parse_args()
+
+    requests, permissions = load_collection(args.collection)
+    unknown = set(args.roles) - set(permissions)
+    if unknown:
+        parser.error(f'unknown roles: {", ".join(sorted(unknown))}')
+
+    with tempfile.TemporaryDirectory() as directory:
+        server, signer, ids = serve(directory, args.seed_drinks, {
+            'RATE_LIMIT_ENABLED': args.rate_limits,
+            'WRITE_COALESCING': args.write_coalescing
+        })
+        tokens = {role: signer.token(granted, sub=f'load|{role}')
+                  for role, granted in permissions.items()
+                  if granted is not None}
+        load = LoadTest('127.0.0.1', server.server_port, requests, tokens,
+                        args.roles, args.read_ratio, ids)
+        rows = load.run(args.concurrency, args.seconds)
+        server.shutdown()
+
+    print(f"{'role':<8} {'endpoint':<22} {'requests':>8} {'errors':>6} "
+          f"{'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for row in rows:
+        print(f"{row['role']:<8} {row['endpoint']:<22} {row['requests']:>8} "
+              f"{row['errors']:>6} {row['throughput']:>8} {row['p50']:>8} "
+              f"{row['p95']:>8} {row['p99']:>8}")
+
+    if args.json:
+        with open(args.json, 'w') as results_file:
+            json.dump({'config': {
+                'seconds': args.seconds,
+                'concurrency': args.concurrency,
+                'read_ratio': args.read_ratio,
+                'roles': args.roles
+            }, 'results': rows}, results_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
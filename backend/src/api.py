@@ -1,103 +1,513 @@
-from flask import Flask, jsonify, abort, g as payload, make_response
-from .database.models import setup_db, Drink, db_drop_and_create_all
-from .auth.auth import AuthError, requires_auth
-from flask_expects_json import expects_json
+from flask import Blueprint, Flask, current_app, jsonify, abort, \
+    g as payload, make_response, request, stream_with_context
+from .database.models import setup_db, Drink, db, db_init, \
+    current_menu_version, is_file_database
+from .database.replica import current_replica
+from .database.search import build_match_query
+from .database.changes import needs_resync
+from .cache.cache import ResponseCache, make_entry
+from .cache.shared import SharedStore, SharedVersion, shared_cache_dir, \
+    open_shared_dir
+from .auth.auth import AuthError, requires_auth, check_permissions, \
+    current_claims_cache, current_key_manager, setup_auth
+from .schemas import create_drinks_schema, update_drinks_schema, \
+    batch_drinks_schema, batch_permissions, validate_batch, batch_ids, \
+    batch_titles, check_batch_conflicts, mark_not_applied, is_valid_create, \
+    is_valid_update
+from .pagination import encode_cursor, parse_page_args, encode_page, \
+    encode_changes
+from .idempotency import idempotent
+from .catalog import drinks_cli, catalog_rows, export_lines, import_lines, \
+    IMPORT_CHUNK_SIZE, IMPORT_MAX_CHUNK_SIZE, IMPORT_MODES
+from .validation import expects_json, MAX_CONTENT_LENGTH
+from .compression import setup_compression, negotiate_encoding, \
+    encoded_variant, mark_negotiated, CACHED_LEVELS, DYNAMIC_LEVELS
+from .limits import setup_limits, current_limits, OVERLOAD_RETRY_AFTER
+from .events import menu_events, stream_events, connection_closed, \
+    EVENTS_HEARTBEAT
+from .metrics.metrics import setup_metrics, registry, CallbackMetric, \
+    phase, timed
 from jsonschema import ValidationError
 from flask_cors import CORS
 
-import pathlib
 import json
 import os
 
 
-app = Flask(__name__)
-SECRET_KEY = os.urandom(32)
-setup_db(app)
-CORS(app)
+# The routes and error handlers, registered on the application by
+# create_app
+api = Blueprint('api', __name__)
+
+# --------------------------------------------------------------------------- #
+# Pagination
+# --------------------------------------------------------------------------- #
+
+# Plain rows instead of models, the json serializers only read these
+MENU_COLUMNS = (Drink.id, Drink.title, Drink.recipe, Drink.short_fragment,
+                Drink.long_fragment)
+
+
+def get_menu_rows(after_id=0, limit=None):
+    '''
+    Arguments:
+        - after_id: only the drinks with a greater id
+        - limit: maximum number of drinks, None for all of them
+
+    - Served from the menu replica of the application without a database
+    query while the menu version is unchanged, from the drinks table if
+    the replica is turned off (MENU_REPLICA)
+
+    Returns:
+        - list of drinks (DrinkRecords or rows) in id order
+    '''
+    replica = current_replica()
+    if replica is not None:
+        return replica.page(current_menu_version().value, after_id, limit)
+    return Drink.query.with_entities(*MENU_COLUMNS).filter(
+        Drink.id > after_id).order_by(Drink.id).limit(limit).all()
+
+
+def get_page_args(unpaged=False):
+    '''
+    Reads the "limit" and "cursor" query parameters of the request
+
+    Arguments:
+        - unpaged: see parse_page_args
+
+    - Responds with a 400 error if any of them is malformed
+    - The limit is capped at DRINKS_MAX_PAGE_SIZE
+
+    Returns:
+        - (limit, after_id) tuple
+    '''
+    try:
+        return parse_page_args(
+            request.args.get('limit'), request.args.get('cursor'), unpaged)
+    except ValueError:
+        abort(400)
+
+
+def get_drinks_page():
+    '''
+    Keyset pagination over the drinks table ordered by Drink.id, the cost of
+    a page does not depend on the number of rows before it.
+
+    - A request without "limit" and "cursor" gets the whole menu in one
+    page, the clients written before the pagination never follow
+    next_cursor
+    - Responds with a 404 error if the page is empty
+
+    Returns:
+        - (drinks, next_cursor) tuple, next_cursor is None on the last page
+    '''
+    limit, after_id = get_page_args(unpaged=True)
+
+    # One extra row tells whether there is a next page
+    drinks = get_menu_rows(after_id, None if limit is None else limit + 1)
+
+    # 404 if there are no drinks entries
+    if not drinks:
+        abort(404)
+
+    next_cursor = None
+    if limit is not None and len(drinks) > limit:
+        drinks = drinks[:limit]
+        next_cursor = encode_cursor(drinks[-1].id)
+
+    return drinks, next_cursor
+
+
+def get_search_page():
+    '''
+    Ranked, offset based pagination over the full-text search results of
+    the "q" query parameter, the cursor encodes the offset of the next page
+
+    - Responds with a 400 error if "q" is missing or has no words
+    - Responds with a 404 error if the page is empty
+
+    Returns:
+        - (drinks, next_cursor) tuple, next_cursor is None on the last page
+    '''
+    limit, offset = get_page_args()
+    try:
+        query = build_match_query(request.args.get('q'))
+    except ValueError:
+        abort(400)
+
+    # One extra row tells whether there is a next page
+    drinks = Drink.search(query, limit + 1, offset)
+
+    # 404 if there are no matching drinks
+    if not drinks:
+        abort(404)
+
+    next_cursor = None
+    if len(drinks) > limit:
+        drinks = drinks[:limit]
+        next_cursor = encode_cursor(offset + limit)
+
+    return drinks, next_cursor
 
-# Creates database with seed data if it not exists
-if not pathlib.Path('database/database.db').exists():
-    db_drop_and_create_all()
 
 # --------------------------------------------------------------------------- #
-# Validation schemas for payloads based on https://json-schema.org
+# Streaming
 # --------------------------------------------------------------------------- #
 
-create_drinks_schema = {
-    'type': 'object',
-    'properties': {
-        'title': {'type': 'string'},
-        'recipe': {
-            'type': 'array',
-            'items': {
-                'type': 'object',
-                'properties': {
-                    'name': {'type': 'string'},
-                    'color': {'type': 'string'},
-                    'parts': {'type': 'number'}
-                },
-                'required': ['name', 'color', 'parts']
-            }
-        },
-    },
-    'required': ['title', 'recipe']
-}
-
-update_drinks_schema = {
-    'type': 'object',
-    'anyOf': [
-        {
-            'properties': {
-                'title': {'type': 'string'},
-            },
-            'required': ['title']
-        },
-        {
-            'properties': {
-                'recipe': {
-                    'type': 'array',
-                    'items': {
-                        'type': 'object',
-                        'properties': {
-                            'name': {'type': 'string'},
-                            'color': {'type': 'string'},
-                            'parts': {'type': 'number'}
-                        },
-                        'required': ['name', 'color', 'parts']
-                    }
-                },
-            },
-            'required': ['recipe']
-        }
-    ],
-}
+# Rows fetched from the database at once
+STREAM_BATCH_SIZE = 500
+# Size of the chunks written to the client in bytes
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+def stream_requested():
+    '''
+    Returns:
+        - True if the "stream" query parameter is "1" or "true"
+    '''
+    return request.args.get('stream') in ('1', 'true')
+
+
+def stream_menu_response(serializer):
+    '''
+    Arguments:
+        - serializer: Drink json method (Drink.short_json or
+        Drink.long_json)
+
+    - Iterates the menu replica, or the whole drinks table in batches of
+    STREAM_BATCH_SIZE rows and serializes every drink as it arrives, the
+    memory usage does not depend on the size of the menu
+    - Responds with a 404 error if there are no drinks
+
+    Returns:
+        - chunked response with the same json shape as a single page
+    '''
+    replica = current_replica()
+    if replica is not None:
+        rows = iter(replica.page(current_menu_version().value))
+    else:
+        rows = iter(Drink.query.with_entities(*MENU_COLUMNS).order_by(
+            Drink.id).yield_per(STREAM_BATCH_SIZE))
+
+    # 404 if there are no drinks entries
+    first = next(rows, None)
+    if first is None:
+        abort(404)
+
+    def generate():
+        chunk = ['{"drinks":[', serializer(first)]
+        size = len(chunk[1])
+        for drink in rows:
+            data = serializer(drink)
+            chunk += (',', data)
+            size += len(data) + 1
+            if size >= STREAM_CHUNK_SIZE:
+                yield ''.join(chunk)
+                chunk = []
+                size = 0
+        chunk.append('],"next_cursor":null}\n')
+        yield ''.join(chunk)
+
+    return current_app.response_class(stream_with_context(generate()),
+                                      status=200, mimetype='application/json')
+
+
+def event_stream_response(representation):
+    '''
+    Arguments:
+        - representation: 'short' or 'long'
+
+    - Subscribes to the menu_events hub before responding, no change
+    committed by this process after the request is missed
+    - The subscription is released once the client closed the connection,
+    see events.connection_closed
+    - Resumes after the Last-Event-ID header (sent by EventSource when it
+    reconnects) or the "last_event_id" query parameter
+    - Responds with a 400 error if the last event id is not an integer
+
+    Returns:
+        - text/event-stream response of the menu changes
+    '''
+    last_event_id = request.headers.get('Last-Event-ID') or \
+        request.args.get('last_event_id')
+    if last_event_id is not None:
+        try:
+            last_event_id = int(last_event_id)
+        except ValueError:
+            abort(400)
+
+    subscription = menu_events.subscribe(last_event_id)
+    response = current_app.response_class(
+        stream_events(menu_events, subscription, representation,
+                      current_app.config['EVENTS_HEARTBEAT'],
+                      connection_closed(request.environ)),
+        status=200, mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # Proxies must not buffer the stream
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+# --------------------------------------------------------------------------- #
+# Menu response cache
+# --------------------------------------------------------------------------- #
+
+def menu_response(serializer, get_page=get_drinks_page):
+    '''
+    Arguments:
+        - serializer: Drink json method (Drink.short_json or
+        Drink.long_json)
+        - get_page: function returning the (drinks, next_cursor) page of the
+        request
+
+    - Serves the serialized page from the menu cache of the application
+    (app.extensions['menu_cache']) while the menu version is unchanged
+    - Sends the gzip or brotli variant the client accepts, a cached page is
+    compressed once per menu version and encoding
+    - Responds with 304 and an empty body if the client already has the
+    current representation (If-None-Match)
+
+    Returns:
+        - response with the page of drinks and a strong ETag header
+    '''
+    config = current_app.config
+    enabled = config['MENU_CACHE_ENABLED']
+    menu_cache = current_app.extensions['menu_cache']
+    key = (request.path, request.query_string)
+    version = current_menu_version().value
+
+    entry = menu_cache.get(key, version) if enabled else None
+    if entry is None:
+        drinks, next_cursor = get_page()
+        with phase('serialization'):
+            body = encode_page(serializer, drinks, next_cursor)
+        entry = menu_cache.set(key, version, body) if enabled \
+            else make_entry(body)
+
+    body, etag, encoding = entry.body, entry.etag, None
+    if config['COMPRESSION_ENABLED']:
+        encoding = negotiate_encoding(request.accept_encodings, len(body),
+                                      config['COMPRESSION_MIN_SIZE'])
+    if encoding is not None:
+        variant = encoded_variant(
+            entry, encoding, CACHED_LEVELS if enabled else DYNAMIC_LEVELS)
+        if variant is not None:
+            body, etag = variant
+        else:
+            encoding = None
+
+    if request.if_none_match.contains_weak(etag):
+        response = current_app.response_class(status=304)
+    else:
+        response = current_app.response_class(
+            body, status=200, mimetype='application/json')
+        if encoding is not None:
+            response.headers['Content-Encoding'] = encoding
+    response.set_etag(etag)
+    response.vary.add('Accept-Encoding')
+    return mark_negotiated(response)
+
+
+# --------------------------------------------------------------------------- #
+# Metrics
+# --------------------------------------------------------------------------- #
+
+def jwks_fetches():
+    key_manager = current_key_manager()
+    return {
+        ('success',): key_manager.fetches - key_manager.fetch_errors,
+        ('error',): key_manager.fetch_errors
+    }
+
+
+registry.register(CallbackMetric(
+    'coffee_jwks_fetches_total', 'JWKS document fetches by result',
+    'counter', ('result',), jwks_fetches))
+
+
+def cache_lookups():
+    menu_cache = current_app.extensions['menu_cache']
+    claims = current_claims_cache().stats()
+    return {
+        ('menu', 'hit'): menu_cache.hits,
+        ('menu', 'miss'): menu_cache.misses,
+        ('menu', 'shared_hit'): menu_cache.shared_hits,
+        ('claims', 'hit'): claims['hits'],
+        ('claims', 'miss'): claims['misses']
+    }
+
+
+registry.register(CallbackMetric(
+    'coffee_cache_lookups_total', 'Menu response and token claims cache '
+    'lookups by result', 'counter', ('cache', 'result'), cache_lookups))
+
+
+def replica_syncs():
+    replica = current_replica()
+    if replica is None:
+        return {}
+    return {
+        ('load',): replica.loads,
+        ('patch',): replica.patches,
+        ('repair',): replica.repairs
+    }
+
+
+registry.register(CallbackMetric(
+    'coffee_menu_replica_syncs_total', 'Menu replica full loads, '
+    'incremental patches and repairs after a failed consistency check',
+    'counter', ('kind',), replica_syncs))
+
+registry.register(CallbackMetric(
+    'coffee_event_stream_subscribers', 'Open menu event streams',
+    callback=lambda: {(): menu_events.stats()['subscribers']}))
+
+registry.register(CallbackMetric(
+    'coffee_event_stream_dropped_total', 'Menu event streams dropped for '
+    'falling behind', 'counter',
+    callback=lambda: {(): menu_events.stats()['dropped']}))
+
+
+def slow_statements():
+    profiler = current_app.extensions.get('query_profiler')
+    if profiler is None:
+        return {}
+    return {
+        ('query',): profiler.slow_queries,
+        ('request',): profiler.slow_requests
+    }
+
+
+registry.register(CallbackMetric(
+    'coffee_db_slow_total', 'Slow SQL statements and slow requests logged '
+    'by the query profiler', 'counter', ('kind',), slow_statements))
+
+
+def rejected_requests():
+    limits = current_limits()
+    if limits is None:
+        return {}
+    return {
+        ('rate_limited',): limits.rate_limited,
+        ('shed',): limits.shed
+    }
+
+
+def requests_in_flight():
+    limits = current_limits()
+    return {(): limits.gate.in_flight} if limits is not None else {}
+
+
+registry.register(CallbackMetric(
+    'coffee_requests_rejected_total', 'Requests rejected by the rate '
+    'limits (429) and shed under overload (503)', 'counter', ('reason',),
+    rejected_requests))
+
+registry.register(CallbackMetric(
+    'coffee_requests_in_flight', 'Requests holding an admission slot',
+    callback=requests_in_flight))
+
+
+# --------------------------------------------------------------------------- #
+# Batch operations
+# --------------------------------------------------------------------------- #
+
+def resolve_batch(operations, results):
+    '''
+    Arguments:
+        - operations: list of valid batch operations
+        - results: list of per operation result dictionaries
+
+    - Loads the drinks of the updates and deletes in one query
+    - Loads the drinks with the new titles in one query
+    - Marks unknown ids and conflicts in <results>, see
+    check_batch_conflicts
+
+    Returns:
+        - dictionary of id -> Drink model or None if any operation failed
+    '''
+    ids = batch_ids(operations)
+    drinks = {drink.id: drink for drink in
+              Drink.query.filter(Drink.id.in_(ids))} if ids else {}
+
+    titles = batch_titles(operations)
+    existing = dict(Drink.query.with_entities(Drink.title, Drink.id).filter(
+        Drink.title.in_(titles))) if titles else {}
+
+    if not check_batch_conflicts(operations, results, drinks, existing):
+        return None
+    return drinks
+
+
+def reject_batch(status, results):
+    '''
+    Arguments:
+        - status: status code of the response
+        - results: list of per operation result dictionaries
+
+    - Operations without an error of their own are marked with status 424
+    since nothing was applied
+
+    Returns:
+        - the error response listing the results
+    '''
+    mark_not_applied(results)
+    return jsonify({
+        'error': status,
+        'message': 'batch rejected',
+        'results': results
+    }), status
 
 
 # --------------------------------------------------------------------------- #
 # Routes
 # --------------------------------------------------------------------------- #
 
-@app.route('/drinks')
+@api.route('/drinks')
 def get_drinks():
     '''
     A public endpoint, contains only the drink.short() data representation.
 
+    Query parameters:
+        - limit: page size, capped at DRINKS_MAX_PAGE_SIZE
+        - cursor: the next_cursor value of the previous page
+        - stream: "1" or "true" streams the whole menu in one chunked
+        response, limit and cursor are ignored
+
     Returns:
-        - status code 200 and json {"drinks": drinks} where drinks is the
-    list of drinks or appropriate status code indicating reason for failure.
+        - status code 200 and json {"drinks": drinks, "next_cursor": cursor}
+    where drinks is the list of drinks and cursor points to the next page
+    (null on the last page) or appropriate status code indicating reason for
+    failure.
+        - status code 304 if the ETag sent in If-None-Match is current
     '''
-    drinks = Drink.query.all()
+    if stream_requested():
+        return stream_menu_response(Drink.short_json)
+    return menu_response(Drink.short_json)
 
-    # 404 if there are no drinks entries
-    if not drinks:
-        abort(404)
 
-    return jsonify({
-        'drinks': [drink.short() for drink in drinks],
-    }), 200
+@api.route('/drinks/search')
+def search_drinks():
+    '''
+    A public endpoint, searches the drink titles and ingredient names and
+    contains only the drink.short() data representation.
+
+    Query parameters:
+        - q: search text, every word must match the start of a word in the
+        title or in an ingredient name
+        - limit: page size, capped at DRINKS_MAX_PAGE_SIZE
+        - cursor: the next_cursor value of the previous page
 
+    Returns:
+        - status code 200 and json {"drinks": drinks, "next_cursor": cursor}
+    where drinks is the list of matching drinks, best matches first, and
+    cursor points to the next page (null on the last page) or appropriate
+    status code indicating reason for failure.
+        - status code 304 if the ETag sent in If-None-Match is current
+    '''
+    return menu_response(Drink.short_json, get_search_page)
 
-@app.route('/drinks-detail')
+
+@api.route('/drinks-detail')
 @requires_auth('get:drinks-detail')
 def get_drinks_detail():
     '''
@@ -106,66 +516,142 @@ def get_drinks_detail():
     - Requires the 'get:drinks-detail' permission
     - Contains the drink.long() data representation
 
+    Query parameters:
+        - limit: page size, capped at DRINKS_MAX_PAGE_SIZE
+        - cursor: the next_cursor value of the previous page
+        - stream: "1" or "true" streams the whole menu in one chunked
+        response, limit and cursor are ignored
+
     Returns:
-        - status code 200 and json {"drinks": drinks} where drinks is the
-    list of drinks or appropriate status code indicating reason for failure
+        - status code 200 and json {"drinks": drinks, "next_cursor": cursor}
+    where drinks is the list of drinks and cursor points to the next page
+    (null on the last page) or appropriate status code indicating reason for
+    failure
+        - status code 304 if the ETag sent in If-None-Match is current
     '''
-    drinks = Drink.query.all()
+    if stream_requested():
+        return stream_menu_response(Drink.long_json)
+    return menu_response(Drink.long_json)
 
-    # 404 if there are no drinks entries
-    if not drinks:
-        abort(404)
 
-    return jsonify({
-        'drinks': [drink.long() for drink in drinks],
-    }), 200
+@api.route('/drinks/stream')
+def stream_drinks():
+    '''
+    A public endpoint, Server-Sent Events stream of the menu changes with
+    the drink.short() data representation.
+
+    - Every committed change is an event with its id, the "create",
+    "update" or "delete" type and the drink as data ({"id": id} for a
+    delete)
+    - Idle streams get a heartbeat comment every EVENTS_HEARTBEAT seconds
+    - Streams falling EVENTS_QUEUE_SIZE events behind are closed, the
+    client reconnects and resumes
+    - A "resync" event means the missed events are no longer kept, the
+    client has to fetch the whole menu from /drinks
 
+    Headers:
+        - Last-Event-ID: id of the last event received, the stream starts
+        with the events missed since
 
-@app.route('/drinks', methods=['POST'])
+    Returns:
+        - status code 200 and the text/event-stream of the changes or
+    appropriate status code indicating reason for failure
+    '''
+    return event_stream_response('short')
+
+
+@api.route('/drinks-detail/stream')
+@requires_auth('get:drinks-detail')
+def stream_drinks_detail():
+    '''
+    Server-Sent Events stream of the menu changes with the drink.long()
+    data representation
+
+    - Requires the 'get:drinks-detail' permission
+    - Same events as /drinks/stream
+
+    Headers:
+        - Last-Event-ID: id of the last event received, the stream starts
+        with the events missed since
+
+    Returns:
+        - status code 200 and the text/event-stream of the changes or
+    appropriate status code indicating reason for failure
+    '''
+    return event_stream_response('long')
+
+
+@api.route('/drinks/changes')
+@requires_auth('get:drinks-detail')
+def get_drinks_changes():
+    '''
+    Delta sync of the drink.long() data representation
+
+    - Requires the 'get:drinks-detail' permission
+    - Responds with a 400 error if "since" is missing or not a version
+
+    Query parameters:
+        - since: the version of the previous response, 0 for the first sync
+
+    Returns:
+        - status code 200 and json {"deleted": ids, "drinks": drinks,
+    "resync": false, "version": version} where drinks are the drinks
+    created or updated and ids are the drinks deleted after <since>, and
+    version is the <since> of the next sync
+        - "resync": true with empty lists if the changes after <since> are
+    no longer kept, the client has to fetch the whole menu from
+    /drinks-detail and continue from the returned version
+    '''
+    since = request.args.get('since', type=int)
+    if since is None or since < 0:
+        abort(400)
+
+    version, upserts, deleted = Drink.changes(since)
+    resync = needs_resync(since, version)
+    if resync:
+        upserts, deleted = [], []
+
+    with phase('serialization'):
+        body = encode_changes(Drink.long_json, version, upserts, deleted,
+                              resync)
+    return current_app.response_class(body, status=200,
+                                      mimetype='application/json')
+
+
+@api.route('/drinks', methods=['POST'])
 @requires_auth('post:drinks')
-@expects_json(create_drinks_schema)
+@idempotent
+@timed('validation', expects_json(create_drinks_schema, is_valid_create))
 def create_drinks():
     '''
     - Creates a new row in the drinks table
     - Requires the 'post:drinks' permission
+    - Retries with the same Idempotency-Key header replay the stored
+    response, see idempotent
 
     Returns:
         - status code 200 and json {"drinks": drink}, where drink an array
     containing only the newly created drink or appropriate status code
     indicating reason for failure
     '''
+    title = payload.data.get('title')
+    recipe = payload.data.get('recipe')
 
-    drink = Drink.query.filter(
-        Drink.title == payload.data.get('title')).first()
-
-    # 409 posted drink already exists
+    # Throws 409 if the drink already exists, the unique title is checked
+    # by the insert statement itself
     # https://stackoverflow.com/questions/12658574/rest-api-design-post-to-create-with-duplicate-data-would-be-integrityerror-500
-    if drink:
-        abort(409)
-
-    drink = Drink(
-        title=payload.data.get('title'),
-        recipe=json.dumps(payload.data.get('recipe'))
-    )
-
-    # Save drink data
-    drink_data = drink.long()
-
     # Throws 422 if there are problems during database transaction
     # Retrieve id of the new drink
-    drink_id = drink.insert()
-
-    # Propagate back the id
-    drink_data['id'] = drink_id
+    drink_id = Drink.create(title, json.dumps(recipe))
 
     return jsonify({
-        'drinks': [drink_data]
+        'drinks': [{'id': drink_id, 'title': title, 'recipe': recipe}]
     }), 200
 
 
-@app.route('/drinks/<int:id>', methods=['PATCH'])
+@api.route('/drinks/<int:id>', methods=['PATCH'])
 @requires_auth('patch:drinks')
-@expects_json(update_drinks_schema)
+@timed('validation', expects_json(update_drinks_schema, is_valid_update))
 def update_drinks(id):
     '''
     Arguments:
@@ -203,7 +689,7 @@ def update_drinks(id):
     }), 200
 
 
-@app.route('/drinks/<int:id>', methods=['DELETE'])
+@api.route('/drinks/<int:id>', methods=['DELETE'])
 @requires_auth('delete:drinks')
 def delete_drinks(id):
     '''
@@ -227,12 +713,164 @@ def delete_drinks(id):
         'delete': id
     }), 200
 
+@api.route('/drinks/batch', methods=['POST'])
+@requires_auth('post:drinks')
+@idempotent
+@timed('validation', expects_json(batch_drinks_schema))
+def batch_drinks():
+    '''
+    Applies a list of create, update and delete operations in a single
+    transaction, either all of them or none
+
+    - Requires the 'post:drinks' permission, and the 'patch:drinks' or
+    'delete:drinks' permission if the batch contains updates or deletes
+    - Create data is validated with create_drinks_schema, update data with
+    update_drinks_schema
+    - Responds with 400, 404 or 409 and the per operation results if any
+    operation is invalid, nothing is applied in that case
+    - Retries with the same Idempotency-Key header replay the stored
+    response, see idempotent
+
+    Returns:
+        - status code 200 and json {"results": results}, where results
+    contains the outcome of every operation in request order or
+    appropriate status code indicating reason for failure
+    '''
+    operations = payload.data.get('operations')
+
+    claims = payload.get('claims')
+    for op in {operation['op'] for operation in operations}:
+        check_permissions(batch_permissions[op], claims)
+
+    results = [{'op': operation['op']} for operation in operations]
+    if not validate_batch(operations, results):
+        return reject_batch(400, results)
+
+    drinks = resolve_batch(operations, results)
+    if drinks is None:
+        statuses = [result['status'] for result in results
+                    if 'status' in result]
+        return reject_batch(404 if 404 in statuses else 409, results)
+
+    creates = []
+    deletes = []
+    for operation, result in zip(operations, results):
+        data = operation.get('data')
+        if operation['op'] == 'create':
+            creates.append({
+                'title': data.get('title'),
+                'recipe': json.dumps(data.get('recipe'))
+            })
+            result['drink'] = {
+                'title': data.get('title'),
+                'recipe': data.get('recipe')
+            }
+        elif operation['op'] == 'update':
+            drink = drinks[operation['id']]
+            if 'title' in data:
+                drink.title = data.get('title')
+            if 'recipe' in data:
+                drink.recipe = json.dumps(data.get('recipe'))
+            result['drink'] = drink.long()
+        else:
+            deletes.append(drinks[operation['id']])
+            result['delete'] = operation['id']
+        result['status'] = 200
+
+    # Throws 409 or 422 if there are problems during database transaction
+    # Retrieve ids of the new drinks
+    created = iter(Drink.batch(creates=creates, deletes=deletes))
+
+    # Propagate back the ids
+    for result in results:
+        if result['op'] == 'create':
+            result['drink']['id'] = next(created)
+
+    return jsonify({
+        'results': results
+    }), 200
+
+
+@api.route('/drinks/export')
+@requires_auth('get:drinks-detail')
+def export_drinks():
+    '''
+    Streams the whole catalog as newline delimited json, one drink.long()
+    data representation per line, the input of /drinks/import
+
+    - Requires the 'get:drinks-detail' permission
+    - The drinks are read in batches from a single query, the memory usage
+    does not depend on the size of the catalog
+
+    Returns:
+        - status code 200 and the application/x-ndjson attachment or
+    appropriate status code indicating reason for failure
+    '''
+    lines = export_lines(catalog_rows())
+
+    def generate():
+        chunk = []
+        size = 0
+        for line in lines:
+            chunk.append(line)
+            size += len(line)
+            if size >= STREAM_CHUNK_SIZE:
+                yield ''.join(chunk)
+                chunk = []
+                size = 0
+        yield ''.join(chunk)
+
+    response = current_app.response_class(
+        stream_with_context(generate()), status=200,
+        mimetype='application/x-ndjson')
+    response.headers['Content-Disposition'] = \
+        'attachment; filename=drinks.ndjson'
+    return response
+
+
+@api.route('/drinks/import', methods=['POST'])
+@requires_auth('post:drinks')
+def import_drinks():
+    '''
+    Imports newline delimited json drinks, one create_drinks_schema
+    document per line (i.e. the lines of /drinks/export)
+
+    - Requires the 'post:drinks' permission, and the 'patch:drinks'
+    permission in upsert mode
+    - The body is read line by line and committed in chunks, a failed line
+    is reported and does not stop the import, see catalog.import_lines
+
+    Query parameters:
+        - mode: "skip" (default) leaves the drinks with a taken title as
+        they are, "upsert" replaces their recipe
+        - chunk_size: drinks per transaction, 1 to IMPORT_MAX_CHUNK_SIZE
+
+    Returns:
+        - status code 200 and the json report {"lines", "created",
+    "updated", "skipped", "failed", "chunks", "errors"}, where errors
+    contains the line number and message of the first IMPORT_MAX_ERRORS
+    failed lines, or appropriate status code indicating reason for failure
+    '''
+    mode = request.args.get('mode', 'skip')
+    try:
+        chunk_size = int(request.args.get('chunk_size', IMPORT_CHUNK_SIZE))
+    except ValueError:
+        abort(400)
+    if mode not in IMPORT_MODES or \
+            not 1 <= chunk_size <= IMPORT_MAX_CHUNK_SIZE:
+        abort(400)
+    if mode == 'upsert':
+        check_permissions('patch:drinks', payload.get('claims'))
+
+    report = import_lines(request.stream, mode, chunk_size)
+    return jsonify(report.as_dict()), 200
+
 # --------------------------------------------------------------------------- #
 # Error handling
 # --------------------------------------------------------------------------- #
 
 
-@app.errorhandler(400)
+@api.app_errorhandler(400)
 def bad_request(error):
     """
     In case of JSON schema Validation error, we provide a detailed
@@ -246,7 +884,7 @@ def bad_request(error):
     return jsonify({'error': 400, 'message': 'bad request'}), 400
 
 
-@app.errorhandler(AuthError)
+@api.app_errorhandler(AuthError)
 def auth_error(error):
     """Used for authentication/authorization errors"""
     status_code = error.status_code
@@ -256,31 +894,152 @@ def auth_error(error):
     }), status_code
 
 
-@app.errorhandler(401)
+@api.app_errorhandler(401)
 def unathorized(error):
     return jsonify({'error': 401, 'message': 'unathorized'}), 401
 
 
-@app.errorhandler(403)
+@api.app_errorhandler(403)
 def forbidden(error):
     return jsonify({'error': 403, 'message': 'forbidden'}), 403
 
 
-@app.errorhandler(404)
+@api.app_errorhandler(404)
 def resource_not_found(error):
     return jsonify({'error': 404, 'message': 'resource not found'}), 404
 
 
-@app.errorhandler(405)
+@api.app_errorhandler(405)
 def method_not_allowed(error):
     return jsonify({'error': 405, 'message': 'method not allowed'}), 405
 
 
-@app.errorhandler(409)
+@api.app_errorhandler(409)
 def conflict(error):
     return jsonify({'error': 409, 'message': 'resource already exists'}), 409
 
 
-@app.errorhandler(422)
+@api.app_errorhandler(413)
+def request_entity_too_large(error):
+    return jsonify({'error': 413, 'message': 'request entity too large'}), \
+        413
+
+
+@api.app_errorhandler(422)
 def unprocessable_entity(error):
     return jsonify({'error': 422, 'message': 'unprocessable entity'}), 422
+
+
+@api.app_errorhandler(429)
+def too_many_requests(error):
+    return jsonify({'error': 429, 'message': 'too many requests'}), 429, \
+        {'Retry-After': error.retry_after or OVERLOAD_RETRY_AFTER}
+
+
+@api.app_errorhandler(503)
+def service_unavailable(error):
+    return jsonify({'error': 503, 'message': 'service unavailable'}), 503, \
+        {'Retry-After': error.retry_after or OVERLOAD_RETRY_AFTER}
+
+
+# --------------------------------------------------------------------------- #
+# Application factory
+# --------------------------------------------------------------------------- #
+
+def setup_shared_cache(app):
+    '''
+    Arguments:
+        - app: flask application
+
+    - The worker processes of the host share the menu version (a
+    memory-mapped file, read on every request), the serialized menu
+    responses, the JWKS document and the idempotent responses (a SQLite
+    file, app.extensions['shared_store']) in the
+    SHARED_CACHE_DIR directory, by default a directory next to the
+    database file, see shared_cache_dir
+    - A directory which is not private to the user is refused, see
+    open_shared_dir, the values of the store are signed with its secret
+    - A write committed by any worker bumps the shared version, every
+    worker stops serving the older responses at once
+    - The files are created if they do not exist, the connections of the
+    store are opened by each process on first use
+    - Without the shared tier (or with a refused directory) the version of
+    a database file misses the
+    writes of the other processes, the menu cache and the menu replica are
+    turned off
+    - The menu cache, the menu version and the key manager are the ones of
+    <app> (app.extensions), other applications of the process keep theirs
+    '''
+    app.extensions['menu_cache'] = ResponseCache()
+    url = db.get_engine(app).url
+    directory = shared_cache_dir(
+        app.config['SHARED_CACHE_DIR'],
+        url.database if is_file_database(url) else None)
+    secret = open_shared_dir(directory) if directory is not None else None
+    if secret is None:
+        if is_file_database(url):
+            app.config['MENU_CACHE_ENABLED'] = False
+            app.extensions.pop('menu_replica', None)
+        return
+    store = SharedStore(os.path.join(directory, 'cache.db'), secret)
+    app.extensions['shared_store'] = store
+    app.extensions['menu_version'].share(
+        SharedVersion(os.path.join(directory, 'version')))
+    app.extensions['menu_cache'].store = store
+    app.extensions['key_manager'].store = store
+
+
+def create_app(config=None):
+    '''
+    Arguments:
+        - config: optional mapping of settings applied over the defaults
+        (i.e. {'SQLALCHEMY_DATABASE_URI': uri, 'MENU_CACHE_ENABLED': False})
+
+    - Importing this module has no side effects, the application, the
+    database binding and the schema are only set up here
+    - Creates the database with the seed data if it has no tables yet and
+    migrates it, unless DATABASE_INIT is False, see db_init
+    - The JWKS keys are fetched by the first authenticated request of the
+    serving process, so workers forked from a preloaded parent (gunicorn
+    --preload) start without open connections or threads
+
+    Returns:
+        - the flask application
+    '''
+    app = Flask(__name__)
+    app.config['SECRET_KEY'] = os.urandom(32)
+    # Largest json request body, see validation.expects_json
+    app.config['MAX_CONTENT_LENGTH'] = MAX_CONTENT_LENGTH
+    # Serialized menu responses are cached per menu version
+    app.config['MENU_CACHE_ENABLED'] = True
+    # Seconds between two heartbeat frames of an idle event stream
+    app.config['EVENTS_HEARTBEAT'] = EVENTS_HEARTBEAT
+    # The menu routes read an in-memory replica of the drinks table
+    app.config['MENU_REPLICA'] = True
+    # The drink writes of the request threads are group committed by a
+    # single writer thread, see models.create_drink_writer
+    app.config['WRITE_COALESCING'] = False
+    # Creates and migrates the database schema
+    app.config['DATABASE_INIT'] = True
+    # The SQL statements of every request are profiled while this file
+    # exists, see profiler.QueryProfiler
+    app.config['QUERY_PROFILER_TOGGLE_FILE'] = os.environ.get(
+        'QUERY_PROFILER_TOGGLE_FILE')
+    # Directory of the cache shared by the worker processes of the host,
+    # None for the default one of the database, '' turns it off
+    app.config['SHARED_CACHE_DIR'] = os.environ.get('SHARED_CACHE_DIR')
+    app.config.from_mapping(config or {})
+
+    setup_db(app)
+    setup_auth(app)
+    setup_shared_cache(app)
+    CORS(app)
+    setup_metrics(app)
+    setup_compression(app)
+    setup_limits(app)
+    app.register_blueprint(api)
+    app.cli.add_command(drinks_cli)
+
+    if app.config['DATABASE_INIT']:
+        db_init(app)
+    return app
@@ -0,0 +1,900 @@
+'''
+Asyncio-native ASGI entry point of the drinks API
+
+Exposes the same routes, validation schemas, error messages and
+requires_auth semantics as the Flask app in api.py, on top of aiosqlite.
+Start it from the backend folder with:
+
+    uvicorn --factory src.asgi:create_asgi_app --port 5000
+
+Importing the module has no side effect, the database and the shared
+cache directory are only opened by create_asgi_app and the first request.
+'''
+from .database.models import Drink, SEED_DRINKS, FRAGMENT_COLUMNS, \
+    BACKFILL_SELECT, BACKFILL_UPDATE, project_dir, database_filename, \
+    get_engine_profile, pragma_statements, encode_fragments
+from .schemas import create_drinks_schema, update_drinks_schema, \
+    batch_drinks_schema, batch_permissions, validate_batch, batch_ids, \
+    batch_titles, check_batch_conflicts, mark_not_applied, is_valid_create, \
+    is_valid_update
+from .validation import compile_schema, validation_error, \
+    MAX_CONTENT_LENGTH
+from .database.search import SEARCH_TABLE, SEARCH_QUERY, SEARCH_INDEX_DDL, \
+    SEARCH_INDEX_BACKFILL, build_match_query
+from .database.changes import CHANGE_TABLE, CHANGE_LOG_DDL, \
+    CHANGE_LOG_BACKFILL, VERSION_QUERY, UPSERTS_QUERY, TOMBSTONES_QUERY, \
+    needs_resync
+from .pagination import encode_cursor, parse_page_args, encode_page, \
+    encode_changes
+from .auth.auth import AuthError, get_token_auth_header, \
+    check_permissions, claims_cache
+from .auth import auth
+from .cache.shared import SharedVersion, shared_cache_dir, open_shared_dir
+from jsonschema import ValidationError
+from sqlalchemy.dialects.sqlite import dialect as sqlite_dialect
+from sqlalchemy.schema import CreateTable
+from werkzeug.datastructures import Headers
+from werkzeug.http import parse_etags
+from urllib.parse import parse_qsl
+from collections import namedtuple
+from contextlib import asynccontextmanager
+
+import aiosqlite
+import asyncio
+import hashlib
+import sqlite3
+import json
+import os
+import re
+
+
+# Row of the drink table, the Drink serializers only read these
+DrinkRow = namedtuple('DrinkRow', ['id', 'title', 'recipe', 'short_fragment',
+                                   'long_fragment'], defaults=(None, None))
+
+# Writes store the precomputed json fragments with the title and recipe
+INSERT_DRINK = ('INSERT INTO drink (title, recipe, short_fragment, '
+                'long_fragment) VALUES (:title, :recipe, :short_fragment, '
+                ':long_fragment)')
+# The unique title is checked by the insert statement itself
+CREATE_DRINK = INSERT_DRINK + ' ON CONFLICT (title) DO NOTHING'
+UPDATE_DRINK = ('UPDATE drink SET title = :title, recipe = :recipe, '
+                'short_fragment = :short_fragment, '
+                'long_fragment = :long_fragment WHERE id = :id')
+
+ERROR_MESSAGES = {
+    400: 'bad request',
+    401: 'unathorized',
+    403: 'forbidden',
+    404: 'resource not found',
+    405: 'method not allowed',
+    409: 'resource already exists',
+    413: 'request entity too large',
+    422: 'unprocessable entity',
+    500: 'internal server error'
+}
+
+# --------------------------------------------------------------------------- #
+# Request / response
+# --------------------------------------------------------------------------- #
+
+
+class HTTPError(Exception):
+    """Aborts the request with the error response of <status_code>"""
+
+    def __init__(self, status_code, message=None):
+        self.status_code = status_code
+        self.message = message or ERROR_MESSAGES.get(status_code, 'error')
+
+
+class Request:
+    """
+    The parts of an ASGI http scope used by the handlers, the body is None
+    if it is longer than the limit of the app
+    """
+
+    def __init__(self, scope, body):
+        self.method = scope['method']
+        self.path = scope['path']
+        self.query_string = scope.get('query_string', b'')
+        self.args = dict(parse_qsl(self.query_string.decode('latin-1')))
+        self.headers = Headers([
+            (name.decode('latin-1'), value.decode('latin-1'))
+            for name, value in scope.get('headers', ())])
+        self.body = body
+
+    def get_json(self):
+        '''
+        - Responds with a 400 error if the body is not declared as json or
+        cannot be decoded, like Flask's request.get_json()
+
+        Returns:
+            - the decoded json body
+        '''
+        mimetype = self.headers.get('Content-Type', '').split(';')[0]
+        if mimetype != 'application/json' and not mimetype.endswith('+json'):
+            raise HTTPError(400)
+        try:
+            return json.loads(self.body)
+        except ValueError:
+            raise HTTPError(400)
+
+
+class Response:
+    """Status, body and headers of an ASGI http response"""
+
+    def __init__(self, body=b'', status=200, headers=None,
+                 content_type='application/json'):
+        self.body = body
+        self.status = status
+        self.headers = Headers(headers or [])
+        if body or status != 304:
+            self.headers.setdefault('Content-Type', content_type)
+
+
+def json_response(data, status=200):
+    '''
+    Returns:
+        - Response with <data> encoded the same way as Flask's jsonify
+    '''
+    body = json.dumps(data, sort_keys=True, separators=(',', ':')) + '\n'
+    return Response(body.encode(), status)
+
+
+def drink_params(title, recipe, **params):
+    '''
+    Arguments:
+        - title: drink title
+        - recipe: recipe json text
+
+    Returns:
+        - parameters of INSERT_DRINK and UPDATE_DRINK
+    '''
+    return dict(params, title=title, recipe=recipe,
+                **encode_fragments(title, recipe))
+
+
+def error_response(status_code, message):
+    return json_response({'error': status_code, 'message': message},
+                         status_code)
+
+# --------------------------------------------------------------------------- #
+# Database
+# --------------------------------------------------------------------------- #
+
+
+class ConnectionPool:
+    """
+    Fixed size pool of aiosqlite connections, every connection runs its
+    queries in its own thread so the event loop never blocks on SQLite I/O
+    """
+
+    def __init__(self, path, size, statements):
+        self.path = path
+        self.size = size
+        self.statements = statements
+        self._queue = None
+        self._connections = []
+
+    async def open(self, timeout):
+        self._queue = asyncio.Queue()
+        for _ in range(self.size):
+            connection = await aiosqlite.connect(self.path, timeout=timeout)
+            for statement in self.statements:
+                await connection.execute(statement)
+            self._connections.append(connection)
+            self._queue.put_nowait(connection)
+
+    async def close(self):
+        for connection in self._connections:
+            await connection.close()
+        self._connections = []
+
+    @asynccontextmanager
+    async def connection(self):
+        connection = await self._queue.get()
+        try:
+            yield connection
+        finally:
+            # Never hand out a connection with an open transaction
+            if connection.in_transaction:
+                await connection.rollback()
+            self._queue.put_nowait(connection)
+
+
+class AsyncDatabase:
+    """
+    The SQLite database of the ASGI app with the engine profile of
+    setup_db: a pool of read-only connections for GET requests and a single
+    writer connection, SQLite allows only one writer at a time anyway
+    """
+
+    def __init__(self, path, profile):
+        self.path = path
+        self.profile = profile
+        self.reader = ConnectionPool(
+            path, profile['pool_size'], pragma_statements(profile, True))
+        self.writer = ConnectionPool(
+            path, 1, pragma_statements(profile))
+        self.opened = False
+        self._lock = None
+
+    async def open(self):
+        if self.opened:
+            return
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if self.opened:
+                return
+            created = not os.path.exists(self.path)
+            timeout = self.profile['busy_timeout'] / 1000
+            await self.writer.open(timeout)
+            if created:
+                await self.create_schema()
+            await self.migrate()
+            await self.reader.open(timeout)
+            self.opened = True
+
+    async def close(self):
+        await self.reader.close()
+        await self.writer.close()
+        self.opened = False
+
+    async def create_schema(self):
+        '''
+        Creates the drink table with the seed data of a new database
+        '''
+        async with self.writer.connection() as connection:
+            await connection.execute(str(CreateTable(
+                Drink.__table__).compile(dialect=sqlite_dialect())))
+            await connection.executemany(INSERT_DRINK, [
+                drink_params(**drink) for drink in SEED_DRINKS])
+            await connection.commit()
+
+    async def migrate(self):
+        '''
+        Brings a database created by an older version up to date, see
+        models.db_migrate
+        '''
+        async with self.writer.connection() as connection:
+            for table, ddl, backfill in (
+                    (SEARCH_TABLE, SEARCH_INDEX_DDL, SEARCH_INDEX_BACKFILL),
+                    (CHANGE_TABLE, CHANGE_LOG_DDL, CHANGE_LOG_BACKFILL)):
+                cursor = await connection.execute(
+                    "SELECT 1 FROM sqlite_master WHERE type = 'table' AND "
+                    "name = ?", (table,))
+                exists = await cursor.fetchone() is not None
+                for statement in ddl:
+                    await connection.execute(statement)
+                if not exists:
+                    for statement in backfill:
+                        await connection.execute(statement)
+
+            columns = {row[1] for row in await connection.execute_fetchall(
+                'PRAGMA table_info(drink)')}
+            for column in FRAGMENT_COLUMNS:
+                if column not in columns:
+                    await connection.execute(
+                        f'ALTER TABLE drink ADD COLUMN {column} TEXT')
+            await connection.executemany(BACKFILL_UPDATE, [
+                drink_params(title, recipe, id=id) for id, title, recipe in
+                await connection.execute_fetchall(BACKFILL_SELECT)])
+            await connection.commit()
+
+    async def changes(self, since):
+        '''
+        Returns:
+            - (version, upserts, deleted_ids) tuple of the change log after
+            version <since>, see Drink.changes
+        '''
+        params = {'since': since}
+        async with self.reader.connection() as connection:
+            (version,), = await connection.execute_fetchall(VERSION_QUERY)
+            upserts = [DrinkRow(*row) for row in
+                       await connection.execute_fetchall(
+                           UPSERTS_QUERY, params)]
+            deleted = [row[0] for row in await connection.execute_fetchall(
+                TOMBSTONES_QUERY, params)]
+        return version, upserts, deleted
+
+    async def search(self, query, limit, offset=0):
+        async with self.reader.connection() as connection:
+            cursor = await connection.execute(SEARCH_QUERY, {
+                'query': query, 'limit': limit, 'offset': offset})
+            return [DrinkRow(*row) for row in await cursor.fetchall()]
+
+    async def fetch_page(self, after_id, limit):
+        async with self.reader.connection() as connection:
+            cursor = await connection.execute(
+                'SELECT id, title, recipe, short_fragment, long_fragment '
+                'FROM drink WHERE id > ? ORDER BY id LIMIT ?',
+                (after_id, limit))
+            return [DrinkRow(*row) for row in await cursor.fetchall()]
+
+# --------------------------------------------------------------------------- #
+# Authentication
+# --------------------------------------------------------------------------- #
+
+
+def verify_token(token):
+    '''
+    Verifies <token> the same way as requires_auth, runs in a worker thread
+    since an unknown kid may fetch the JWKS from Auth0
+
+    Returns:
+        - the verified claims
+    '''
+    key = auth.verify_jwt(token)
+    return claims_cache.set(token, auth.decode_token(token, key))
+
+
+async def authorize(request, permission):
+    '''
+    Arguments:
+        - request: the Request
+        - permission: string permission (i.e. 'post:drink')
+
+    - Same semantics as requires_auth, already verified tokens are served
+    from the claims_cache without leaving the event loop
+
+    Returns:
+        - the verified claims
+    '''
+    token = get_token_auth_header(request.headers)
+    claims = claims_cache.get(token)
+    if claims is None:
+        claims = await asyncio.to_thread(verify_token, token)
+    check_permissions(permission, claims)
+    return claims
+
+
+# The request schemas, compiled once
+create_drinks_validator = compile_schema(create_drinks_schema)
+update_drinks_validator = compile_schema(update_drinks_schema)
+batch_drinks_validator = compile_schema(batch_drinks_schema)
+
+
+def validate_json(request, validator, fast_check=None):
+    '''
+    Same semantics as expects_json, see validation.validation_error
+
+    Returns:
+        - the decoded and validated json body
+    '''
+    data = request.get_json()
+    error = validation_error(data, validator, fast_check)
+    if error is not None:
+        raise error
+    return data
+
+# --------------------------------------------------------------------------- #
+# Routes
+# --------------------------------------------------------------------------- #
+
+
+def get_page_args(request, unpaged=False):
+    '''
+    Returns:
+        - (limit, after_id) tuple of the "limit" and "cursor" query
+        parameters, see api.get_page_args
+    '''
+    try:
+        return parse_page_args(
+            request.args.get('limit'), request.args.get('cursor'), unpaged)
+    except ValueError:
+        raise HTTPError(400)
+
+
+async def get_drinks_page(app, request):
+    '''
+    Returns:
+        - (drinks, next_cursor) tuple of the page, see api.get_drinks_page
+    '''
+    limit, after_id = get_page_args(request, unpaged=True)
+
+    # One extra row tells whether there is a next page, a negative SQLite
+    # limit returns every row
+    drinks = await app.db.fetch_page(
+        after_id, -1 if limit is None else limit + 1)
+
+    # 404 if there are no drinks entries
+    if not drinks:
+        raise HTTPError(404)
+
+    next_cursor = None
+    if limit is not None and len(drinks) > limit:
+        drinks = drinks[:limit]
+        next_cursor = encode_cursor(drinks[-1].id)
+    return drinks, next_cursor
+
+
+async def get_search_page(app, request):
+    '''
+    Returns:
+        - (drinks, next_cursor) tuple of the search results page, see
+        api.get_search_page
+    '''
+    limit, offset = get_page_args(request)
+    try:
+        query = build_match_query(request.args.get('q'))
+    except ValueError:
+        raise HTTPError(400)
+
+    # One extra row tells whether there is a next page
+    drinks = await app.db.search(query, limit + 1, offset)
+
+    # 404 if there are no matching drinks
+    if not drinks:
+        raise HTTPError(404)
+
+    next_cursor = None
+    if len(drinks) > limit:
+        drinks = drinks[:limit]
+        next_cursor = encode_cursor(offset + limit)
+    return drinks, next_cursor
+
+
+async def menu_response(app, request, serializer, get_page=get_drinks_page):
+    '''
+    Returns:
+        - the page of drinks serialized with <serializer> and a strong
+        ETag, or 304 if the client already has it
+    '''
+    drinks, next_cursor = await get_page(app, request)
+
+    response = Response(encode_page(serializer, drinks, next_cursor))
+    etag = hashlib.sha1(response.body).hexdigest()
+    if parse_etags(request.headers.get('If-None-Match')).contains_weak(etag):
+        response = Response(status=304)
+    response.headers['ETag'] = f'"{etag}"'
+    return response
+
+
+async def get_drinks(app, request):
+    return await menu_response(app, request, Drink.short_json)
+
+
+async def search_drinks(app, request):
+    return await menu_response(app, request, Drink.short_json, get_search_page)
+
+
+async def get_drinks_detail(app, request):
+    await authorize(request, 'get:drinks-detail')
+    return await menu_response(app, request, Drink.long_json)
+
+
+async def get_drinks_changes(app, request):
+    await authorize(request, 'get:drinks-detail')
+    try:
+        since = int(request.args.get('since'))
+    except (TypeError, ValueError):
+        raise HTTPError(400)
+    if since < 0:
+        raise HTTPError(400)
+
+    version, upserts, deleted = await app.db.changes(since)
+    resync = needs_resync(since, version)
+    if resync:
+        upserts, deleted = [], []
+    return Response(encode_changes(Drink.long_json, version, upserts,
+                                   deleted, resync))
+
+
+async def create_drinks(app, request):
+    await authorize(request, 'post:drinks')
+    data = validate_json(request, create_drinks_validator,
+                         is_valid_create)
+
+    async with app.db.writer.connection() as connection:
+        try:
+            cursor = await connection.execute(CREATE_DRINK, drink_params(
+                data.get('title'), json.dumps(data.get('recipe'))))
+            await connection.commit()
+            if cursor.rowcount:
+                app.menu_changed()
+        except sqlite3.Error as error:
+            print(error)
+            raise HTTPError(422)
+
+    # 409 posted drink already exists
+    if cursor.rowcount == 0:
+        raise HTTPError(409)
+
+    return json_response({
+        'drinks': [{
+            'id': cursor.lastrowid,
+            'title': data.get('title'),
+            'recipe': data.get('recipe')
+        }]
+    })
+
+
+async def update_drinks(app, request, id):
+    await authorize(request, 'patch:drinks')
+    data = validate_json(request, update_drinks_validator,
+                         is_valid_update)
+
+    async with app.db.writer.connection() as connection:
+        cursor = await connection.execute(
+            'SELECT id, title, recipe FROM drink WHERE id = ?', (id,))
+        row = await cursor.fetchone()
+
+        # 404 if no entry found
+        if row is None:
+            raise HTTPError(404)
+
+        drink = DrinkRow(*row)
+        if 'title' in data:
+            drink = drink._replace(title=data.get('title'))
+        if 'recipe' in data:
+            drink = drink._replace(recipe=json.dumps(data.get('recipe')))
+
+        try:
+            await connection.execute(UPDATE_DRINK, drink_params(
+                drink.title, drink.recipe, id=id))
+            await connection.commit()
+            app.menu_changed()
+        except sqlite3.Error as error:
+            print(error)
+            raise HTTPError(422)
+
+    return json_response({'drinks': [Drink.long(drink)]})
+
+
+async def delete_drinks(app, request, id):
+    await authorize(request, 'delete:drinks')
+
+    async with app.db.writer.connection() as connection:
+        cursor = await connection.execute(
+            'DELETE FROM drink WHERE id = ?', (id,))
+
+        # 404 if no entry found
+        if cursor.rowcount == 0:
+            raise HTTPError(404)
+
+        try:
+            await connection.commit()
+            app.menu_changed()
+        except sqlite3.Error as error:
+            print(error)
+            raise HTTPError(422)
+
+    return json_response({'delete': id})
+
+
+async def batch_drinks(app, request):
+    claims = await authorize(request, 'post:drinks')
+    operations = validate_json(request, batch_drinks_validator)['operations']
+
+    for op in {operation['op'] for operation in operations}:
+        check_permissions(batch_permissions[op], claims)
+
+    results = [{'op': operation['op']} for operation in operations]
+    if not validate_batch(operations, results):
+        mark_not_applied(results)
+        return json_response({
+            'error': 400, 'message': 'batch rejected', 'results': results
+        }, 400)
+
+    async with app.db.writer.connection() as connection:
+        ids = batch_ids(operations)
+        rows = await connection.execute_fetchall(
+            'SELECT id, title, recipe FROM drink WHERE id IN '
+            f'({",".join("?" * len(ids))})', ids) if ids else []
+        drinks = {row[0]: DrinkRow(*row) for row in rows}
+
+        titles = batch_titles(operations)
+        existing = dict(await connection.execute_fetchall(
+            'SELECT title, id FROM drink WHERE title IN '
+            f'({",".join("?" * len(titles))})', titles)) if titles else {}
+
+        if not check_batch_conflicts(operations, results, drinks, existing):
+            statuses = [result['status'] for result in results
+                        if 'status' in result]
+            status = 404 if 404 in statuses else 409
+            mark_not_applied(results)
+            return json_response({
+                'error': status, 'message': 'batch rejected',
+                'results': results
+            }, status)
+
+        try:
+            for operation, result in zip(operations, results):
+                data = operation.get('data')
+                if operation['op'] == 'create':
+                    cursor = await connection.execute(
+                        INSERT_DRINK, drink_params(
+                            data.get('title'),
+                            json.dumps(data.get('recipe'))))
+                    result['drink'] = {
+                        'id': cursor.lastrowid,
+                        'title': data.get('title'),
+                        'recipe': data.get('recipe')
+                    }
+                elif operation['op'] == 'update':
+                    drink = drinks[operation['id']]
+                    if 'title' in data:
+                        drink = drink._replace(title=data.get('title'))
+                    if 'recipe' in data:
+                        drink = drink._replace(
+                            recipe=json.dumps(data.get('recipe')))
+                    await connection.execute(
+                        UPDATE_DRINK, drink_params(
+                            drink.title, drink.recipe, id=drink.id))
+                    result['drink'] = Drink.long(drink)
+                else:
+                    await connection.execute(
+                        'DELETE FROM drink WHERE id = ?', (operation['id'],))
+                    result['delete'] = operation['id']
+                result['status'] = 200
+            await connection.commit()
+            app.menu_changed()
+        except sqlite3.IntegrityError as error:
+            print(error)
+            raise HTTPError(409)
+        except sqlite3.Error as error:
+            print(error)
+            raise HTTPError(422)
+
+    return json_response({'results': results})
+
+
+ROUTES = [
+    ('/drinks', {'GET': get_drinks, 'POST': create_drinks}),
+    ('/drinks-detail', {'GET': get_drinks_detail}),
+    ('/drinks/search', {'GET': search_drinks}),
+    ('/drinks/changes', {'GET': get_drinks_changes}),
+    ('/drinks/batch', {'POST': batch_drinks}),
+    (r'/drinks/(?P<id>\d+)', {'PATCH': update_drinks,
+                              'DELETE': delete_drinks}),
+]
+
+# --------------------------------------------------------------------------- #
+# Application
+# --------------------------------------------------------------------------- #
+
+
+class AsgiApp:
+    """
+    The ASGI application, dispatches the http scopes to the ROUTES and
+    turns errors into the same json responses as the Flask error handlers
+    """
+
+    def __init__(self, database=None, profile=None, shared_dir=None,
+                 max_content_length=MAX_CONTENT_LENGTH):
+        self.max_content_length = max_content_length
+        self.db = AsyncDatabase(
+            database or os.path.join(project_dir, database_filename),
+            profile or get_engine_profile())
+        self.routes = [(re.compile(f'{path}$'), methods)
+                       for path, methods in ROUTES]
+        # The menu version of the Flask workers serving the same database,
+        # see api.setup_shared_cache
+        self.menu_version = None
+        directory = shared_cache_dir(
+            os.environ.get('SHARED_CACHE_DIR') if shared_dir is None
+            else shared_dir, self.db.path)
+        if directory is not None and open_shared_dir(directory) is not None:
+            self.menu_version = SharedVersion(
+                os.path.join(directory, 'version'))
+
+    def menu_changed(self):
+        '''
+        Bumps the shared menu version after a committed write, the Flask
+        workers stop serving their cached menu and replica at once
+        '''
+        if self.menu_version is not None:
+            self.menu_version.bump()
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+
+        body = await self.read_body(scope, receive)
+        response = await self.handle(Request(scope, body))
+        await send({
+            'type': 'http.response.start',
+            'status': response.status,
+            'headers': [(name.lower().encode('latin-1'), value.encode(
+                'latin-1')) for name, value in response.headers.items()]
+        })
+        await send({'type': 'http.response.body', 'body': response.body})
+
+    async def read_body(self, scope, receive):
+        '''
+        - Stops reading at the declared Content-Length or as soon as the body
+        read gets longer than max_content_length, like Flask's
+        MAX_CONTENT_LENGTH
+
+        Returns:
+            - the request body, None if it is too long
+        '''
+        limit = self.max_content_length
+        if limit is not None:
+            for name, value in scope.get('headers', ()):
+                if name.lower() == b'content-length' and \
+                        value.isdigit() and int(value) > limit:
+                    return None
+
+        chunks = []
+        size = 0
+        more_body = scope['type'] == 'http'
+        while more_body:
+            message = await receive()
+            chunk = message.get('body', b'')
+            size += len(chunk)
+            if limit is not None and size > limit:
+                return None
+            chunks.append(chunk)
+            more_body = message.get('more_body', False)
+        return b''.join(chunks)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await self.db.open()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.db.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def match(self, request):
+        '''
+        Returns:
+            - (handler, path arguments) tuple of the request
+        '''
+        for pattern, methods in self.routes:
+            matched = pattern.match(request.path)
+            if matched is None:
+                continue
+            method = 'GET' if request.method == 'HEAD' else request.method
+            if request.method == 'OPTIONS':
+                return None, {'methods': methods}
+            if method not in methods:
+                raise HTTPError(405)
+            kwargs = {name: int(value)
+                      for name, value in matched.groupdict().items()}
+            return methods[method], kwargs
+        raise HTTPError(404)
+
+    async def handle(self, request):
+        try:
+            if request.body is None:
+                raise HTTPError(413)
+            await self.db.open()
+            handler, kwargs = self.match(request)
+            if handler is None:
+                response = self.preflight(request, kwargs['methods'])
+            else:
+                response = await handler(self, request, **kwargs)
+        except HTTPError as error:
+            response = error_response(error.status_code, error.message)
+        except ValidationError as error:
+            response = error_response(400, error.message)
+        except AuthError as error:
+            response = error_response(
+                error.status_code, error.error.get('description'))
+        except Exception as error:
+            print(error)
+            response = error_response(500, ERROR_MESSAGES[500])
+
+        if request.method == 'HEAD':
+            response.body = b''
+        # Same CORS policy as CORS(app), every origin is allowed
+        response.headers['Access-Control-Allow-Origin'] = '*'
+        return response
+
+    def preflight(self, request, methods):
+        response = Response(content_type='text/html; charset=utf-8')
+        response.headers['Access-Control-Allow-Methods'] = ', '.join(
+            sorted(set(methods) | {'HEAD', 'OPTIONS'}))
+        requested = request.headers.get('Access-Control-Request-Headers')
+        if requested:
+            response.headers['Access-Control-Allow-Headers'] = requested
+        return response
+
+    def test_client(self):
+        '''
+        Returns:
+            - AsgiTestClient running requests against the app
+        '''
+        return AsgiTestClient(self)
+
+
+def create_asgi_app(database=None, profile=None, shared_dir=None):
+    '''
+    Arguments:
+        - database: path of the SQLite database, the one of the Flask app
+        by default
+        - profile: engine profile, see models.get_engine_profile
+        - shared_dir: directory of the menu version shared with the Flask
+        workers, see shared_cache_dir
+
+    - ASGI application factory (uvicorn --factory), the database is opened
+    by the lifespan startup or the first request
+
+    Returns:
+        - the AsgiApp
+    '''
+    return AsgiApp(database, profile, shared_dir)
+
+# --------------------------------------------------------------------------- #
+# Test client
+# --------------------------------------------------------------------------- #
+
+
+class AsgiTestResponse:
+    """Response with the interface of the Flask test client responses"""
+
+    def __init__(self, status_code, headers, data):
+        self.status_code = status_code
+        self.headers = headers
+        self.data = data
+
+    def get_data(self):
+        return self.data
+
+    def get_json(self):
+        return json.loads(self.data) if self.data else None
+
+
+class AsgiTestClient:
+    """
+    Runs requests against an AsgiApp on its own event loop, with the
+    interface of the Flask test client (get, post, patch, delete)
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.loop = asyncio.new_event_loop()
+
+    def open(self, path, method='GET', headers=None, **kwargs):
+        path, _, query_string = path.partition('?')
+        headers = Headers(headers or {})
+        body = b''
+        if kwargs.get('json') is not None:
+            body = json.dumps(kwargs['json']).encode()
+            headers.setdefault('Content-Type', 'application/json')
+        scope = {
+            'type': 'http',
+            'method': method,
+            'path': path,
+            'query_string': query_string.encode(),
+            'headers': [(name.lower().encode(), value.encode())
+                        for name, value in headers.items()]
+        }
+        messages = [{'type': 'http.request', 'body': body}]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        self.loop.run_until_complete(self.app(scope, receive, send))
+        return AsgiTestResponse(
+            sent[0]['status'],
+            Headers([(name.decode(), value.decode())
+                     for name, value in sent[0]['headers']]),
+            sent[1]['body'])
+
+    def get(self, path, **kwargs):
+        return self.open(path, 'GET', **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.open(path, 'POST', **kwargs)
+
+    def patch(self, path, **kwargs):
+        return self.open(path, 'PATCH', **kwargs)
+
+    def delete(self, path, **kwargs):
+        return self.open(path, 'DELETE', **kwargs)
+
+    def close(self):
+        self.loop.run_until_complete(self.app.db.close())
+        self.loop.close()
@@ -1,40 +1,77 @@
-from datetime import datetime, timedelta
-from functools import wraps, lru_cache
-from flask import request
+from functools import wraps
+from flask import current_app, has_app_context, request, g
 from jose import jwt
+from .jwks import JWKSKeyManager, create_session, fetch_jwks
+from ..cache.cache import TTLCache, timed_cache
+from ..metrics.metrics import phase
+from ..limits import check_rate_limit
 
-import functools
-import requests
+import hashlib
+import time
+import os
 
 
 AUTH0_DOMAIN = 'https://dev-start-location.eu.auth0.com/'
 AUTH0_WELL_KNOWN = f'{AUTH0_DOMAIN}.well-known/jwks.json'
 ALGORITHMS = ['RS256']
 API_AUDIENCE = 'coffeeshop'
+# Optional local JWKS document, used instead of Auth0 (offline and tests)
+AUTH0_JWKS_FILE = os.environ.get('AUTH0_JWKS_FILE')
 
 # --------------------------------------------------------------------------- #
 # Helpers
 # --------------------------------------------------------------------------- #
 
 
-def timed_cache(**timedelta_kwargs):
-    """Timed cache decorator, uses timedelta class for expiration"""
-    def _wrapper(f):
-        update_delta = timedelta(**timedelta_kwargs)
-        next_update = datetime.utcnow() + update_delta
-        f = lru_cache(None)(f)
+class ClaimsCache(TTLCache):
+    """
+    Thread-safe, size bounded LRU cache of verified token claims
+
+    - Keys are the SHA-256 digests of the raw tokens
+    - Every entry expires at the "exp" claim of its own token
+    - Permissions are stored as a frozenset for O(1) membership checks
+    """
 
-        @functools.wraps(f)
-        def _wrapped(*args, **kwargs):
-            nonlocal next_update
-            now = datetime.utcnow()
-            if now >= next_update:
-                f.cache_clear()
-                next_update = now + update_delta
-            return f(*args, **kwargs)
-        return _wrapped
-    return _wrapper
+    def __init__(self, maxsize=1024):
+        super().__init__(maxsize=maxsize)
 
+    @staticmethod
+    def _digest(token):
+        return hashlib.sha256(token.encode()).digest()
+
+    def get(self, token):
+        '''
+        Arguments:
+            - token: a json web token (string)
+
+        Returns:
+            - the cached claims of <token> or None if they are unknown or
+            the token has expired
+        '''
+        return super().get(self._digest(token))
+
+    def set(self, token, payload):
+        '''
+        Arguments:
+            - token: a json web token (string)
+            - payload: the verified payload of <token>
+
+        - Tokens without a numeric "exp" claim are not cached
+
+        Returns:
+            - the claims as stored in the cache
+        '''
+        claims = dict(payload)
+        claims['permissions'] = frozenset(payload.get('permissions') or ())
+        expires = payload.get('exp')
+        if isinstance(expires, (int, float)):
+            ttl = expires - time.time()
+            if ttl > 0:
+                super().set(self._digest(token), claims, ttl)
+        return claims
+
+
+claims_cache = ClaimsCache()
 
 # --------------------------------------------------------------------------- #
 # Custom error classes
@@ -154,10 +191,64 @@ def check_permissions(permission, payload):
     return True
 
 
-@timed_cache(days=1)
+jwks_session = create_session()
+
+key_manager = JWKSKeyManager(
+    url=AUTH0_WELL_KNOWN,
+    path=AUTH0_JWKS_FILE,
+    algorithm=ALGORITHMS[0],
+    session=jwks_session
+)
+
+
+def setup_auth(app):
+    '''
+    Arguments:
+        - app: flask application
+
+    - <app> gets its own key manager (app.extensions['key_manager']) and
+    claims cache, the ones of the module serve the ASGI app
+    - Reads the keys from the local JWKS document of the AUTH0_JWKS_FILE
+    setting of <app> if it is set, instead of the environment variable
+    - Nothing is fetched here, the key manager loads the keys and starts
+    its refresh thread on the first verification
+    '''
+    app.extensions['key_manager'] = JWKSKeyManager(
+        url=AUTH0_WELL_KNOWN,
+        path=app.config.get('AUTH0_JWKS_FILE') or AUTH0_JWKS_FILE,
+        algorithm=ALGORITHMS[0],
+        session=jwks_session
+    )
+    app.extensions['claims_cache'] = ClaimsCache()
+
+
+def current_key_manager():
+    '''
+    Returns:
+        - the JWKSKeyManager of the current flask application, or the
+        key_manager of the module outside of one
+    '''
+    if has_app_context():
+        return current_app.extensions.get('key_manager', key_manager)
+    return key_manager
+
+
+def current_claims_cache():
+    '''
+    Returns:
+        - the ClaimsCache of the current flask application, or the
+        claims_cache of the module outside of one
+    '''
+    if has_app_context():
+        return current_app.extensions.get('claims_cache', claims_cache)
+    return claims_cache
+
+
+@timed_cache(maxsize=8, hours=1)
 def get_jwks(url):
     '''
-    Retrieves the jason web keys from Auth0
+    Retrieves the jason web keys from Auth0 through the pooled session,
+    concurrent calls for the same url share a single request
 
     Argumens:
         - url: Auth0 /.well-known/jwks.json address
@@ -165,7 +256,7 @@ def get_jwks(url):
     Returns:
         - dictionary with jw keys
     '''
-    return requests.get(url).json()
+    return fetch_jwks(url, jwks_session)
 
 
 def verify_jwt(token):
@@ -174,13 +265,13 @@ def verify_jwt(token):
         - token: a json web token (string)
 
     - It should be an Auth0 token with key id (kid)
-    - Verifies the token using Auth0 /.well-known/jwks.json
+    - Looks up the key of the kid in the key manager of the application
+    (see current_key_manager), which keeps the Auth0
+    /.well-known/jwks.json keys pre-constructed
 
     Returns:
         - rsa_key: key for decoding jwt
     '''
-    rsa_key = {}
-    jw_keys = get_jwks(AUTH0_WELL_KNOWN)
     unverified_header = jwt.get_unverified_header(token)
     if not unverified_header.get('kid'):
         raise AuthError({
@@ -188,17 +279,9 @@ def verify_jwt(token):
             'description': 'Authorization malformed.'
         }, 401)
 
-    for key in jw_keys.get('keys'):
-        if key.get('kid') == unverified_header.get('kid'):
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
-
-    if not rsa_key:
+    rsa_key = current_key_manager().get_key(unverified_header.get('kid'))
+
+    if rsa_key is None:
         raise AuthError({
             'code': 'invalid_header',
             'description': 'Unable to find the appropriate key.'
@@ -217,9 +300,17 @@ def requires_auth(permission=''):
         - permission: string permission (i.e. 'post:drink')
 
     - Uses the get_token_auth_header method to get the token
-    - Uses the verify_decode_jwt method to decode the jwt
+    - Serves the claims of already verified tokens from the claims cache
+    of the application, see current_claims_cache
+    - Otherwise uses the verify_jwt and decode_token methods to decode the
+        jwt and caches the result
     - Uses the check_permissions method validate claims and check the
         requested permission
+    - Keeps the verified claims in flask.g.claims for the request
+    - Rate limits the "sub" of the token by the limit of the permission,
+    see limits.check_rate_limit
+    - Times the checks as the 'auth' request phase, a cache miss also as the
+    'auth_verify' and 'auth_decode' phases
 
     Returns:
         - the decorator which passes the decoded payload to the decorated method
@@ -227,10 +318,21 @@ def requires_auth(permission=''):
     def requires_auth_decorator(func):
         @wraps(func)
         def wrapper(*args, **kwargs):
-            token = get_token_auth_header(request.headers)
-            key = verify_jwt(token)
-            payload = decode_token(token, key)
-            check_permissions(permission, payload)
+            with phase('auth'):
+                token = get_token_auth_header(request.headers)
+                cache = current_claims_cache()
+                payload = cache.get(token)
+                if payload is None:
+                    with phase('auth_verify'):
+                        key = verify_jwt(token)
+                    with phase('auth_decode'):
+                        payload = decode_token(token, key)
+                    payload = cache.set(token, payload)
+                check_permissions(permission, payload)
+                g.claims = payload
+            check_rate_limit(permission, payload.get('sub'))
             return func(*args, **kwargs)
+        # Routes without it are rate limited by client IP
+        wrapper.required_permission = permission
         return wrapper
     return requires_auth_decorator
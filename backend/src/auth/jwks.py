@@ -0,0 +1,243 @@
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from jose import jwk
+
+import threading
+import requests
+import json
+import time
+
+
+# (connect, read) timeouts of the JWKS requests in seconds
+JWKS_TIMEOUT = (3.05, 5)
+
+# --------------------------------------------------------------------------- #
+# Helpers
+# --------------------------------------------------------------------------- #
+
+
+def create_session():
+    '''
+    Returns:
+        - pooled requests session with a small retry budget for the
+        idempotent JWKS requests
+    '''
+    session = requests.Session()
+    retries = Retry(total=2, backoff_factor=0.2,
+                    status_forcelist=(500, 502, 503, 504))
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=4,
+                          max_retries=retries)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def fetch_jwks(url, session, timeout=JWKS_TIMEOUT):
+    '''
+    Arguments:
+        - url: /.well-known/jwks.json address
+        - session: requests session used for the request
+        - timeout: (connect, read) timeouts in seconds
+
+    Returns:
+        - dictionary with jw keys
+    '''
+    response = session.get(url, timeout=timeout)
+    response.raise_for_status()
+    return response.json()
+
+
+def build_keys(jwks, algorithm):
+    '''
+    Arguments:
+        - jwks: json web key set (dictionary)
+        - algorithm: the algorithm the keys are used with (i.e. 'RS256')
+
+    - Keys which cannot be constructed (missing kid, unsupported type or
+    malformed values) are skipped
+    - Raises a ValueError if no key can be constructed (an empty or
+    malformed document), the caller keeps its last good keys
+
+    Returns:
+        - dictionary of kid -> pre-constructed jose key objects
+    '''
+    if not isinstance(jwks, dict) or not isinstance(jwks.get('keys'), list):
+        raise ValueError('Malformed JWKS document')
+
+    keys = {}
+    for key in jwks['keys']:
+        if not isinstance(key, dict):
+            continue
+        if not key.get('kid') or key.get('kty') != 'RSA':
+            continue
+        try:
+            keys[key['kid']] = jwk.construct({
+                'kty': key['kty'],
+                'kid': key['kid'],
+                'use': key.get('use', 'sig'),
+                'n': key['n'],
+                'e': key['e']
+            }, algorithm=algorithm)
+        except Exception as error:
+            print(error)
+
+    if not keys:
+        raise ValueError('JWKS document without usable keys')
+    return keys
+
+# --------------------------------------------------------------------------- #
+# Key manager
+# --------------------------------------------------------------------------- #
+
+
+class JWKSKeyManager:
+    """
+    Keeps the json web keys of the identity provider ready for verification
+
+    - Keys are indexed by kid and constructed once per JWKS document
+    - A background thread refreshes the keys every <refresh_interval>
+    seconds, out of the request path
+    - An unknown kid triggers a single synchronous refresh, at most once per
+    <min_fetch_interval> seconds
+    - If a refresh fails, or returns a document without usable keys, the
+    last good keys are kept and the next unknown kid waits for
+    <min_fetch_interval> seconds as well
+    - With <path> set the JWKS document is read from a local file instead of
+    the network
+    - With a <store> (see cache.shared.SharedStore) the fetched document is
+    shared with the other worker processes of the host, a document stored
+    by another process is used if it is newer than the loaded one and not
+    older than <refresh_interval>
+    """
+
+    def __init__(self, url=None, path=None, algorithm='RS256',
+                 refresh_interval=3600, min_fetch_interval=30,
+                 timeout=JWKS_TIMEOUT, session=None, store=None):
+        self.url = url
+        self.path = path
+        self.algorithm = algorithm
+        self.refresh_interval = refresh_interval
+        self.min_fetch_interval = min_fetch_interval
+        self.timeout = timeout
+        self.session = session
+        self.store = store
+        self.jwks = None
+        self.jwks_time = 0
+        self.keys = {}
+        self.last_fetch = None
+        self.fetches = 0
+        self.fetch_errors = 0
+        self._fetch_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def fetch(self):
+        '''
+        Returns:
+            - the JWKS document from the local file, the shared store or the
+            remote url
+        '''
+        if self.path:
+            with open(self.path) as jwks_file:
+                return json.load(jwks_file)
+
+        key = f'jwks {self.url}'
+        if self.store is not None:
+            stored = self.store.get_document(key)
+            if stored is not None:
+                jwks, stored_at = stored
+                if self.jwks_time < stored_at and \
+                        time.time() - stored_at < self.refresh_interval:
+                    self.jwks_time = stored_at
+                    return jwks
+
+        if self.session is None:
+            self.session = create_session()
+        jwks = fetch_jwks(self.url, self.session, self.timeout)
+        # A document without usable keys is a failed fetch, it is not
+        # shared with the other workers
+        build_keys(jwks, self.algorithm)
+        self.jwks_time = time.time()
+        if self.store is not None:
+            self.store.set_document(key, jwks, self.jwks_time)
+        return jwks
+
+    def refresh(self):
+        '''
+        Fetches the JWKS document and replaces the key index
+
+        Returns:
+            - True on success, False if the last good keys were kept
+        '''
+        with self._fetch_lock:
+            return self._refresh()
+
+    def _refresh(self):
+        # Callers must hold the _fetch_lock
+        self.last_fetch = time.monotonic()
+        self.fetches += 1
+        try:
+            jwks = self.fetch()
+            keys = build_keys(jwks, self.algorithm)
+        except Exception as error:
+            print(error)
+            self.fetch_errors += 1
+            return False
+
+        # Swap whole objects, readers never see a partial index
+        self.jwks = jwks
+        self.keys = keys
+        return True
+
+    def get_key(self, kid):
+        '''
+        Arguments:
+            - kid: key id from the unverified token header
+
+        Returns:
+            - the constructed key for <kid> or None if it is unknown
+        '''
+        self.start()
+        key = self.keys.get(kid)
+        if key is not None:
+            return key
+
+        # Unknown kid, the keys may have been rotated since the last fetch
+        last_fetch = self.last_fetch
+        with self._fetch_lock:
+            # Another request refreshed the keys while this one waited
+            if self.last_fetch != last_fetch:
+                return self.keys.get(kid)
+            if time.monotonic() - last_fetch < self.min_fetch_interval:
+                return None
+            self._refresh()
+            return self.keys.get(kid)
+
+    def start(self):
+        '''
+        Loads the keys and starts the background refresh thread on first use
+        '''
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is not None:
+                return
+            self.refresh()
+            self._stopped.clear()
+            self._thread = threading.Thread(
+                target=self._run, name='jwks-refresh', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        '''
+        Stops the background refresh thread
+        '''
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stopped.wait(self.refresh_interval):
+            self.refresh()
@@ -0,0 +1,69 @@
+from jose.utils import long_to_base64
+from jose import jwt
+from .auth import ALGORITHMS, API_AUDIENCE, AUTH0_DOMAIN
+
+import json
+import time
+import rsa
+
+
+class LocalSigner:
+    """
+    Locally generated RS256 key pair, which signs tokens the same way as
+    Auth0 does. Together with the AUTH0_JWKS_FILE setting it lets the app
+    verify tokens without network access (tests, benchmarks, load tests).
+    """
+
+    def __init__(self, kid='local-key', bits=2048):
+        self.kid = kid
+        self.public_key, self.private_key = rsa.newkeys(bits)
+        self._private_pem = self.private_key.save_pkcs1().decode()
+
+    def jwks(self):
+        '''
+        Returns:
+            - json web key set (dictionary) with the public key
+        '''
+        return {
+            'keys': [{
+                'kty': 'RSA',
+                'kid': self.kid,
+                'use': 'sig',
+                'alg': ALGORITHMS[0],
+                'n': long_to_base64(self.public_key.n).decode(),
+                'e': long_to_base64(self.public_key.e).decode()
+            }]
+        }
+
+    def write_jwks(self, path):
+        '''
+        Arguments:
+            - path: file to write the json web key set to
+        '''
+        with open(path, 'w') as jwks_file:
+            json.dump(self.jwks(), jwks_file)
+
+    def token(self, permissions=(), sub='local|user', expires_in=3600,
+              **claims):
+        '''
+        Arguments:
+            - permissions: permission strings (i.e. 'post:drinks')
+            - sub: subject of the token
+            - expires_in: lifetime of the token in seconds
+            - claims: additional or overridden claims
+
+        Returns:
+            - signed json web token (string)
+        '''
+        now = int(time.time())
+        payload = {
+            'iss': AUTH0_DOMAIN,
+            'sub': sub,
+            'aud': API_AUDIENCE,
+            'iat': now,
+            'exp': now + expires_in,
+            'permissions': list(permissions)
+        }
+        payload.update(claims)
+        return jwt.encode(payload, self._private_pem,
+                          algorithm=ALGORITHMS[0], headers={'kid': self.kid})
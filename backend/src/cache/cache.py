@@ -0,0 +1,379 @@
+from collections import OrderedDict, namedtuple
+from datetime import timedelta
+
+import functools
+import threading
+import hashlib
+import time
+
+
+# Serialized response body with its strong entity tag, <variants> keeps
+# the encoded (i.e. compressed) variants of the body built for the entry
+CachedResponse = namedtuple('CachedResponse', ['body', 'etag', 'variants'])
+
+
+def make_etag(body):
+    '''
+    Arguments:
+        - body: serialized response body (bytes)
+
+    Returns:
+        - strong entity tag derived from the content of <body>
+    '''
+    return hashlib.sha1(body).hexdigest()
+
+
+def make_entry(body):
+    '''
+    Arguments:
+        - body: serialized response body (bytes)
+
+    Returns:
+        - CachedResponse of <body> without variants
+    '''
+    return CachedResponse(body, make_etag(body), {})
+
+# --------------------------------------------------------------------------- #
+# Response cache
+# --------------------------------------------------------------------------- #
+
+
+class ResponseCache:
+    """
+    Thread-safe in-memory cache of serialized responses
+
+    Every entry belongs to one version of the underlying data, as soon as a
+    newer version is seen all the older entries are dropped. The number of
+    entries is bounded, the least recently used one is evicted first.
+
+    With a <store> (see shared.SharedStore) the local misses are looked up
+    in the store of the host and the built responses are written to it, so
+    a response is built once per version for all the worker processes.
+    """
+
+    def __init__(self, maxsize=256, store=None):
+        self.maxsize = maxsize
+        self.store = store
+        self.hits = 0
+        self.misses = 0
+        self.shared_hits = 0
+        self._version = None
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _sync_version(self, version):
+        # Entries of an older version are never valid again
+        if self._version is None or version > self._version:
+            self._entries.clear()
+            self._version = version
+        return version == self._version
+
+    def get(self, key, version):
+        '''
+        Arguments:
+            - key: hashable cache key
+            - version: current version of the cached data
+
+        Returns:
+            - the CachedResponse stored for <key> or None
+        '''
+        with self._lock:
+            entry = None
+            if self._sync_version(version):
+                entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            if self.store is None:
+                self.misses += 1
+                return None
+
+        # Out of the lock, the store is a file
+        body = self.store.get_response(repr(key), version)
+        if body is None:
+            with self._lock:
+                self.misses += 1
+            return None
+        entry = self._add(key, version, body)
+        with self._lock:
+            self.shared_hits += 1
+        return entry
+
+    def _add(self, key, version, body):
+        entry = make_entry(body)
+        with self._lock:
+            if not self._sync_version(version):
+                return entry
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return entry
+
+    def set(self, key, version, body):
+        '''
+        Arguments:
+            - key: hashable cache key
+            - version: version of the data <body> was built from
+            - body: serialized response body (bytes)
+
+        Returns:
+            - the CachedResponse, it is only stored if <version> is current
+        '''
+        entry = self._add(key, version, body)
+        if self.store is not None:
+            self.store.set_response(repr(key), version, body)
+        return entry
+
+    def clear(self):
+        '''
+        Drops all entries and resets the counters
+        '''
+        with self._lock:
+            self._entries.clear()
+            self._version = None
+            self.hits = 0
+            self.misses = 0
+            self.shared_hits = 0
+
+    def stats(self):
+        '''
+        Returns:
+            - dictionary with the hit, miss and size counters
+        '''
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'shared_hits': self.shared_hits,
+                'size': len(self._entries),
+                'version': self._version
+            }
+
+# --------------------------------------------------------------------------- #
+# TTL cache
+# --------------------------------------------------------------------------- #
+
+
+class _Flight:
+    """A load in progress, concurrent callers wait for its result"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class TTLCache:
+    """
+    Thread-safe LRU cache with per-entry expiry
+
+    - At most <maxsize> entries are kept, the least recently used one is
+    evicted first
+    - Every entry expires <ttl> seconds after it was stored, unless the
+    entry has its own ttl
+    - get_or_load runs a single load per key, concurrent misses on the same
+    key wait for its result
+    - With <stale_ttl> set, an expired entry is still served for that many
+    seconds while it is reloaded in a background thread
+    """
+
+    def __init__(self, maxsize=128, ttl=None, stale_ttl=0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self.evictions = 0
+        self.loads = 0
+        self.load_errors = 0
+        self._entries = OrderedDict()
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def _lookup(self, key, now):
+        # Returns (value, fresh) or None, callers must hold the _lock
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        value, expires = entry
+        if expires is None or now < expires:
+            self._entries.move_to_end(key)
+            return value, True
+        if now < expires + self.stale_ttl:
+            return value, False
+        del self._entries[key]
+        self.evictions += 1
+        return None
+
+    def get(self, key, default=None):
+        '''
+        Arguments:
+            - key: hashable cache key
+            - default: returned if there is no fresh entry for <key>
+
+        Returns:
+            - the cached value of <key> or <default>
+        '''
+        with self._lock:
+            found = self._lookup(key, time.monotonic())
+            if found is None or not found[1]:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return found[0]
+
+    def set(self, key, value, ttl=None):
+        '''
+        Arguments:
+            - key: hashable cache key
+            - value: the value to cache
+            - ttl: lifetime of the entry in seconds, defaults to the ttl of
+            the cache (None never expires)
+        '''
+        self._store(key, value, ttl)
+
+    def _store(self, key, value, ttl):
+        ttl = self.ttl if ttl is None else ttl
+        expires = None if ttl is None else time.monotonic() + ttl
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        '''
+        Arguments:
+            - key: hashable cache key, missing keys are ignored
+        '''
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def get_or_load(self, key, loader, ttl=None):
+        '''
+        Arguments:
+            - key: hashable cache key
+            - loader: function without arguments computing the value
+            - ttl: lifetime of the loaded entry in seconds
+
+        - Errors of the loader are raised to every waiting caller and are
+        not cached
+
+        Returns:
+            - the cached or freshly loaded value of <key>
+        '''
+        with self._lock:
+            found = self._lookup(key, time.monotonic())
+            if found is not None and found[1]:
+                self.hits += 1
+                return found[0]
+
+            flight = self._flights.get(key)
+            if found is not None:
+                # Stale entry, served while a single background reload runs
+                self.stale_hits += 1
+                if flight is None:
+                    flight = self._flights[key] = _Flight()
+                    threading.Thread(
+                        target=self._load, args=(key, loader, ttl, flight),
+                        daemon=True).start()
+                return found[0]
+
+            self.misses += 1
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+
+        if leader:
+            self._load(key, loader, ttl, flight)
+        else:
+            flight.done.wait()
+
+        if flight.error is not None:
+            raise flight.error
+        return flight.value
+
+    def _load(self, key, loader, ttl, flight):
+        try:
+            flight.value = loader()
+            self._store(key, flight.value, ttl)
+            self.loads += 1
+        except Exception as error:
+            flight.error = error
+            self.load_errors += 1
+        finally:
+            with self._lock:
+                self._flights.pop(key, None)
+            flight.done.set()
+
+    def clear(self):
+        '''
+        Drops all entries and resets the counters
+        '''
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+            self.stale_hits = 0
+            self.evictions = 0
+            self.loads = 0
+            self.load_errors = 0
+
+    def stats(self):
+        '''
+        Returns:
+            - dictionary with the hit, miss, eviction, load and size counters
+        '''
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'stale_hits': self.stale_hits,
+                'evictions': self.evictions,
+                'loads': self.loads,
+                'load_errors': self.load_errors,
+                'size': len(self._entries),
+                'maxsize': self.maxsize
+            }
+
+
+def timed_cache(maxsize=128, stale_while_revalidate=None,
+                **timedelta_kwargs):
+    '''
+    Timed cache decorator, uses timedelta class for the expiration of each
+    entry
+
+    Arguments:
+        - maxsize: maximum number of cached results
+        - stale_while_revalidate: timedelta an expired result is still
+        served for while it is reloaded in the background
+        - timedelta_kwargs: lifetime of the entries (i.e. days=1)
+
+    - Calls are keyed by their positional and keyword arguments, concurrent
+    calls with the same arguments run the function once
+    - The wrapped function exposes cache, cache_info() and cache_clear()
+
+    Returns:
+        - the decorator
+    '''
+    ttl = timedelta(**timedelta_kwargs).total_seconds()
+    stale_ttl = stale_while_revalidate.total_seconds() \
+        if stale_while_revalidate else 0
+
+    def _wrapper(f):
+        cache = TTLCache(maxsize=maxsize, ttl=ttl, stale_ttl=stale_ttl)
+
+        @functools.wraps(f)
+        def _wrapped(*args, **kwargs):
+            key = (args, frozenset(kwargs.items())) if kwargs else args
+            return cache.get_or_load(key, lambda: f(*args, **kwargs))
+
+        _wrapped.cache = cache
+        _wrapped.cache_info = cache.stats
+        _wrapped.cache_clear = cache.clear
+        return _wrapped
+    return _wrapper
@@ -0,0 +1,330 @@
+import threading
+import tempfile
+import hashlib
+import sqlite3
+import stat
+import hmac
+import struct
+import mmap
+import json
+import time
+import os
+
+try:
+    import fcntl
+except ImportError:  # Windows, the shared tier is not available
+    fcntl = None
+
+
+# Bytes of the key which signs the values of the store
+SECRET_SIZE = 32
+# HMAC-SHA256 of every value of the store
+SIGNATURE_SIZE = hashlib.sha256().digest_size
+
+# Unsigned 64 bit counter at the start of the version file
+VERSION_FORMAT = '<Q'
+VERSION_SIZE = struct.calcsize(VERSION_FORMAT)
+
+SHARED_STORE_DDL = [
+    "CREATE TABLE IF NOT EXISTS response ("
+    "key TEXT PRIMARY KEY, version INTEGER NOT NULL, body BLOB NOT NULL)",
+
+    "CREATE INDEX IF NOT EXISTS response_version ON response (version)",
+
+    "CREATE TABLE IF NOT EXISTS document ("
+    "key TEXT PRIMARY KEY, value TEXT NOT NULL, stored_at REAL NOT NULL)",
+]
+
+# --------------------------------------------------------------------------- #
+# Directory
+# --------------------------------------------------------------------------- #
+
+
+def shared_cache_dir(setting, database):
+    '''
+    Arguments:
+        - setting: the SHARED_CACHE_DIR setting, None for the default, an
+        empty string turns the shared tier off
+        - database: path of the SQLite database file, None if the database
+        is not a file
+
+    - By default every process serving the same database file (the Flask
+    workers and the ASGI app) uses the "<database>-shared" directory next
+    to the real path of the file, like the -wal and -shm files of SQLite
+    - A database which is not a file is private to its process, there is
+    nothing to share
+
+    Returns:
+        - the directory of the shared tier, or None
+    '''
+    if setting is not None:
+        return setting or None
+    if database is None or fcntl is None:
+        return None
+    return os.path.realpath(database) + '-shared'
+
+
+def is_private(status):
+    '''
+    Returns:
+        - True if the stat result <status> belongs to the user of the
+        process and gives no permission to the group and the others
+    '''
+    return status.st_uid == os.getuid() and not status.st_mode & 0o077
+
+
+def read_secret(path):
+    '''
+    Returns:
+        - the signing key in the file at <path>, which must be a private
+        regular file (not a symlink)
+    '''
+    fd = os.open(path, os.O_RDONLY | os.O_NOFOLLOW)
+    try:
+        status = os.fstat(fd)
+        if not stat.S_ISREG(status.st_mode) or not is_private(status):
+            raise PermissionError(f'{path} is not a private file')
+        secret = os.read(fd, SECRET_SIZE)
+    finally:
+        os.close(fd)
+    if len(secret) < SECRET_SIZE:
+        raise ValueError(f'{path} is too short')
+    return secret
+
+
+def open_shared_dir(directory):
+    '''
+    Arguments:
+        - directory: directory of the shared tier, see shared_cache_dir
+
+    - Creates the directory (mode 0700) if it does not exist
+    - Refuses a directory which is a symlink, belongs to another user or
+    is open to the group or the others: the workers trust what they read
+    from it (i.e. the JWKS document)
+    - The "secret" file of the directory holds the key signing the values
+    of the SharedStore, the first process creates it atomically
+
+    Returns:
+        - the signing key, or None if the directory cannot be used
+    '''
+    path = os.path.join(directory, 'secret')
+    try:
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        status = os.lstat(directory)
+        if not stat.S_ISDIR(status.st_mode) or not is_private(status):
+            raise PermissionError(f'{directory} is not a private directory')
+        if not os.path.lexists(path):
+            fd, temporary = tempfile.mkstemp(dir=directory)
+            try:
+                with os.fdopen(fd, 'wb') as secret_file:
+                    secret_file.write(os.urandom(SECRET_SIZE))
+                os.link(temporary, path)
+            except FileExistsError:
+                pass
+            finally:
+                os.unlink(temporary)
+        return read_secret(path)
+    except (OSError, ValueError) as error:
+        print(error)
+        return None
+
+# --------------------------------------------------------------------------- #
+# Version stamp
+# --------------------------------------------------------------------------- #
+
+
+class SharedVersion:
+    """
+    Version counter in a memory-mapped file, shared by every process of the
+    host which maps the same file
+
+    - Reading is a load from the mapped page, no system call
+    - Bumps are serialized by a lock on the file (across processes) and a
+    thread lock (within the process)
+    - The mapping is MAP_SHARED, processes forked after it was created keep
+    seeing the updates of each other
+    """
+
+    def __init__(self, path):
+        if fcntl is None:
+            raise RuntimeError('the shared version needs fcntl (POSIX)')
+        self.path = path
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(self._fd).st_size < VERSION_SIZE:
+            os.ftruncate(self._fd, VERSION_SIZE)
+        self._map = mmap.mmap(self._fd, VERSION_SIZE)
+        self._lock = threading.Lock()
+
+    @property
+    def value(self):
+        return struct.unpack_from(VERSION_FORMAT, self._map)[0]
+
+    def bump(self):
+        '''
+        Increments the version for every process
+
+        Returns:
+            - the new value
+        '''
+        with self._lock:
+            # POSIX record locks belong to the process, unlike flock locks
+            # they are not shared with the forked children
+            fcntl.lockf(self._fd, fcntl.LOCK_EX)
+            try:
+                value = self.value + 1
+                struct.pack_into(VERSION_FORMAT, self._map, 0, value)
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN)
+        return value
+
+# --------------------------------------------------------------------------- #
+# Store
+# --------------------------------------------------------------------------- #
+
+
+class SharedStore:
+    """
+    SQLite file with the serialized responses and documents (i.e. JWKS)
+    shared by every process of the host
+
+    - Connections are opened per process and thread on first use, none is
+    used across a fork
+    - It is a cache: a busy or broken store is logged and reads as a miss,
+    writes are not durable (synchronous off)
+    - Every value is signed with <secret> (HMAC-SHA256 over the key, the
+    version or store time and the value), a value with a wrong signature
+    was not written by a worker of the tier and reads as a miss
+    - Responses of older versions are deleted when a newer one is stored,
+    at most <maxsize> responses are kept
+    """
+
+    def __init__(self, path, secret, maxsize=1024, timeout=0.05):
+        self.path = path
+        self.secret = secret
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.errors = 0
+        self._local = threading.local()
+
+    def _connection(self):
+        local = self._local
+        # A thread-local of the forking thread is inherited by the child
+        if getattr(local, 'pid', None) != os.getpid():
+            connection = sqlite3.connect(
+                self.path, timeout=self.timeout, isolation_level=None,
+                check_same_thread=False)
+            connection.execute('PRAGMA journal_mode = WAL')
+            connection.execute('PRAGMA synchronous = OFF')
+            for statement in SHARED_STORE_DDL:
+                connection.execute(statement)
+            local.connection = connection
+            local.pid = os.getpid()
+        return local.connection
+
+    def _sign(self, key, stamp, value):
+        message = f'{key}\0{stamp!r}\0'.encode() + value
+        return hmac.new(self.secret, message, hashlib.sha256).digest()
+
+    def _verify(self, key, stamp, value, signature):
+        if hmac.compare_digest(self._sign(key, stamp, value), signature):
+            return True
+        print(f'invalid signature of {key!r} in {self.path}')
+        self.errors += 1
+        return False
+
+    def _execute(self, statement, parameters=()):
+        try:
+            return self._connection().execute(statement, parameters)
+        except sqlite3.Error as error:
+            print(error)
+            self.errors += 1
+            return None
+
+    def get_response(self, key, version):
+        '''
+        Arguments:
+            - key: cache key (string)
+            - version: current version of the cached data
+
+        Returns:
+            - the body stored for <key> and <version> or None
+        '''
+        cursor = self._execute(
+            'SELECT body FROM response WHERE key = ? AND version = ?',
+            (key, version))
+        row = cursor.fetchone() if cursor is not None else None
+        if row is None:
+            return None
+        value = row[0] if isinstance(row[0], bytes) else b''
+        signature, body = value[:SIGNATURE_SIZE], value[SIGNATURE_SIZE:]
+        if not self._verify(key, version, body, signature):
+            return None
+        return body
+
+    def set_response(self, key, version, body):
+        '''
+        Arguments:
+            - key: cache key (string)
+            - version: version of the data <body> was built from
+            - body: serialized response body (bytes)
+        '''
+        self._execute(
+            'INSERT INTO response (key, version, body) VALUES (?, ?, ?) '
+            'ON CONFLICT (key) DO UPDATE SET version = excluded.version, '
+            'body = excluded.body WHERE excluded.version >= response.version',
+            (key, version, self._sign(key, version, body) + body))
+        self._execute('DELETE FROM response WHERE version < ?', (version,))
+        self._execute(
+            'DELETE FROM response WHERE rowid <= '
+            '(SELECT max(rowid) FROM response) - ?', (self.maxsize,))
+
+    def get_document(self, key):
+        '''
+        Arguments:
+            - key: document key (string)
+
+        Returns:
+            - (document, stored_at) tuple, the decoded json document and its
+            wall clock store time, or None
+        '''
+        cursor = self._execute(
+            'SELECT value, stored_at FROM document WHERE key = ?', (key,))
+        row = cursor.fetchone() if cursor is not None else None
+        if row is None:
+            return None
+        value, stored_at = str(row[0]), row[1]
+        try:
+            stored_at = float(stored_at)
+            signature = bytes.fromhex(value[:2 * SIGNATURE_SIZE])
+        except (TypeError, ValueError):
+            signature = b''
+        value = value[2 * SIGNATURE_SIZE:]
+        if not self._verify(key, stored_at, value.encode(), signature):
+            return None
+        return json.loads(value), stored_at
+
+    def set_document(self, key, document, stored_at=None):
+        '''
+        Arguments:
+            - key: document key (string)
+            - document: json serializable document
+            - stored_at: wall clock time of the document, defaults to now
+        '''
+        value = json.dumps(document)
+        stored_at = float(stored_at or time.time())
+        self._execute(
+            'INSERT INTO document (key, value, stored_at) VALUES (?, ?, ?) '
+            'ON CONFLICT (key) DO UPDATE SET value = excluded.value, '
+            'stored_at = excluded.stored_at',
+            (key, self._sign(key, stored_at, value.encode()).hex() + value,
+             stored_at))
+
+    def delete_documents(self, prefix, stored_before):
+        '''
+        Arguments:
+            - prefix: key prefix of the documents (i.e. 'idempotency ')
+            - stored_before: wall clock time, older documents are deleted
+        '''
+        self._execute(
+            'DELETE FROM document WHERE substr(key, 1, ?) = ? AND '
+            'stored_at < ?', (len(prefix), prefix, stored_before))
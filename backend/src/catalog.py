@@ -0,0 +1,253 @@
+from flask.cli import AppGroup
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy import select
+from .database.models import Drink, db, encode_fragments, drink_event, \
+    drinks_committed
+from .schemas import create_drinks_schema, is_valid_create
+from .validation import compile_schema, validation_error
+
+import click
+import json
+
+
+# Rows read per batch by an export
+EXPORT_BATCH_SIZE = 500
+# Drinks committed per transaction by an import, the largest chunk stays
+# well below the SQLite limit of bound variables of the title lookup
+IMPORT_CHUNK_SIZE = 500
+IMPORT_MAX_CHUNK_SIZE = 10000
+# skip: drinks with a title already taken are left as they are
+# upsert: their recipe is replaced
+IMPORT_MODES = ('skip', 'upsert')
+# Line errors kept in the report, the failed lines are all counted
+IMPORT_MAX_ERRORS = 1000
+
+CATALOG_COLUMNS = (Drink.id, Drink.title, Drink.recipe, Drink.short_fragment,
+                   Drink.long_fragment)
+
+create_drinks_validator = compile_schema(create_drinks_schema)
+
+# --------------------------------------------------------------------------- #
+# Export
+# --------------------------------------------------------------------------- #
+
+
+def catalog_rows():
+    '''
+    Returns:
+        - the drinks in id order, fetched EXPORT_BATCH_SIZE rows at a time
+        by a single query (one consistent snapshot of the table)
+    '''
+    return Drink.query.with_entities(*CATALOG_COLUMNS).order_by(
+        Drink.id).yield_per(EXPORT_BATCH_SIZE)
+
+
+def export_lines(rows):
+    '''
+    Arguments:
+        - rows: drinks with the CATALOG_COLUMNS, see catalog_rows
+
+    Returns:
+        - generator of the newline delimited json lines of the drinks, the
+        Drink.long() representation which import_lines reads back
+    '''
+    for row in rows:
+        yield Drink.long_json(row) + '\n'
+
+# --------------------------------------------------------------------------- #
+# Import
+# --------------------------------------------------------------------------- #
+
+
+class ImportReport:
+    """
+    Outcome of an import: every line read is created, updated, skipped or
+    failed, at most <max_errors> line errors are kept
+    """
+
+    def __init__(self, max_errors=IMPORT_MAX_ERRORS, on_error=None):
+        self.lines = 0
+        self.created = 0
+        self.updated = 0
+        self.skipped = 0
+        self.failed = 0
+        self.chunks = 0
+        self.errors = []
+        self.max_errors = max_errors
+        self.on_error = on_error
+
+    def error(self, line, message):
+        self.failed += 1
+        if len(self.errors) < self.max_errors:
+            self.errors.append({'line': line, 'message': message})
+        if self.on_error is not None:
+            self.on_error(line, message)
+
+    def as_dict(self):
+        return {
+            'lines': self.lines,
+            'created': self.created,
+            'updated': self.updated,
+            'skipped': self.skipped,
+            'failed': self.failed,
+            'chunks': self.chunks,
+            'errors': self.errors
+        }
+
+
+def write_chunk(chunk, mode, report):
+    '''
+    Arguments:
+        - chunk: dictionary of title -> (line numbers, drink parameters),
+        the lines of a title after the first one replace it (upsert)
+        - mode: one of IMPORT_MODES
+        - report: ImportReport
+
+    - Writes the chunk in a single transaction with one executemany on the
+    read-write engine (the session of a GET request reads through the
+    read-only one), a database error fails every line of the chunk
+    '''
+    table = Drink.__table__
+    statement = sqlite_insert(table)
+    if mode == 'upsert':
+        statement = statement.on_conflict_do_update(
+            index_elements=[table.c.title], set_={
+                column: statement.excluded[column] for column in
+                ('recipe', 'short_fragment', 'long_fragment')})
+    else:
+        statement = statement.on_conflict_do_nothing(
+            index_elements=[table.c.title])
+
+    try:
+        with db.engine.begin() as connection:
+            existing = {title for title, in connection.execute(
+                select(table.c.title).where(table.c.title.in_(list(chunk))))}
+            connection.execute(statement, [params for _, params in
+                                           chunk.values()])
+            written = [title for title in chunk
+                       if mode == 'upsert' or title not in existing]
+            events = [drink_event('update' if row.title in existing else
+                                  'create', Drink(**row._mapping))
+                      for row in connection.execute(
+                          select(*CATALOG_COLUMNS).where(
+                              table.c.title.in_(written)))] \
+                if written else []
+    except Exception as error:
+        print(error)
+        for numbers, _ in chunk.values():
+            for number in numbers:
+                report.error(number, 'unprocessable entity')
+        return
+
+    drinks_committed(events)
+    report.chunks += 1
+    report.created += len(chunk) - len(existing)
+    if mode == 'upsert':
+        report.updated += len(existing) + sum(
+            len(numbers) - 1 for numbers, _ in chunk.values())
+    else:
+        report.skipped += len(existing)
+
+
+def import_lines(lines, mode='skip', chunk_size=IMPORT_CHUNK_SIZE,
+                 report=None, progress=None):
+    '''
+    Arguments:
+        - lines: iterable of newline delimited json lines (bytes or str),
+        one drink per line as create_drinks_schema expects it, i.e. the
+        lines of export_lines (the "id" is ignored, drinks are matched by
+        title)
+        - mode: one of IMPORT_MODES
+        - chunk_size: drinks per transaction
+        - report: ImportReport to fill, a new one by default
+        - progress: optional function called with the report after every
+        chunk
+
+    - Lines are read, validated and written one chunk at a time, the
+    memory usage does not depend on the size of the catalog
+    - An invalid line is reported with the message of the 400 handler and
+    does not stop the import, blank lines are ignored
+    - A title repeated within a chunk is skipped, or replaces the earlier
+    line in upsert mode
+
+    Returns:
+        - the ImportReport
+    '''
+    if report is None:
+        report = ImportReport()
+    chunk = {}
+    for number, line in enumerate(lines, 1):
+        report.lines = number
+        if not line.strip():
+            continue
+        try:
+            data = json.loads(line)
+        except ValueError as error:
+            report.error(number, f'invalid json: {error}')
+            continue
+        error = validation_error(data, create_drinks_validator,
+                                 is_valid_create)
+        if error is not None:
+            report.error(number, error.message)
+            continue
+
+        title = data['title']
+        numbers = [number]
+        if title in chunk:
+            if mode == 'skip':
+                report.skipped += 1
+                continue
+            numbers = chunk[title][0] + numbers
+        recipe = json.dumps(data['recipe'])
+        chunk[title] = (numbers, dict(encode_fragments(title, recipe),
+                                      title=title, recipe=recipe))
+        if len(chunk) >= chunk_size:
+            write_chunk(chunk, mode, report)
+            chunk = {}
+            if progress is not None:
+                progress(report)
+
+    if chunk:
+        write_chunk(chunk, mode, report)
+        if progress is not None:
+            progress(report)
+    return report
+
+# --------------------------------------------------------------------------- #
+# Command line
+# --------------------------------------------------------------------------- #
+
+
+drinks_cli = AppGroup('drinks', help='Bulk import and export of the drink '
+                                     'catalog as newline delimited json.')
+
+
+@drinks_cli.command('export')
+@click.argument('output', type=click.File('w'), default='-')
+def export_command(output):
+    '''Writes every drink to OUTPUT (standard output by default).'''
+    for line in export_lines(catalog_rows()):
+        output.write(line)
+    db.session.remove()
+
+
+@drinks_cli.command('import')
+@click.argument('input', type=click.File('rb'), default='-')
+@click.option('--mode', type=click.Choice(IMPORT_MODES), default='skip',
+              show_default=True, help='what to do with taken titles')
+@click.option('--chunk-size', type=click.IntRange(1, IMPORT_MAX_CHUNK_SIZE),
+              default=IMPORT_CHUNK_SIZE, show_default=True,
+              help='drinks committed per transaction')
+def import_command(input, mode, chunk_size):
+    '''
+    Reads the drinks of INPUT (standard input by default), prints the
+    progress and the line errors to standard error and the report as json
+    to standard output.
+    '''
+    report = ImportReport(on_error=lambda number, message: click.echo(
+        f'line {number}: {message}', err=True))
+    import_lines(input, mode, chunk_size, report, lambda report: click.echo(
+        f'{report.lines} lines: {report.created} created, '
+        f'{report.updated} updated, {report.skipped} skipped, '
+        f'{report.failed} failed', err=True))
+    click.echo(json.dumps(report.as_dict()))
@@ -0,0 +1,150 @@
+from flask import request
+from collections import namedtuple
+from .metrics.metrics import phase
+
+import gzip
+
+try:
+    import brotli
+except ImportError:  # gzip only
+    brotli = None
+
+
+# Smaller bodies are sent as they are, the framing overhead eats the gain
+COMPRESSION_MIN_SIZE = 1024
+# Only text, streams (i.e. text/event-stream) are never compressed
+COMPRESSIBLE_TYPES = ('application/json', 'text/plain', 'text/html')
+# Preferred first, brotli compresses json noticeably better
+ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+# Cached variants are built once per menu version, the best ratio pays off
+CACHED_LEVELS = {'br': 11, 'gzip': 9}
+# Responses compressed on every request
+DYNAMIC_LEVELS = {'br': 4, 'gzip': 6}
+
+# Encoded body with its strong entity tag
+EncodedVariant = namedtuple('EncodedVariant', ['body', 'etag'])
+
+
+def negotiate_encoding(accept_encodings, size, min_size=COMPRESSION_MIN_SIZE):
+    '''
+    Arguments:
+        - accept_encodings: the parsed Accept-Encoding header of the request
+        - size: length of the identity body in bytes
+        - min_size: smallest body worth compressing
+
+    Returns:
+        - 'br' or 'gzip', the accepted encoding with the highest quality
+        (brotli on a tie), or None for the identity encoding
+    '''
+    if size < min_size:
+        return None
+    return accept_encodings.best_match(ENCODINGS)
+
+
+def compress(body, encoding, level):
+    '''
+    Arguments:
+        - body: response body (bytes)
+        - encoding: 'br' or 'gzip'
+        - level: brotli quality or gzip compression level
+
+    Returns:
+        - the encoded body, byte for byte the same for the same input (no
+        gzip timestamp) so every worker derives the same entity tag
+    '''
+    if encoding == 'br':
+        return brotli.compress(body, quality=level)
+    return gzip.compress(body, compresslevel=level, mtime=0)
+
+
+def encoded_variant(entry, encoding, levels=CACHED_LEVELS):
+    '''
+    Arguments:
+        - entry: CachedResponse of the identity body
+        - encoding: 'br' or 'gzip'
+        - levels: compression levels by encoding
+
+    - The variant is built on first use and kept on the entry, a cached
+    entry is compressed once per menu version and encoding
+    - A body the encoding does not shrink is kept as None
+
+    Returns:
+        - EncodedVariant with the "<etag>-<encoding>" entity tag, or None if
+        the identity body should be sent
+    '''
+    if encoding in entry.variants:
+        return entry.variants[encoding]
+    with phase('compression'):
+        body = compress(entry.body, encoding, levels[encoding])
+    variant = None
+    if len(body) < len(entry.body):
+        variant = EncodedVariant(body, f'{entry.etag}-{encoding}')
+    entry.variants[encoding] = variant
+    return variant
+
+
+def mark_negotiated(response):
+    '''
+    Arguments:
+        - response: response whose encoding is already chosen (i.e. a
+        cached menu page, see encoded_variant)
+
+    - The compress_response hook leaves it as it is, a cached variant the
+    encoding does not shrink is not compressed again on every request
+
+    Returns:
+        - the response
+    '''
+    response.encoding_negotiated = True
+    return response
+
+
+def is_compressible(response):
+    return response.mimetype in COMPRESSIBLE_TYPES and \
+        not response.is_streamed and not response.direct_passthrough and \
+        not getattr(response, 'encoding_negotiated', False)
+
+
+def setup_compression(app):
+    '''
+    Arguments:
+        - app: flask application
+
+    - Compresses the responses of the compressible types with the encoding
+    negotiated through Accept-Encoding, unless they are smaller than
+    COMPRESSION_MIN_SIZE bytes, carry a Content-Encoding already or were
+    negotiated by the view (the cached menu responses carry their
+    precompressed variants, see encoded_variant and mark_negotiated)
+    - Every compressible response varies on Accept-Encoding
+    - COMPRESSION_ENABLED turns it off
+    '''
+    app.config.setdefault('COMPRESSION_ENABLED', True)
+    app.config.setdefault('COMPRESSION_MIN_SIZE', COMPRESSION_MIN_SIZE)
+
+    @app.after_request
+    def compress_response(response):
+        if not app.config['COMPRESSION_ENABLED'] or \
+                not is_compressible(response):
+            return response
+        response.vary.add('Accept-Encoding')
+        if 'Content-Encoding' in response.headers or \
+                response.status_code in (204, 206, 304) or \
+                response.status_code < 200:
+            return response
+
+        body = response.get_data()
+        encoding = negotiate_encoding(request.accept_encodings, len(body),
+                                      app.config['COMPRESSION_MIN_SIZE'])
+        if encoding is None:
+            return response
+        with phase('compression'):
+            data = compress(body, encoding, DYNAMIC_LEVELS[encoding])
+        if len(data) >= len(body):
+            return response
+
+        response.set_data(data)
+        response.headers['Content-Encoding'] = encoding
+        etag, weak = response.get_etag()
+        if etag is not None:
+            response.set_etag(f'{etag}-{encoding}', weak)
+        return response
@@ -0,0 +1,119 @@
+# Change log of the drink table, the version of an entry is its position in
+# the log (AUTOINCREMENT, never reused)
+CHANGE_TABLE = 'drink_change'
+
+# Tombstones older than this many versions are dropped, clients further
+# behind have to resync the whole menu
+CHANGE_LOG_RETENTION = 10000
+
+# Every write of a drink supersedes its older entries (log compaction), so
+# the log holds one entry per drink plus the recent tombstones. The triggers
+# cover every code path (ORM, bulk or raw SQL) writing the drink table.
+CHANGE_LOG_DDL = [
+    f"CREATE TABLE IF NOT EXISTS {CHANGE_TABLE} ("
+    "version INTEGER PRIMARY KEY AUTOINCREMENT, "
+    "drink_id INTEGER NOT NULL, "
+    "op VARCHAR(6) NOT NULL)",
+
+    f"CREATE INDEX IF NOT EXISTS {CHANGE_TABLE}_drink_id "
+    f"ON {CHANGE_TABLE} (drink_id)",
+
+    f"CREATE TRIGGER IF NOT EXISTS {CHANGE_TABLE}_insert "
+    f"AFTER INSERT ON drink BEGIN "
+    f"DELETE FROM {CHANGE_TABLE} WHERE drink_id = new.id; "
+    f"INSERT INTO {CHANGE_TABLE} (drink_id, op) VALUES (new.id, 'upsert'); "
+    f"END",
+
+    f"CREATE TRIGGER IF NOT EXISTS {CHANGE_TABLE}_update "
+    f"AFTER UPDATE OF title, recipe ON drink BEGIN "
+    f"DELETE FROM {CHANGE_TABLE} WHERE drink_id = new.id; "
+    f"INSERT INTO {CHANGE_TABLE} (drink_id, op) VALUES (new.id, 'upsert'); "
+    f"END",
+
+    f"CREATE TRIGGER IF NOT EXISTS {CHANGE_TABLE}_delete "
+    f"AFTER DELETE ON drink BEGIN "
+    f"DELETE FROM {CHANGE_TABLE} WHERE drink_id = old.id; "
+    f"INSERT INTO {CHANGE_TABLE} (drink_id, op) VALUES (old.id, 'delete'); "
+    f"DELETE FROM {CHANGE_TABLE} WHERE op = 'delete' AND version <= "
+    f"(SELECT max(version) FROM {CHANGE_TABLE}) - {CHANGE_LOG_RETENTION}; "
+    f"END",
+]
+
+# A new log starts with an upsert of every existing drink, so a sync from
+# version 0 returns the whole menu
+CHANGE_LOG_BACKFILL = [
+    f"INSERT INTO {CHANGE_TABLE} (drink_id, op) "
+    "SELECT id, 'upsert' FROM drink ORDER BY id",
+]
+
+CHANGE_LOG_DROP = [f"DROP TABLE IF EXISTS {CHANGE_TABLE}"]
+
+# Current version of the log, the AUTOINCREMENT counter survives compaction
+VERSION_QUERY = (
+    "SELECT coalesce((SELECT seq FROM sqlite_sequence "
+    f"WHERE name = '{CHANGE_TABLE}'), 0)")
+
+# Drinks written after a version, oldest change first
+UPSERTS_QUERY = (
+    "SELECT drink.id, drink.title, drink.recipe, drink.short_fragment, "
+    f"drink.long_fragment FROM {CHANGE_TABLE} "
+    f"JOIN drink ON drink.id = {CHANGE_TABLE}.drink_id "
+    f"WHERE {CHANGE_TABLE}.version > :since AND {CHANGE_TABLE}.op = 'upsert' "
+    f"ORDER BY {CHANGE_TABLE}.version")
+
+# Ids of the drinks deleted after a version
+TOMBSTONES_QUERY = (
+    f"SELECT drink_id FROM {CHANGE_TABLE} "
+    "WHERE version > :since AND op = 'delete' ORDER BY version")
+
+
+def change_log_exists(connection):
+    '''
+    Arguments:
+        - connection: DB-API or SQLAlchemy connection
+
+    Returns:
+        - True if the change log table exists
+    '''
+    return connection.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = "
+        f"'{CHANGE_TABLE}'").fetchone() is not None
+
+
+def create_change_log(connection):
+    '''
+    Arguments:
+        - connection: DB-API or SQLAlchemy connection of a database with the
+        drink table
+
+    - Creates the change log and its triggers if they do not exist, a new
+    log is filled with the existing drinks (migration of older databases)
+    '''
+    exists = change_log_exists(connection)
+    for statement in CHANGE_LOG_DDL:
+        connection.execute(statement)
+    if not exists:
+        for statement in CHANGE_LOG_BACKFILL:
+            connection.execute(statement)
+
+
+def drop_change_log(connection):
+    '''
+    Drops the change log, the triggers are dropped with the drink table
+    '''
+    for statement in CHANGE_LOG_DROP:
+        connection.execute(statement)
+
+
+def needs_resync(since, version):
+    '''
+    Arguments:
+        - since: version the client is at
+        - version: current version of the log
+
+    Returns:
+        - True if the changes after <since> are no longer in the log (the
+        tombstones were dropped) or <since> is ahead of the log (the
+        database was recreated), the client has to fetch the whole menu
+    '''
+    return since > version or since < version - CHANGE_LOG_RETENTION
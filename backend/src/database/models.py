@@ -1,7 +1,20 @@
-from sqlalchemy import Column, String, Integer
-from flask_sqlalchemy import SQLAlchemy
-from flask import abort
+from sqlalchemy import Column, String, Integer, Text, create_engine, event, \
+    inspect, orm, text
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.pool import QueuePool
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from flask import abort, current_app, has_app_context, \
+    has_request_context, request
+from .search import SEARCH_QUERY, create_search_index, drop_search_index
+from ..events import menu_events
+from .replica import MenuReplica, current_replica
+from .writer import DrinkWriter, WRITE_WINDOW, WRITE_MAX_BATCH
+from .profiler import setup_profiler
+from .changes import VERSION_QUERY, UPSERTS_QUERY, TOMBSTONES_QUERY, \
+    create_change_log, drop_change_log
 
+import threading
 import json
 import os
 
@@ -10,18 +23,368 @@ project_dir = os.path.dirname(os.path.abspath(__file__))
 database_path = 'sqlite:///{}'.format(
     os.path.join(project_dir, database_filename))
 
-db = SQLAlchemy()
+
+# --------------------------------------------------------------------------- #
+# SQLite engine profile
+# --------------------------------------------------------------------------- #
+
+JOURNAL_MODES = ('DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF')
+SYNCHRONOUS_MODES = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
+
+
+def get_engine_profile(environ=os.environ):
+    """
+    get_engine_profile(environ)
+        reads the SQLite engine profile from the environment
+        SQLITE_JOURNAL_MODE: journal mode, WAL lets readers and the writer
+        work concurrently
+        SQLITE_SYNCHRONOUS: synchronous mode, NORMAL is durable in WAL mode
+        SQLITE_MMAP_SIZE: bytes of the database memory-mapped
+        SQLITE_CACHE_SIZE: page cache per connection, negative values are KiB
+        SQLITE_BUSY_TIMEOUT: milliseconds to wait for a lock
+        SQLITE_POOL_SIZE, SQLITE_MAX_OVERFLOW: connection pool size
+        SQLITE_READ_ONLY_GET: "1" routes GET requests to read-only
+        connections
+    """
+    profile = {
+        'journal_mode': environ.get('SQLITE_JOURNAL_MODE', 'WAL').upper(),
+        'synchronous': environ.get('SQLITE_SYNCHRONOUS', 'NORMAL').upper(),
+        'mmap_size': int(environ.get('SQLITE_MMAP_SIZE', 64 * 1024 * 1024)),
+        'cache_size': int(environ.get('SQLITE_CACHE_SIZE', -16000)),
+        'busy_timeout': int(environ.get('SQLITE_BUSY_TIMEOUT', 5000)),
+        'pool_size': int(environ.get('SQLITE_POOL_SIZE', 5)),
+        'max_overflow': int(environ.get('SQLITE_MAX_OVERFLOW', 10)),
+        'read_only_get': environ.get('SQLITE_READ_ONLY_GET', '1') == '1'
+    }
+    if profile['journal_mode'] not in JOURNAL_MODES:
+        raise ValueError('Invalid SQLITE_JOURNAL_MODE')
+    if profile['synchronous'] not in SYNCHRONOUS_MODES:
+        raise ValueError('Invalid SQLITE_SYNCHRONOUS')
+    return profile
+
+
+def engine_options(profile):
+    """
+    engine_options(profile)
+        SQLAlchemy engine options of a file based SQLite database: a sized
+        connection pool shared by the threads of the worker
+    """
+    return {
+        'poolclass': QueuePool,
+        'pool_size': profile['pool_size'],
+        'max_overflow': profile['max_overflow'],
+        'connect_args': {
+            'check_same_thread': False,
+            'timeout': profile['busy_timeout'] / 1000
+        }
+    }
+
+
+def pragma_statements(profile, read_only=False):
+    """
+    pragma_statements(profile, read_only)
+        PRAGMA statements applying the profile to a new SQLite connection
+        read-only connections reject every write statement
+    """
+    statements = [f"PRAGMA busy_timeout={profile['busy_timeout']}"]
+    if not read_only:
+        statements.append(f"PRAGMA journal_mode={profile['journal_mode']}")
+    statements += [
+        f"PRAGMA synchronous={profile['synchronous']}",
+        f"PRAGMA mmap_size={profile['mmap_size']}",
+        f"PRAGMA cache_size={profile['cache_size']}"
+    ]
+    if read_only:
+        statements.append('PRAGMA query_only=ON')
+    return statements
+
+
+def apply_pragmas(dbapi_connection, profile, read_only=False):
+    """
+    apply_pragmas(dbapi_connection, profile, read_only)
+        applies the profile to a new SQLite connection
+    """
+    cursor = dbapi_connection.cursor()
+    for statement in pragma_statements(profile, read_only):
+        cursor.execute(statement)
+    cursor.close()
+
+
+def is_file_database(sa_url):
+    return sa_url.drivername.startswith('sqlite') and \
+        sa_url.database not in (None, '', ':memory:')
+
+
+class RoutingSession(SignallingSession):
+    """
+    RoutingSession
+    a session which reads through read-only connections while serving a GET
+    request, flushes always use the read-write engine
+    """
+
+    def __init__(self, db, **options):
+        self.db = db
+        super().__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        bind = super().get_bind(mapper, clause)
+        if self._flushing or not has_request_context() or \
+                request.method not in ('GET', 'HEAD'):
+            return bind
+        return self.db.get_read_engine(bind)
+
+
+class Database(SQLAlchemy):
+    """
+    Database
+    the SQLAlchemy service, applies the SQLite engine profile at connect time
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.profile = get_engine_profile()
+        self._read_engines = {}
+        self._read_engines_lock = threading.Lock()
+
+    def create_session(self, options):
+        session_factory = orm.sessionmaker(
+            class_=RoutingSession, db=self, **options)
+        return session_factory
+
+    def create_engine(self, sa_url, engine_opts):
+        engine = super().create_engine(sa_url, engine_opts)
+        if is_file_database(sa_url):
+            event.listen(engine, 'connect', lambda dbapi_connection, _:
+                         apply_pragmas(dbapi_connection, self.profile))
+        return engine
+
+    def get_read_engine(self, engine):
+        """
+        get_read_engine(engine)
+            returns the read-only twin of <engine> with its own pool, or
+            <engine> itself if it is not a file based SQLite engine or
+            read-only routing is turned off
+        """
+        if not self.profile['read_only_get'] or \
+                not is_file_database(engine.url):
+            return engine
+
+        read_engine = self._read_engines.get(engine.url)
+        if read_engine is None:
+            with self._read_engines_lock:
+                read_engine = self._read_engines.get(engine.url)
+                if read_engine is None:
+                    read_engine = create_engine(
+                        engine.url, **engine_options(self.profile))
+                    event.listen(
+                        read_engine, 'connect', lambda dbapi_connection, _:
+                        apply_pragmas(dbapi_connection, self.profile,
+                                      read_only=True))
+                    self._read_engines[engine.url] = read_engine
+        return read_engine
+
+
+db = Database()
+
+# --------------------------------------------------------------------------- #
+# Precomputed json
+# --------------------------------------------------------------------------- #
+
+# Columns with the json of short() and long() without the id
+FRAGMENT_COLUMNS = ('short_fragment', 'long_fragment')
+
+# Rows written by an older version or by raw SQL without the fragments
+BACKFILL_SELECT = ('SELECT id, title, recipe FROM drink '
+                   'WHERE short_fragment IS NULL OR long_fragment IS NULL')
+BACKFILL_UPDATE = ('UPDATE drink SET short_fragment = :short_fragment, '
+                   'long_fragment = :long_fragment WHERE id = :id')
+
+
+def encode_json(data):
+    """
+    encode_json(data)
+        compact json text with sorted keys, the same as flask.jsonify
+        writes without the trailing newline
+    """
+    return json.dumps(data, sort_keys=True, separators=(',', ':'))
+
+
+def encode_fragments(title, recipe):
+    """
+    encode_fragments(title, recipe)
+        title: drink title
+        recipe: the recipe json text of the drink
+        returns the {'short_fragment': ..., 'long_fragment': ...} members
+        of the short() and long() json objects without the id, i.e.
+        '"recipe":[...],"title":"Water"'
+    """
+    recipe = json.loads(recipe)
+    short_recipe = [{'color': r['color'], 'parts': r['parts']}
+                    for r in recipe]
+    return {
+        'short_fragment': encode_json(
+            {'recipe': short_recipe, 'title': title})[1:-1],
+        'long_fragment': encode_json(
+            {'recipe': recipe, 'title': title})[1:-1]
+    }
+
+
+# Seed data of a new database
+SEED_DRINKS = [
+    {'title': 'Water',
+     'recipe': '[{"name": "water", "color": "blue", "parts": 1}]'}]
+
+
+class MenuVersion:
+    """
+    MenuVersion
+    a monotonic counter bumped after every committed change of the drinks
+    table, cached menu representations are only valid for one version
+    in-process by default, after share() the counter of a SharedVersion
+    file, bumped and seen by every worker process of the host
+    """
+
+    def __init__(self):
+        self._value = 0
+        self._shared = None
+        self._lock = threading.Lock()
+
+    @property
+    def value(self):
+        if self._shared is not None:
+            return self._shared.value
+        return self._value
+
+    def bump(self):
+        """
+        bump()
+            increments the version and returns the new value
+        """
+        if self._shared is not None:
+            return self._shared.bump()
+        with self._lock:
+            self._value += 1
+            return self._value
+
+    def share(self, shared):
+        """
+        share(shared)
+            continues on the SharedVersion <shared>, bumped once so that
+            no response cached before (by another run) is valid
+        """
+        self._shared = shared
+        shared.bump()
+
+
+def current_menu_version():
+    """
+    current_menu_version()
+        the MenuVersion of the current application, see setup_db
+    """
+    return current_app.extensions['menu_version']
+
+
+def drink_event(op, drink):
+    """
+    drink_event(op, drink)
+        the menu_events.publish arguments of a change of <drink>, read
+        after the flush and before the commit expires the model
+        op: 'create', 'update' or 'delete'
+    """
+    if op == 'delete':
+        return (op, drink.id, None, None)
+    return (op, drink.id, drink.short_json(), drink.long_json())
+
+
+def drinks_committed(events):
+    """
+    drinks_committed(events)
+        called after every commit of drink changes: bumps the menu
+        version, patches the menu replica of the application and publishes
+        the drink_event tuples to the open event streams of this process
+        (the writes of other processes only bump the shared version)
+        the changes are committed, a failed replica sync only invalidates
+        the replica
+    """
+    version = current_menu_version().bump()
+    replica = current_replica()
+    if replica is not None:
+        try:
+            replica.sync(version)
+        except Exception as error:
+            print(error)
+            replica.invalidate()
+    for args in events:
+        menu_events.publish(*args)
+
+
+# drink_event op of every DrinkWriter op
+WRITE_EVENTS = {'insert': 'create', 'create': 'create', 'update': 'update',
+                'delete': 'delete'}
+
+
+def writes_committed(writes):
+    """
+    writes_committed(writes)
+        drinks_committed of a batch of the DrinkWriter
+        writes: (op, id, params) tuples of the committed writes
+    """
+    drinks_committed([
+        drink_event(WRITE_EVENTS[op], Drink(**dict(params, id=id)))
+        for op, id, params in writes])
+
+
+def create_drink_writer(app):
+    """
+    create_drink_writer(app)
+        a DrinkWriter of the database of <app>, WRITE_WINDOW and
+        WRITE_MAX_BATCH of the application config size its batches
+    """
+    return DrinkWriter(app, lambda: db.get_engine(app), writes_committed,
+                       app.config.get('WRITE_WINDOW', WRITE_WINDOW),
+                       app.config.get('WRITE_MAX_BATCH', WRITE_MAX_BATCH))
+
+
+def current_writer():
+    """
+    current_writer()
+        the DrinkWriter of the current application, or None if the writes
+        are committed by the request threads
+    """
+    if not has_app_context():
+        return None
+    return current_app.extensions.get('drink_writer')
 
 
 def setup_db(app):
     """
     setup_db(app)
         binds a flask application and a SQLAlchemy service
+        the database defaults to database.db next to this module, unless
+        the application sets SQLALCHEMY_DATABASE_URI
+        the SQLite engine profile is read from the environment, see
+        get_engine_profile
+        the application gets its own MenuVersion, nothing is kept in the
+        module, several applications of a process serve their own database
+        unless MENU_REPLICA is False the application gets a MenuReplica
+        reading through the read-only engine
+        if WRITE_COALESCING is True the drink writes go through a
+        DrinkWriter, see create_drink_writer
+        the statements of the requests are profiled while the
+        QueryProfiler is enabled, see profiler.setup_profiler
+        no connection is opened, the engine is created on first use
     """
-    app.config["SQLALCHEMY_DATABASE_URI"] = database_path
+    app.config.setdefault("SQLALCHEMY_DATABASE_URI", database_path)
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-    db.app = app
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(db.profile)
     db.init_app(app)
+    app.extensions["menu_version"] = MenuVersion()
+    if app.config.get("MENU_REPLICA", True):
+        app.extensions["menu_replica"] = MenuReplica(
+            lambda: db.get_read_engine(db.get_engine(app)))
+    if app.config.get("WRITE_COALESCING", False):
+        app.extensions["drink_writer"] = create_drink_writer(app)
+    setup_profiler(app)
 
 def db_drop_and_create_all():
     """
@@ -31,13 +394,75 @@ def db_drop_and_create_all():
     """
     db.drop_all()
     db.create_all()
-    drinks = [
-        {'title': 'Water',
-         'recipe': '[{"name": "water", "color": "blue", "parts": 1}]'}]
-    for drink in drinks:
+    for drink in SEED_DRINKS:
         Drink(**drink).insert()
 
 
+def db_migrate():
+    """
+    db_migrate()
+        brings a database created by an older version up to date
+        every step is idempotent, safe to run on every start
+    """
+    with db.engine.begin() as connection:
+        create_search_index(connection)
+        create_change_log(connection)
+        columns = {row[1] for row in connection.execute(
+            'PRAGMA table_info(drink)')}
+        for column in FRAGMENT_COLUMNS:
+            if column not in columns:
+                connection.execute(
+                    f'ALTER TABLE drink ADD COLUMN {column} TEXT')
+        fragments = [dict(encode_fragments(title, recipe), id=id)
+                     for id, title, recipe in
+                     connection.execute(BACKFILL_SELECT)]
+        if fragments:
+            connection.execute(text(BACKFILL_UPDATE), fragments)
+
+
+
+# Real paths (or urls) of the databases db_init has set up in this process
+initialized_databases = set()
+initialize_lock = threading.Lock()
+
+
+def database_key(sa_url):
+    """
+    database_key(sa_url)
+        the real path of a SQLite database file, whatever the working
+        directory and symlinks, or the url of any other database
+    """
+    if is_file_database(sa_url):
+        return os.path.realpath(sa_url.database)
+    return str(sa_url)
+
+
+def db_init(app):
+    """
+    db_init(app)
+        creates the tables with the seed data if the database of <app> has
+        no drink table yet, then brings it up to date with db_migrate
+        an existing database is never dropped
+        runs once per database and process, see database_key
+        the connections are closed afterwards, processes forked from the
+        caller (gunicorn --preload) do not inherit any
+    """
+    with app.app_context():
+        engine = db.get_engine()
+        key = database_key(engine.url)
+        with initialize_lock:
+            if key in initialized_databases:
+                return
+            if not inspect(engine).has_table(Drink.__tablename__):
+                db.create_all()
+                for drink in SEED_DRINKS:
+                    Drink(**drink).insert()
+            db_migrate()
+            initialized_databases.add(key)
+        db.session.remove()
+        engine.dispose()
+
+
 class Drink(db.Model):
     """
     Drink
@@ -49,6 +474,10 @@ class Drink(db.Model):
     # the required datatype is [{'color': string, 'name':string,
     # 'parts':number}]
     recipe = Column(String(180), nullable=False)
+    # the short() and long() json without the id, written with the recipe
+    # so reads never decode it, see encode_fragments
+    short_fragment = Column(Text)
+    long_fragment = Column(Text)
 
     def short(self):
         """
@@ -74,6 +503,47 @@ class Drink(db.Model):
             'recipe': json.loads(self.recipe)
         }
 
+    def short_json(self):
+        """
+        short_json()
+            json text of short(), spliced from the stored fragment
+        """
+        fragment = self.short_fragment
+        if fragment is None:
+            fragment = encode_fragments(
+                self.title, self.recipe)['short_fragment']
+        return f'{{"id":{self.id},{fragment}}}'
+
+    def long_json(self):
+        """
+        long_json()
+            json text of long(), spliced from the stored fragment
+        """
+        fragment = self.long_fragment
+        if fragment is None:
+            fragment = encode_fragments(
+                self.title, self.recipe)['long_fragment']
+        return f'{{"id":{self.id},{fragment}}}'
+
+    def encode(self):
+        """
+        encode()
+            stores the short() and long() fragments of the current title
+            and recipe, called before every insert and update
+        """
+        fragments = encode_fragments(self.title, self.recipe)
+        self.short_fragment = fragments['short_fragment']
+        self.long_fragment = fragments['long_fragment']
+
+    def write_params(self):
+        """
+        write_params()
+            the DrinkWriter parameters of the current columns, the
+            fragments encoded on the calling thread
+        """
+        return dict(encode_fragments(self.title, self.recipe), id=self.id,
+                    title=self.title, recipe=self.recipe)
+
 
     def insert(self):
         """
@@ -81,14 +551,24 @@ class Drink(db.Model):
             inserts a new model into a database
             the model must have a unique name
             the model must have a unique id or null id
+            with a DrinkWriter (WRITE_COALESCING) the write is queued to
+            it and waited for, see current_writer
             EXAMPLE
                 drink = Drink(title=req_title, recipe=req_recipe)
                 drink.insert()
         """
+        writer = current_writer()
+        if writer is not None:
+            self.id = writer.write('insert', **self.write_params())
+            return self.id
+
         try:
             db.session.add(self)
-            db.session.commit()
+            db.session.flush()
             id = self.id
+            events = [drink_event('create', self)]
+            db.session.commit()
+            drinks_committed(events)
         except Exception as error:
             print(error)
             db.session.rollback()
@@ -103,13 +583,24 @@ class Drink(db.Model):
         delete()
             deletes a new model into a database
             the model must exist in the database
+            with a DrinkWriter (WRITE_COALESCING) the write is queued to
+            it and waited for, see current_writer
             EXAMPLE
                 drink = Drink(title=req_title, recipe=req_recipe)
                 drink.delete()
         """
+        writer = current_writer()
+        if writer is not None:
+            id = self.id
+            db.session.close()
+            writer.write('delete', id=id)
+            return
+
         try:
+            events = [drink_event('delete', self)]
             db.session.delete(self)
             db.session.commit()
+            drinks_committed(events)
         except Exception as error:
             print(error)
             db.session.rollback()
@@ -123,13 +614,78 @@ class Drink(db.Model):
         update()
             updates a new model into a database
             the model must exist in the database
+            with a DrinkWriter (WRITE_COALESCING) the write is queued to
+            it and waited for, see current_writer
             EXAMPLE
                 drink = Drink.query.filter(Drink.id == id).one_or_none()
                 drink.title = 'Black Coffee'
                 drink.update()
         """
+        writer = current_writer()
+        if writer is not None:
+            params = self.write_params()
+            # The changes are written by the writer, not flushed
+            db.session.close()
+            writer.write('update', **params)
+            return
+
+        try:
+            db.session.flush()
+            events = [drink_event('update', self)]
+            db.session.commit()
+            drinks_committed(events)
+        except Exception as error:
+            print(error)
+            db.session.rollback()
+            abort(422)
+        finally:
+            db.session.close()
+
+    @classmethod
+    def batch(cls, creates=(), deletes=()):
+        """
+        batch(creates, deletes)
+            applies the pending changes of the session, the <creates> and
+            the <deletes> in a single transaction with one commit
+            creates: list of {'title': title, 'recipe': recipe} mappings,
+            inserted in bulk
+            deletes: list of models to delete
+            the ids of the created drinks are returned in <creates> order
+            responds with 409 if a title is not unique, 422 on any other
+            database error
+            EXAMPLE
+                drink = Drink.query.get(id)
+                drink.title = 'Black Coffee'
+                ids = Drink.batch(creates=[{'title': title,
+                                            'recipe': recipe}])
+        """
         try:
+            ids = []
+            updated = [drink for drink in db.session.dirty
+                       if isinstance(drink, cls) and
+                       db.session.is_modified(drink)]
+            db.session.flush()
+            events = [drink_event('update', drink) for drink in updated]
+            if creates:
+                # Bulk inserts skip the mapper events
+                mappings = [dict(create, **encode_fragments(
+                    create['title'], create['recipe'])) for create in creates]
+                db.session.bulk_insert_mappings(cls, mappings)
+                titles = [create['title'] for create in creates]
+                created = dict(db.session.query(cls.title, cls.id).filter(
+                    cls.title.in_(titles)))
+                ids = [created[title] for title in titles]
+                events += [drink_event('create', cls(id=id, **mapping))
+                           for id, mapping in zip(ids, mappings)]
+            for drink in deletes:
+                events.append(drink_event('delete', drink))
+                db.session.delete(drink)
             db.session.commit()
+            drinks_committed(events)
+        except IntegrityError as error:
+            print(error)
+            db.session.rollback()
+            abort(409)
         except Exception as error:
             print(error)
             db.session.rollback()
@@ -137,5 +693,105 @@ class Drink(db.Model):
         finally:
             db.session.close()
 
+        return ids
+
+    @classmethod
+    def create(cls, title, recipe):
+        """
+        create(title, recipe)
+            inserts a new drink in a single INSERT ... ON CONFLICT DO
+            NOTHING statement, no separate lookup of the title
+            recipe: the recipe json text
+            responds with 409 if the title is taken, 422 on any other
+            database error
+            returns the id of the new drink
+            with a DrinkWriter (WRITE_COALESCING) the write is queued to
+            it and waited for, see current_writer
+            EXAMPLE
+                id = Drink.create(req_title, json.dumps(req_recipe))
+        """
+        fragments = encode_fragments(title, recipe)
+        writer = current_writer()
+        if writer is not None:
+            return writer.write('create', title=title, recipe=recipe,
+                                **fragments)
+
+        statement = sqlite_insert(cls.__table__).values(
+            title=title, recipe=recipe, **fragments
+        ).on_conflict_do_nothing(index_elements=[cls.title])
+        try:
+            result = db.session.execute(statement)
+            id = result.inserted_primary_key[0] if result.rowcount else None
+            db.session.commit()
+            if id is not None:
+                drinks_committed([drink_event('create', cls(
+                    id=id, title=title, recipe=recipe, **fragments))])
+        except Exception as error:
+            print(error)
+            db.session.rollback()
+            abort(422)
+        finally:
+            db.session.close()
+
+        # 409 the title is taken
+        if id is None:
+            abort(409)
+        return id
+
+    @classmethod
+    def changes(cls, since):
+        """
+        changes(since)
+            reads the change log after version <since>
+            the version is read first, a write racing with the reads is
+            returned again by the next sync
+            returns a (version, upserts, deleted_ids) tuple where version is
+            the current version of the log and upserts are (id, title,
+            recipe, short_fragment, long_fragment) rows
+        """
+        params = {'since': since}
+        version = db.session.execute(text(VERSION_QUERY)).scalar()
+        upserts = db.session.execute(text(UPSERTS_QUERY), params).fetchall()
+        deleted = [row[0] for row in db.session.execute(
+            text(TOMBSTONES_QUERY), params)]
+        return version, upserts, deleted
+
+    @classmethod
+    def search(cls, query, limit, offset=0):
+        """
+        search(query, limit, offset)
+            full-text search over the titles and the ingredient names
+            query: FTS5 match expression, see search.build_match_query
+            returns at most <limit> (id, title, recipe, short_fragment,
+            long_fragment) rows ranked by relevance, skipping the first
+            <offset> matches
+        """
+        return db.session.execute(text(SEARCH_QUERY), {
+            'query': query,
+            'limit': limit,
+            'offset': offset
+        }).fetchall()
+
     def __repr__(self):
         return json.dumps(self.short())
+
+
+# The fragments are written together with the title and recipe
+@event.listens_for(Drink, 'before_insert')
+@event.listens_for(Drink, 'before_update')
+def encode_drink(mapper, connection, target):
+    target.encode()
+
+
+# The search index, the change log and their triggers live and die with
+# the drink table
+@event.listens_for(Drink.__table__, 'after_create')
+def create_drink_triggers(target, connection, **kw):
+    create_search_index(connection)
+    create_change_log(connection)
+
+
+@event.listens_for(Drink.__table__, 'before_drop')
+def drop_drink_triggers(target, connection, **kw):
+    drop_search_index(connection)
+    drop_change_log(connection)
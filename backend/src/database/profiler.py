@@ -0,0 +1,272 @@
+from flask import g, has_request_context, request
+from sqlalchemy.engine import Engine
+from sqlalchemy import event
+
+import threading
+import json
+import time
+import os
+
+
+# Statements slower than this in seconds are logged with their parameters
+# and query plan
+SLOW_QUERY_THRESHOLD = 0.05
+# Requests slower than this in seconds are logged
+SLOW_REQUEST_THRESHOLD = 0.5
+# A statement run this many times by one request is flagged (N+1 pattern)
+REPEATED_STATEMENT_THRESHOLD = 5
+# Seconds between two checks of the toggle file
+TOGGLE_CHECK_INTERVAL = 1.0
+# Characters of the parameters and statements kept in a log line
+MAX_TEXT_LENGTH = 500
+
+# Statements EXPLAIN QUERY PLAN accepts
+EXPLAINABLE = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH')
+
+
+def truncate(text):
+    if len(text) <= MAX_TEXT_LENGTH:
+        return text
+    return text[:MAX_TEXT_LENGTH] + '...'
+
+
+def explain_query_plan(cursor, statement, parameters):
+    '''
+    Arguments:
+        - cursor: DBAPI cursor of a SQLite connection
+        - statement: SQL statement as it was executed
+        - parameters: its parameters
+
+    - Runs on the DBAPI connection itself, neither the engine events nor
+    the transaction of the statement are touched, the statement is not
+    executed again
+
+    Returns:
+        - the detail column of every row of the plan, or None if the
+        statement has no plan (i.e. a PRAGMA)
+    '''
+    if not statement.lstrip().upper().startswith(EXPLAINABLE):
+        return None
+    try:
+        plan = cursor.connection.execute(
+            f'EXPLAIN QUERY PLAN {statement}', parameters or ())
+        return [row[3] for row in plan.fetchall()]
+    except Exception as error:
+        print(error)
+        return None
+
+
+class RequestProfile:
+    """
+    Per request statement log, kept in flask.g.query_profile
+    """
+
+    __slots__ = ('start', 'statements', 'counts', 'db_time', 'slow',
+                 'status')
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.statements = 0
+        self.counts = {}
+        self.db_time = 0
+        self.slow = []
+        self.status = None
+
+
+class QueryProfiler:
+    """
+    Slow query log and per request statement profiler
+
+    - Every statement of a profiled request is counted per statement text,
+    the SQLAlchemy statements carry their parameters as placeholders so
+    the same query with other values counts as a repetition
+    - A statement slower than <slow_query> seconds is kept with its
+    parameters and the EXPLAIN QUERY PLAN output
+    - A request slower than <slow_request> seconds, with a slow statement
+    or with a statement run <repeated> times or more is logged as a single
+    json line through <log>
+    - <enabled> can be changed at any time, with a <toggle_file> the
+    profiler is enabled while that file exists (checked every
+    TOGGLE_CHECK_INTERVAL seconds), i.e. on every worker of the host at once
+    """
+
+    def __init__(self, enabled=False, slow_query=SLOW_QUERY_THRESHOLD,
+                 slow_request=SLOW_REQUEST_THRESHOLD,
+                 repeated=REPEATED_STATEMENT_THRESHOLD, toggle_file=None,
+                 log=print):
+        self.enabled = enabled
+        self.slow_query = slow_query
+        self.slow_request = slow_request
+        self.repeated = repeated
+        self.toggle_file = toggle_file
+        self.log = log
+        self.slow_queries = 0
+        self.slow_requests = 0
+        self._toggle_checked = None
+        self._lock = threading.Lock()
+
+    @property
+    def active(self):
+        if self.toggle_file is not None:
+            now = time.monotonic()
+            with self._lock:
+                if self._toggle_checked is None or \
+                        now - self._toggle_checked >= TOGGLE_CHECK_INTERVAL:
+                    self._toggle_checked = now
+                    self.enabled = os.path.exists(self.toggle_file)
+        return self.enabled
+
+    def statement_executed(self, profile, cursor, statement, parameters,
+                           seconds, explain):
+        '''
+        Arguments:
+            - profile: RequestProfile of the request
+            - cursor: DBAPI cursor the statement ran on
+            - statement, parameters: as they were executed
+            - seconds: execution time
+            - explain: True if the plan of a slow statement can be read
+            (a SQLite statement run once, not per parameter set)
+        '''
+        profile.statements += 1
+        profile.db_time += seconds
+        profile.counts[statement] = profile.counts.get(statement, 0) + 1
+        if seconds < self.slow_query:
+            return
+        self.slow_queries += 1
+        plan = None
+        if explain:
+            plan = explain_query_plan(cursor, statement, parameters)
+        profile.slow.append({
+            'statement': truncate(statement),
+            'parameters': truncate(repr(parameters)),
+            'duration_ms': round(seconds * 1000, 3),
+            'plan': plan
+        })
+
+    def report(self, profile):
+        '''
+        Arguments:
+            - profile: RequestProfile of a finished request
+
+        Returns:
+            - the log record of the request, or None if it is not worth
+            logging
+        '''
+        seconds = time.perf_counter() - profile.start
+        repeated = [{'statement': truncate(statement), 'count': count}
+                    for statement, count in profile.counts.items()
+                    if count >= self.repeated]
+        reasons = []
+        if seconds >= self.slow_request:
+            reasons.append('slow_request')
+        if profile.slow:
+            reasons.append('slow_query')
+        if repeated:
+            reasons.append('repeated_statements')
+        if not reasons:
+            return None
+        return {
+            'event': 'query_profile',
+            'reasons': reasons,
+            'method': request.method,
+            'path': request.path,
+            'route': request.url_rule.rule if request.url_rule else None,
+            'status': profile.status,
+            'duration_ms': round(seconds * 1000, 3),
+            'statements': profile.statements,
+            'db_ms': round(profile.db_time * 1000, 3),
+            'slow_queries': profile.slow,
+            'repeated': repeated
+        }
+
+    def finish(self, profile):
+        record = self.report(profile)
+        if record is None:
+            return
+        if 'slow_request' in record['reasons']:
+            self.slow_requests += 1
+        self.log(json.dumps(record, sort_keys=True, default=str))
+
+# --------------------------------------------------------------------------- #
+# Engine events
+# --------------------------------------------------------------------------- #
+
+
+def current_profile():
+    if not has_request_context():
+        return None
+    return g.get('query_profile')
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    if current_profile() is not None:
+        conn.info.setdefault('profiler_query_start', []).append(
+            time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    profile = current_profile()
+    starts = conn.info.get('profiler_query_start')
+    if profile is None or not starts:
+        return
+    seconds = time.perf_counter() - starts.pop()
+    g.query_profiler.statement_executed(
+        profile, cursor, statement, parameters, seconds,
+        conn.dialect.name == 'sqlite' and not executemany)
+
+
+def listen_engines():
+    '''
+    Profiles the SQL statements of every engine (the read-only engines
+    included), only requests with a RequestProfile pay for it
+    '''
+    if not event.contains(Engine, 'before_cursor_execute',
+                          before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+
+
+def setup_profiler(app):
+    '''
+    Arguments:
+        - app: flask application
+
+    - Adds a QueryProfiler to the application (app.extensions
+    ['query_profiler']), configured by QUERY_PROFILER (enabled at start),
+    SLOW_QUERY_THRESHOLD, SLOW_REQUEST_THRESHOLD,
+    REPEATED_STATEMENT_THRESHOLD and QUERY_PROFILER_TOGGLE_FILE
+    - Requests started while it is disabled are not profiled
+    '''
+    profiler = QueryProfiler(
+        app.config.get('QUERY_PROFILER', False),
+        app.config.get('SLOW_QUERY_THRESHOLD', SLOW_QUERY_THRESHOLD),
+        app.config.get('SLOW_REQUEST_THRESHOLD', SLOW_REQUEST_THRESHOLD),
+        app.config.get('REPEATED_STATEMENT_THRESHOLD',
+                       REPEATED_STATEMENT_THRESHOLD),
+        app.config.get('QUERY_PROFILER_TOGGLE_FILE'))
+    app.extensions['query_profiler'] = profiler
+    listen_engines()
+
+    @app.before_request
+    def start_query_profile():
+        profiler = app.extensions['query_profiler']
+        if profiler.active:
+            g.query_profiler = profiler
+            g.query_profile = RequestProfile()
+
+    @app.after_request
+    def record_query_profile_status(response):
+        profile = current_profile()
+        if profile is not None:
+            profile.status = response.status_code
+        return response
+
+    @app.teardown_request
+    def finish_query_profile(error):
+        profile = g.pop('query_profile', None)
+        if profile is not None:
+            if profile.status is None:
+                profile.status = 500
+            g.pop('query_profiler').finish(profile)
@@ -0,0 +1,171 @@
+from sqlalchemy import text
+from flask import current_app, has_app_context
+from .changes import VERSION_QUERY, UPSERTS_QUERY, TOMBSTONES_QUERY, \
+    needs_resync
+
+import threading
+import bisect
+
+
+# The whole menu, in id order
+SNAPSHOT_QUERY = ('SELECT id, title, recipe, short_fragment, long_fragment '
+                  'FROM drink ORDER BY id')
+
+# Patches between two consistency checks
+REPLICA_CHECK_EVERY = 100
+
+
+class DrinkRecord:
+    """
+    DrinkRecord
+    the columns of a drink the menu routes read, Drink.short_json and
+    Drink.long_json accept it in place of a model
+    """
+    __slots__ = ('id', 'title', 'recipe', 'short_fragment', 'long_fragment')
+
+    def __init__(self, id, title, recipe, short_fragment, long_fragment):
+        self.id = id
+        self.title = title
+        self.recipe = recipe
+        self.short_fragment = short_fragment
+        self.long_fragment = long_fragment
+
+    def __eq__(self, other):
+        return isinstance(other, DrinkRecord) and all(
+            getattr(self, name) == getattr(other, name)
+            for name in self.__slots__)
+
+
+class MenuReplica:
+    """
+    MenuReplica
+    in-process snapshot of the drinks table: parallel tuples of the ids and
+    the DrinkRecords in id order
+    the snapshot is synced from the change log (see changes.py) in a single
+    read transaction, only the rows written since the snapshot are read
+    (a full load if the log has no longer got them), then swapped as a
+    whole, readers never lock or see a partial snapshot
+    get_engine: function returning the engine to read through
+    """
+
+    def __init__(self, get_engine, check_every=REPLICA_CHECK_EVERY):
+        self.get_engine = get_engine
+        self.check_every = check_every
+        # Change log version of the snapshot
+        self.version = None
+        # Menu version the snapshot is current for
+        self.seen = None
+        self.loads = 0
+        self.patches = 0
+        self.repairs = 0
+        # (ids, records), replaced as a whole
+        self._snapshot = ((), ())
+        self._lock = threading.Lock()
+
+    def _load(self, connection):
+        records = tuple(DrinkRecord(*row)
+                        for row in connection.execute(text(SNAPSHOT_QUERY)))
+        self.loads += 1
+        return records
+
+    def _patch(self, connection, since):
+        params = {'since': since}
+        upserts = {row[0]: DrinkRecord(*row) for row in connection.execute(
+            text(UPSERTS_QUERY), params)}
+        deleted = {row[0] for row in connection.execute(
+            text(TOMBSTONES_QUERY), params)}
+        records = [record for record in self._snapshot[1]
+                   if record.id not in deleted and record.id not in upserts]
+        records.extend(upserts.values())
+        records.sort(key=lambda record: record.id)
+        self.patches += 1
+        return tuple(records)
+
+    def _swap(self, records, version, seen):
+        self._snapshot = (tuple(record.id for record in records), records)
+        self.version = version
+        self.seen = seen
+
+    def sync(self, seen):
+        """
+        sync(seen)
+            brings the snapshot up to date with the database
+            seen: the menu version read before the sync, the snapshot is
+            current for it
+            every <check_every> patches the snapshot is verified
+        """
+        with self._lock:
+            if self.seen == seen:
+                return
+            with self.get_engine().connect() as connection:
+                with connection.begin():
+                    version = connection.execute(
+                        text(VERSION_QUERY)).scalar()
+                    if self.version is None or \
+                            needs_resync(self.version, version):
+                        records = self._load(connection)
+                    else:
+                        records = self._patch(connection, self.version)
+            self._swap(records, version, seen)
+            if self.check_every and self.patches % self.check_every == 0 \
+                    and self.patches:
+                self._verify()
+
+    def invalidate(self):
+        """
+        invalidate()
+            the next read syncs the snapshot from the database
+        """
+        with self._lock:
+            self.seen = None
+
+    def verify(self):
+        """
+        verify()
+            consistency check, compares the snapshot with the drinks table
+            and replaces it if they differ (i.e. a write which did not go
+            through the models and did not bump the menu version)
+            returns the ids of the drinks which differed
+        """
+        with self._lock:
+            return self._verify()
+
+    def _verify(self):
+        with self.get_engine().connect() as connection:
+            with connection.begin():
+                version = connection.execute(text(VERSION_QUERY)).scalar()
+                records = self._load(connection)
+        current = {record.id: record for record in self._snapshot[1]}
+        loaded = {record.id: record for record in records}
+        differ = sorted(id for id in current.keys() | loaded.keys()
+                        if current.get(id) != loaded.get(id))
+        if differ:
+            print(f'menu replica differs from the database: {differ}')
+            self.repairs += 1
+            self._swap(records, version, self.seen)
+        return differ
+
+    def page(self, seen, after_id=0, limit=None):
+        """
+        page(seen, after_id, limit)
+            the records with an id above <after_id> in id order, at most
+            <limit> of them
+            seen: the current menu version, the snapshot is synced first if
+            it is not current for it
+        """
+        if self.seen != seen:
+            self.sync(seen)
+        ids, records = self._snapshot
+        start = bisect.bisect_right(ids, after_id)
+        end = None if limit is None else start + limit
+        return list(records[start:end])
+
+
+def current_replica():
+    """
+    current_replica()
+        the MenuReplica of the current application, or None
+    """
+    if not has_app_context():
+        return None
+    return current_app.extensions.get('menu_replica')
@@ -0,0 +1,119 @@
+import re
+
+
+# FTS5 index of the drink titles and ingredient names, the rowid of an
+# entry is the id of its drink
+SEARCH_TABLE = 'drink_search'
+
+# Space separated ingredient names of a recipe (json text)
+INGREDIENTS_SQL = (
+    "(SELECT group_concat(json_extract(value, '$.name'), ' ') "
+    "FROM json_each(CASE WHEN json_valid({0}) THEN {0} ELSE '[]' END))")
+
+# The triggers keep the index in sync with every write of the drink table,
+# whichever code path (ORM, bulk or raw SQL) it comes from
+SEARCH_INDEX_DDL = [
+    f"CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_TABLE} USING fts5("
+    "title, ingredients, tokenize = 'unicode61 remove_diacritics 2', "
+    "prefix = '2 3')",
+
+    f"CREATE TRIGGER IF NOT EXISTS {SEARCH_TABLE}_insert "
+    f"AFTER INSERT ON drink BEGIN "
+    f"INSERT INTO {SEARCH_TABLE} (rowid, title, ingredients) VALUES "
+    f"(new.id, new.title, {INGREDIENTS_SQL.format('new.recipe')}); END",
+
+    f"CREATE TRIGGER IF NOT EXISTS {SEARCH_TABLE}_update "
+    f"AFTER UPDATE OF id, title, recipe ON drink BEGIN "
+    f"DELETE FROM {SEARCH_TABLE} WHERE rowid = old.id; "
+    f"INSERT INTO {SEARCH_TABLE} (rowid, title, ingredients) VALUES "
+    f"(new.id, new.title, {INGREDIENTS_SQL.format('new.recipe')}); END",
+
+    f"CREATE TRIGGER IF NOT EXISTS {SEARCH_TABLE}_delete "
+    f"AFTER DELETE ON drink BEGIN "
+    f"DELETE FROM {SEARCH_TABLE} WHERE rowid = old.id; END",
+]
+
+# Rebuilds the index from the drink table
+SEARCH_INDEX_BACKFILL = [
+    f"DELETE FROM {SEARCH_TABLE}",
+    f"INSERT INTO {SEARCH_TABLE} (rowid, title, ingredients) "
+    f"SELECT id, title, {INGREDIENTS_SQL.format('recipe')} FROM drink",
+]
+
+SEARCH_INDEX_DROP = [f"DROP TABLE IF EXISTS {SEARCH_TABLE}"]
+
+# Matches ranked by bm25, a title match weighs more than an ingredient
+# match, ties are broken by id so pages are stable
+SEARCH_QUERY = (
+    f"SELECT drink.id, drink.title, drink.recipe, drink.short_fragment, "
+    f"drink.long_fragment FROM {SEARCH_TABLE} "
+    f"JOIN drink ON drink.id = {SEARCH_TABLE}.rowid "
+    f"WHERE {SEARCH_TABLE} MATCH :query "
+    f"ORDER BY bm25({SEARCH_TABLE}, 10.0, 1.0), drink.id "
+    f"LIMIT :limit OFFSET :offset")
+
+# Longest accepted search text and number of terms
+SEARCH_MAX_LENGTH = 200
+SEARCH_MAX_TERMS = 10
+
+
+def search_index_exists(connection):
+    '''
+    Arguments:
+        - connection: DB-API or SQLAlchemy connection
+
+    Returns:
+        - True if the search index table exists
+    '''
+    return connection.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = "
+        f"'{SEARCH_TABLE}'").fetchone() is not None
+
+
+def create_search_index(connection):
+    '''
+    Arguments:
+        - connection: DB-API or SQLAlchemy connection of a database with the
+        drink table
+
+    - Creates the search index and its triggers if they do not exist, a new
+    index is filled from the existing drinks (migration of older databases)
+    '''
+    exists = search_index_exists(connection)
+    for statement in SEARCH_INDEX_DDL:
+        connection.execute(statement)
+    if not exists:
+        for statement in SEARCH_INDEX_BACKFILL:
+            connection.execute(statement)
+
+
+def drop_search_index(connection):
+    '''
+    Drops the search index, the triggers are dropped with the drink table
+    '''
+    for statement in SEARCH_INDEX_DROP:
+        connection.execute(statement)
+
+
+def build_match_query(text):
+    '''
+    Arguments:
+        - text: search text of the user
+
+    - Every word becomes a quoted prefix term, all of them must match, so
+    the FTS5 query syntax (operators, column filters) cannot be injected
+
+    Raises:
+        - ValueError if <text> is empty, too long or has no words
+
+    Returns:
+        - FTS5 MATCH expression (i.e. '"cof"* "milk"*')
+    '''
+    if not text or len(text) > SEARCH_MAX_LENGTH:
+        raise ValueError('invalid search text')
+
+    terms = re.findall(r'\w+', text)[:SEARCH_MAX_TERMS]
+    if not terms:
+        raise ValueError('invalid search text')
+
+    return ' '.join(f'"{term}"*' for term in terms)
@@ -0,0 +1,185 @@
+from sqlalchemy import text
+from sqlalchemy.exc import IntegrityError
+from werkzeug.exceptions import Conflict, UnprocessableEntity
+from concurrent.futures import Future
+from collections import namedtuple
+
+import threading
+import queue
+import time
+import os
+
+
+# Seconds the writer waits for more writes once it has got one
+WRITE_WINDOW = 0.002
+# Writes committed in one transaction at most
+WRITE_MAX_BATCH = 64
+
+# The statements of the writes, a single statement each: SQLite rolls back
+# a statement which fails a constraint on its own, the other writes of the
+# transaction are kept
+WRITE_STATEMENTS = {
+    'insert': 'INSERT INTO drink (title, recipe, short_fragment, '
+              'long_fragment) VALUES (:title, :recipe, :short_fragment, '
+              ':long_fragment)',
+    'create': 'INSERT INTO drink (title, recipe, short_fragment, '
+              'long_fragment) VALUES (:title, :recipe, :short_fragment, '
+              ':long_fragment) ON CONFLICT (title) DO NOTHING',
+    'update': 'UPDATE drink SET title = :title, recipe = :recipe, '
+              'short_fragment = :short_fragment, '
+              'long_fragment = :long_fragment WHERE id = :id',
+    'delete': 'DELETE FROM drink WHERE id = :id',
+}
+
+# A queued write: op is a WRITE_STATEMENTS key, params its parameters
+WriteRequest = namedtuple('WriteRequest', ['op', 'params', 'future'])
+
+
+class DrinkWriter:
+    """
+    DrinkWriter
+    a single thread writing the drink mutations of every request thread,
+    the writes queued while it commits are applied in one transaction
+    (group commit): one fsync and one acquisition of the SQLite write lock
+    per batch instead of per write
+    every write resolves its own future after the commit returned, a
+    request never sees a result which is not durable
+    a write which fails a constraint fails alone with the status the
+    synchronous path responds with: 409 for a taken title on create, 422
+    otherwise, any other database error fails the whole batch with 422
+    app: flask application, the writer thread runs in its app context
+    get_engine: function returning the read-write engine
+    committed: function called with the (op, id, params) tuples of the
+    writes of every committed batch, before their futures are resolved
+    """
+
+    def __init__(self, app, get_engine, committed, window=WRITE_WINDOW,
+                 max_batch=WRITE_MAX_BATCH):
+        self.app = app
+        self.get_engine = get_engine
+        self.committed = committed
+        self.window = window
+        self.max_batch = max_batch
+        self.writes = 0
+        self.commits = 0
+        self.errors = 0
+        self._queue = queue.Queue()
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        # Started on first use, a process forked from the caller (gunicorn
+        # --preload) starts its own thread
+        with self._lock:
+            if self._pid != os.getpid() or not self._thread.is_alive():
+                if self._pid != os.getpid():
+                    self._queue = queue.Queue()
+                self._thread = threading.Thread(
+                    target=self._run, name='drink-writer', daemon=True)
+                self._thread.start()
+                self._pid = os.getpid()
+
+    def submit(self, op, **params):
+        """
+        submit(op, **params)
+            queues a write, returns its Future
+            the result is the id of the drink for 'insert' and 'create',
+            None otherwise, a failed write raises the HTTPException of its
+            status
+        """
+        if self._pid != os.getpid() or not self._thread.is_alive():
+            self._start()
+        future = Future()
+        self._queue.put(WriteRequest(op, params, future))
+        return future
+
+    def write(self, op, **params):
+        """
+        write(op, **params)
+            queues a write and waits for its result, see submit
+        """
+        return self.submit(op, **params).result()
+
+    def stop(self):
+        """
+        stop()
+            commits the queued writes and ends the writer thread
+        """
+        if self._thread is not None and self._pid == os.getpid():
+            self._queue.put(None)
+            self._thread.join()
+
+    def _collect(self, first):
+        batch = [first]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch:
+            try:
+                request = self._queue.get(
+                    timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            if request is None:
+                # Stop after this batch
+                self._queue.put(None)
+                break
+            batch.append(request)
+        return batch
+
+    def _run(self):
+        with self.app.app_context():
+            while True:
+                request = self._queue.get()
+                if request is None:
+                    return
+                self._commit(self._collect(request))
+
+    def _apply(self, connection, request):
+        result = connection.execute(
+            text(WRITE_STATEMENTS[request.op]), request.params)
+        if request.op == 'create' and result.rowcount == 0:
+            # 409 the title is taken
+            raise Conflict()
+        if result.rowcount == 0:
+            # The drink was deleted since the request read it
+            raise UnprocessableEntity()
+        if request.op in ('insert', 'create'):
+            return result.lastrowid
+        return request.params['id']
+
+    def _commit(self, batch):
+        outcomes = []
+        try:
+            with self.get_engine().begin() as connection:
+                for request in batch:
+                    try:
+                        outcomes.append((request, self._apply(
+                            connection, request), None))
+                    except IntegrityError as error:
+                        print(error)
+                        outcomes.append((request, None,
+                                         UnprocessableEntity()))
+                    except (Conflict, UnprocessableEntity) as error:
+                        outcomes.append((request, None, error))
+        except Exception as error:
+            print(error)
+            self.errors += 1
+            for request in batch:
+                request.future.set_exception(UnprocessableEntity())
+            return
+
+        self.commits += 1
+        self.writes += len(batch)
+        try:
+            self.committed([(request.op, id, request.params)
+                            for request, id, error in outcomes
+                            if error is None])
+        except Exception as error:
+            print(error)
+        for request, id, error in outcomes:
+            if error is not None:
+                request.future.set_exception(error)
+            elif request.op in ('insert', 'create'):
+                request.future.set_result(id)
+            else:
+                request.future.set_result(None)
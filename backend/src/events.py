@@ -0,0 +1,224 @@
+from collections import deque, namedtuple
+
+import threading
+import select
+import socket
+import queue
+import time
+
+
+# Events kept for Last-Event-ID resume
+EVENTS_HISTORY_SIZE = 1000
+# Events buffered per subscriber, a subscriber falling further behind is
+# dropped and has to reconnect (and resume)
+EVENTS_QUEUE_SIZE = 100
+# Seconds between two heartbeat frames of an idle stream
+EVENTS_HEARTBEAT = 15
+# Seconds between two checks of the client connection of an idle stream
+EVENTS_POLL = 1
+# Reconnection delay advised to the clients in milliseconds
+EVENTS_RETRY = 3000
+
+# A committed change of a drink, <short> and <long> are the json texts of
+# Drink.short() and Drink.long() (None for deletes)
+MenuEvent = namedtuple('MenuEvent', ['id', 'op', 'drink_id', 'short', 'long'])
+
+
+class Subscription:
+    """
+    Bounded queue of the events of one stream
+
+    - <backlog> holds the events missed since the Last-Event-ID of the
+    client, <resync> is True if they are no longer kept
+    - <dropped> is set by the hub when the queue overflows
+    """
+
+    def __init__(self, maxsize):
+        self.queue = queue.Queue(maxsize)
+        self.backlog = []
+        self.resync = False
+        self.dropped = False
+
+
+class EventHub:
+    """
+    In-process fan-out of the committed drink changes to the open streams
+
+    - Only the changes committed by this process are published, the
+    writes of other workers, of the ASGI app or of an import run in
+    another process are not (see /drinks/changes for all of them)
+    - publish never blocks, a subscriber whose queue is full is dropped
+    - The last <history_size> events are kept for Last-Event-ID resume
+    - Event ids are consecutive within the process, a restart resets them
+    and resuming clients are told to resync
+    """
+
+    def __init__(self, queue_size=EVENTS_QUEUE_SIZE,
+                 history_size=EVENTS_HISTORY_SIZE):
+        self.queue_size = queue_size
+        self.history = deque(maxlen=history_size)
+        self.last_id = 0
+        self.dropped = 0
+        self._subscribers = set()
+        self._lock = threading.Lock()
+
+    def publish(self, op, drink_id, short=None, long=None):
+        '''
+        Arguments:
+            - op: 'create', 'update' or 'delete'
+            - drink_id: id of the changed drink
+            - short, long: json texts of the drink representations
+
+        Returns:
+            - the published MenuEvent
+        '''
+        with self._lock:
+            self.last_id += 1
+            event = MenuEvent(self.last_id, op, drink_id, short, long)
+            self.history.append(event)
+            for subscription in list(self._subscribers):
+                try:
+                    subscription.queue.put_nowait(event)
+                except queue.Full:
+                    # Slow consumer, the stream ends after its queue
+                    subscription.dropped = True
+                    self._subscribers.discard(subscription)
+                    self.dropped += 1
+        return event
+
+    def subscribe(self, last_event_id=None):
+        '''
+        Arguments:
+            - last_event_id: id of the last event the client received
+
+        Returns:
+            - a Subscription receiving every event published from now on,
+            with the missed events after <last_event_id> as backlog
+        '''
+        subscription = Subscription(self.queue_size)
+        with self._lock:
+            if last_event_id is not None:
+                oldest = self.history[0].id if self.history else \
+                    self.last_id + 1
+                if last_event_id > self.last_id or \
+                        last_event_id < oldest - 1:
+                    subscription.resync = True
+                else:
+                    subscription.backlog = [
+                        event for event in self.history
+                        if event.id > last_event_id]
+            self._subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    def stats(self):
+        '''
+        Returns:
+            - dictionary with the subscriber, event and drop counters
+        '''
+        with self._lock:
+            return {
+                'subscribers': len(self._subscribers),
+                'last_id': self.last_id,
+                'dropped': self.dropped
+            }
+
+
+def format_event(event, representation):
+    '''
+    Arguments:
+        - event: MenuEvent
+        - representation: 'short' or 'long'
+
+    Returns:
+        - the server-sent event frame of <event>
+    '''
+    data = getattr(event, representation) or f'{{"id":{event.drink_id}}}'
+    return f'id: {event.id}\nevent: {event.op}\ndata: {data}\n\n'
+
+
+def connection_closed(environ):
+    '''
+    Arguments:
+        - environ: WSGI environment of the request
+
+    - Reads the client socket the server exposes (werkzeug.socket or
+    gunicorn.socket) without consuming it: a readable socket with nothing
+    to read was closed by the client
+    - Always False if the server does not expose its socket or it cannot
+    be peeked (i.e. TLS)
+
+    Returns:
+        - function telling whether the client closed the connection
+    '''
+    connection = environ.get('werkzeug.socket') or \
+        environ.get('gunicorn.socket')
+    if connection is None:
+        return lambda: False
+
+    def closed():
+        try:
+            readable, _, _ = select.select([connection], [], [], 0)
+            return bool(readable) and \
+                not connection.recv(1, socket.MSG_PEEK)
+        except ValueError:
+            return False
+        except OSError:
+            return True
+    return closed
+
+
+def stream_events(hub, subscription, representation,
+                  heartbeat=EVENTS_HEARTBEAT, closed=None, poll=EVENTS_POLL):
+    '''
+    Arguments:
+        - hub: EventHub the subscription belongs to
+        - subscription: Subscription of the stream
+        - representation: 'short' or 'long'
+        - heartbeat: seconds between two heartbeat frames of an idle stream
+        - closed: optional function telling whether the client is gone,
+        see connection_closed
+        - poll: seconds between two calls of <closed> while waiting
+
+    - Starts with the missed events, or a resync event if they are no
+    longer kept, then follows the live events
+    - Ends when the subscription was dropped and its queue is drained, or
+    when the client closed the connection, noticed while waiting instead
+    of at the next heartbeat write
+
+    Returns:
+        - generator of server-sent event frames
+    '''
+    try:
+        yield f'retry: {EVENTS_RETRY}\n\n'
+        if subscription.resync:
+            yield f'id: {hub.last_id}\nevent: resync\ndata: {{}}\n\n'
+        for event in subscription.backlog:
+            yield format_event(event, representation)
+        subscription.backlog = []
+
+        deadline = time.monotonic() + heartbeat
+        while True:
+            wait = deadline - time.monotonic()
+            if closed is not None:
+                wait = min(wait, poll)
+            try:
+                event = subscription.queue.get(timeout=max(wait, 0))
+            except queue.Empty:
+                if subscription.dropped or \
+                        (closed is not None and closed()):
+                    return
+                if time.monotonic() >= deadline:
+                    deadline = time.monotonic() + heartbeat
+                    yield ': heartbeat\n\n'
+                continue
+            deadline = time.monotonic() + heartbeat
+            yield format_event(event, representation)
+    finally:
+        hub.unsubscribe(subscription)
+
+
+menu_events = EventHub()
@@ -0,0 +1,144 @@
+from flask import abort, current_app, g, make_response, request
+from .cache.cache import TTLCache
+from collections import namedtuple
+from functools import wraps
+
+import hashlib
+import base64
+import json
+import time
+
+
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+# Completed responses are replayed for 24 hours
+IDEMPOTENCY_TTL = 24 * 60 * 60
+IDEMPOTENCY_MAX_KEYS = 10000
+IDEMPOTENCY_MAX_KEY_LENGTH = 255
+# Key prefix of the responses in the shared store
+IDEMPOTENCY_DOCUMENT = 'idempotency '
+
+# Completed response of a request, <fingerprint> is the digest of its body
+StoredResponse = namedtuple(
+    'StoredResponse', ['fingerprint', 'body', 'status', 'content_type'])
+
+idempotency_store = TTLCache(maxsize=IDEMPOTENCY_MAX_KEYS,
+                             ttl=IDEMPOTENCY_TTL)
+
+
+def load_shared(store, key):
+    '''
+    Arguments:
+        - store: the SharedStore of the app
+        - key: document key of the response
+
+    Returns:
+        - the StoredResponse another worker of the host stored less than
+        IDEMPOTENCY_TTL seconds ago, or None
+    '''
+    found = store.get_document(key)
+    if found is None:
+        return None
+    document, stored_at = found
+    if time.time() - stored_at >= IDEMPOTENCY_TTL:
+        return None
+    return StoredResponse(bytes.fromhex(document['fingerprint']),
+                          base64.b64decode(document['body']),
+                          document['status'], document['content_type'])
+
+
+def store_shared(store, key, stored):
+    '''
+    Arguments:
+        - store: the SharedStore of the app
+        - key: document key of the response
+        - stored: the StoredResponse, expired ones are deleted
+    '''
+    store.set_document(key, {
+        'fingerprint': stored.fingerprint.hex(),
+        'body': base64.b64encode(stored.body).decode(),
+        'status': stored.status,
+        'content_type': stored.content_type
+    })
+    store.delete_documents(IDEMPOTENCY_DOCUMENT,
+                           time.time() - IDEMPOTENCY_TTL)
+
+
+class ErrorResponse(Exception):
+    """Carries an error response of the view out of the store unstored"""
+
+    def __init__(self, response):
+        self.response = response
+
+
+def idempotent(func):
+    '''
+    Arguments:
+        - func: view function of a non idempotent route (i.e. POST)
+
+    - Requests without the Idempotency-Key header are passed through
+    - Keys are scoped to the user (token "sub" claim), method and path
+    - The first request with a key runs the view, its successful response
+    is stored and replayed to every retry with the same key without
+    running the view again, concurrent retries wait for the first one
+    - The responses are kept in the shared store of the host as well
+    (app.extensions['shared_store']), a retry served by another worker
+    is replayed too; concurrent retries are only serialized within a
+    process, and without the shared store (or while it is busy) the
+    guarantee holds per process
+    - Error responses are not stored, a retry runs the view again
+    - Responds with a 400 error if the key is empty or too long and with a
+    422 error if a retry sends a different body than the first request
+    - Place it after requires_auth, the claims identify the user
+
+    Returns:
+        - the decorated view function
+    '''
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get(IDEMPOTENCY_HEADER)
+        if key is None:
+            return func(*args, **kwargs)
+
+        if not key or len(key) > IDEMPOTENCY_MAX_KEY_LENGTH:
+            abort(400)
+
+        claims = g.get('claims') or {}
+        store_key = (claims.get('sub'), request.method, request.path, key)
+        fingerprint = hashlib.sha256(request.get_data()).digest()
+        shared = current_app.extensions.get('shared_store')
+        shared_key = IDEMPOTENCY_DOCUMENT + json.dumps(store_key)
+        replayed = True
+
+        def run():
+            nonlocal replayed
+            if shared is not None:
+                stored = load_shared(shared, shared_key)
+                if stored is not None:
+                    return stored
+            replayed = False
+            response = make_response(func(*args, **kwargs))
+            if response.status_code >= 400:
+                raise ErrorResponse(response)
+            stored = StoredResponse(fingerprint, response.get_data(),
+                                    response.status_code,
+                                    response.content_type)
+            if shared is not None:
+                store_shared(shared, shared_key, stored)
+            return stored
+
+        try:
+            stored = idempotency_store.get_or_load(store_key, run)
+        except ErrorResponse as error:
+            return error.response
+
+        # 422 the key was used for a different request
+        if stored.fingerprint != fingerprint:
+            abort(422)
+
+        response = current_app.response_class(
+            stored.body, status=stored.status,
+            content_type=stored.content_type)
+        if replayed:
+            response.headers['Idempotent-Replayed'] = 'true'
+        return response
+    return wrapper
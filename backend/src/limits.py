@@ -0,0 +1,236 @@
+from flask import current_app, g, request
+from werkzeug.exceptions import TooManyRequests, ServiceUnavailable
+from werkzeug.middleware.proxy_fix import ProxyFix
+from collections import OrderedDict
+
+import threading
+import math
+import time
+
+
+# (requests per second, burst) of every client by the permission of the
+# route, '' for the public routes (keyed by client IP instead of "sub").
+# The public routes are not limited by default: behind a proxy or a NAT
+# every client would share the bucket of one address, see TRUSTED_PROXIES
+RATE_LIMITS = {
+    'get:drinks-detail': (10, 20),
+    'post:drinks': (2, 10),
+    'patch:drinks': (2, 10),
+    'delete:drinks': (2, 10),
+}
+# Clients tracked per limit, the least recently seen one is forgotten (it
+# starts over with a full bucket)
+RATE_LIMIT_MAX_CLIENTS = 10000
+# Requests served at once, requests waiting for a slot and how long they
+# wait in seconds, anything beyond is shed with a 503
+MAX_IN_FLIGHT = 32
+MAX_QUEUED = 64
+QUEUE_TIMEOUT = 1.0
+# Retry-After of a shed request in seconds
+OVERLOAD_RETRY_AFTER = 1
+
+# --------------------------------------------------------------------------- #
+# Token buckets
+# --------------------------------------------------------------------------- #
+
+
+class TokenBucketLimiter:
+    """
+    Token bucket per client key
+
+    - Every client gets <burst> tokens refilled at <rate> tokens per
+    second, a request takes one token
+    - A check is a dictionary lookup and some arithmetic under a lock, the
+    buckets are refilled lazily when their client is seen again
+    - At most <maxsize> buckets are kept, the least recently used is evicted
+    """
+
+    def __init__(self, rate, burst, maxsize=RATE_LIMIT_MAX_CLIENTS):
+        self.rate = rate
+        self.burst = burst
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def acquire(self, key, now=None):
+        '''
+        Arguments:
+            - key: client key (i.e. the "sub" claim or the IP address)
+            - now: monotonic time, defaults to time.monotonic()
+
+        Returns:
+            - 0 if the request is admitted, otherwise the seconds until the
+            client gets a token again
+        '''
+        if now is None:
+            now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                tokens = self.burst
+            else:
+                tokens = min(self.burst,
+                             bucket[0] + (now - bucket[1]) * self.rate)
+            wait = 0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / self.rate
+            self._buckets[key] = (tokens, now)
+            self._buckets.move_to_end(key)
+            if len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+            return wait
+
+    def __len__(self):
+        return len(self._buckets)
+
+# --------------------------------------------------------------------------- #
+# Load shedding
+# --------------------------------------------------------------------------- #
+
+
+class AdmissionGate:
+    """
+    Bounds the requests served at once
+
+    - Up to <max_in_flight> requests are served, up to <max_queued> more
+    wait at most <timeout> seconds for a slot
+    - Anything else is rejected at once, the latency does not pile up
+    """
+
+    def __init__(self, max_in_flight=MAX_IN_FLIGHT, max_queued=MAX_QUEUED,
+                 timeout=QUEUE_TIMEOUT):
+        self.max_in_flight = max_in_flight
+        self.max_queued = max_queued
+        self.timeout = timeout
+        self.in_flight = 0
+        self.queued = 0
+        self._condition = threading.Condition()
+
+    def enter(self):
+        '''
+        Returns:
+            - True if the request got a slot, call leave() when it is done
+        '''
+        with self._condition:
+            if self.in_flight < self.max_in_flight:
+                self.in_flight += 1
+                return True
+            if self.queued >= self.max_queued:
+                return False
+            self.queued += 1
+            try:
+                admitted = self._condition.wait_for(
+                    lambda: self.in_flight < self.max_in_flight,
+                    self.timeout)
+            finally:
+                self.queued -= 1
+            if admitted:
+                self.in_flight += 1
+            return admitted
+
+    def leave(self):
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify()
+
+# --------------------------------------------------------------------------- #
+# Flask integration
+# --------------------------------------------------------------------------- #
+
+
+class Limits:
+    """
+    Admission control state of an application: a TokenBucketLimiter per
+    permission of <rate_limits> and the AdmissionGate
+    """
+
+    def __init__(self, rate_limits=RATE_LIMITS, max_in_flight=MAX_IN_FLIGHT,
+                 max_queued=MAX_QUEUED, timeout=QUEUE_TIMEOUT,
+                 max_clients=RATE_LIMIT_MAX_CLIENTS):
+        self.limiters = {
+            permission: TokenBucketLimiter(rate, burst, max_clients)
+            for permission, (rate, burst) in rate_limits.items()}
+        self.gate = AdmissionGate(max_in_flight, max_queued, timeout)
+        self.rate_limited = 0
+        self.shed = 0
+
+
+def current_limits():
+    limits = current_app.extensions.get('limits')
+    if limits is None or not current_app.config['RATE_LIMIT_ENABLED']:
+        return None
+    return limits
+
+
+def check_rate_limit(permission, key):
+    '''
+    Arguments:
+        - permission: permission of the route, '' for a public route
+        - key: client key (i.e. the "sub" claim or the IP address)
+
+    - Permissions without a configured limit are not limited
+
+    Raises:
+        - TooManyRequests (429) with the Retry-After seconds if the client
+        has no token left
+    '''
+    limits = current_limits()
+    limiter = limits.limiters.get(permission) if limits else None
+    if limiter is None:
+        return
+    wait = limiter.acquire(key)
+    if wait:
+        limits.rate_limited += 1
+        raise TooManyRequests(retry_after=max(1, math.ceil(wait)))
+
+
+def setup_limits(app, exempt=('metrics',)):
+    '''
+    Arguments:
+        - app: flask application
+        - exempt: endpoints never limited (i.e. the metrics scrapes)
+
+    - Every request takes a slot of the AdmissionGate, a shed request gets
+    a 503 error with Retry-After
+    - The public routes are rate limited by client IP here if RATE_LIMITS
+    has a '' limit, the routes behind requires_auth by the "sub" claim of
+    the token once it is verified, see auth.requires_auth
+    - With TRUSTED_PROXIES set to the number of reverse proxies in front
+    of the app, the client IP is read from X-Forwarded-For (ProxyFix),
+    otherwise it is the address of the peer
+    - Configured by RATE_LIMITS (merged over the defaults), MAX_IN_FLIGHT,
+    MAX_QUEUED and QUEUE_TIMEOUT, RATE_LIMIT_ENABLED turns it off
+    '''
+    app.config.setdefault('RATE_LIMIT_ENABLED', True)
+    app.config.setdefault('TRUSTED_PROXIES', 0)
+    if app.config['TRUSTED_PROXIES']:
+        app.wsgi_app = ProxyFix(app.wsgi_app,
+                                x_for=app.config['TRUSTED_PROXIES'])
+    app.extensions['limits'] = Limits(
+        dict(RATE_LIMITS, **app.config.get('RATE_LIMITS', {})),
+        app.config.get('MAX_IN_FLIGHT', MAX_IN_FLIGHT),
+        app.config.get('MAX_QUEUED', MAX_QUEUED),
+        app.config.get('QUEUE_TIMEOUT', QUEUE_TIMEOUT))
+
+    @app.before_request
+    def admit_request():
+        limits = current_limits()
+        if limits is None or request.endpoint in exempt:
+            return
+        if not limits.gate.enter():
+            limits.shed += 1
+            raise ServiceUnavailable(retry_after=OVERLOAD_RETRY_AFTER)
+        g.admitted = limits.gate
+
+        view = app.view_functions.get(request.endpoint)
+        if view is not None and \
+                getattr(view, 'required_permission', None) is None:
+            check_rate_limit('', request.remote_addr)
+
+    @app.teardown_request
+    def release_request(error):
+        gate = g.pop('admitted', None)
+        if gate is not None:
+            gate.leave()
@@ -0,0 +1,376 @@
+from flask import g, has_request_context, request
+from contextlib import contextmanager
+from sqlalchemy.engine import Engine
+from sqlalchemy import event
+from functools import wraps
+from bisect import bisect_left
+
+import threading
+import time
+
+
+# Upper bounds of the latency histogram buckets in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1, 2.5, 5, 10)
+# Upper bounds of the queries per request histogram buckets
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# --------------------------------------------------------------------------- #
+# Metric types
+# --------------------------------------------------------------------------- #
+
+
+def format_labels(names, values):
+    '''
+    Returns:
+        - the {name="value",...} label set of a sample in the text format
+    '''
+    if not names:
+        return ''
+    pairs = (
+        '{}="{}"'.format(name, str(value).replace('\\', r'\\').replace(
+            '"', r'\"').replace('\n', r'\n'))
+        for name, value in zip(names, values))
+    return '{' + ','.join(pairs) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """
+    Monotonically increasing value per label set
+    """
+
+    type = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels):
+        return self._values.get(labels, 0)
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            yield self.name, self.labelnames, labels, value
+
+
+class CallbackMetric:
+    """
+    Counter or gauge read from <callback> at collection time, for values
+    other components already keep. The callback returns a dictionary of
+    label values tuple -> value.
+    """
+
+    def __init__(self, name, documentation, type='gauge', labelnames=(),
+                 callback=dict):
+        self.name = name
+        self.documentation = documentation
+        self.type = type
+        self.labelnames = tuple(labelnames)
+        self.callback = callback
+
+    def samples(self):
+        for labels, value in sorted(self.callback().items()):
+            yield self.name, self.labelnames, labels, value
+
+
+class Histogram:
+    """
+    Observations counted in cumulative buckets per label set
+
+    - Every observation is a bisect and two additions under a lock, the
+    buckets are only accumulated when collected
+    """
+
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(labels)
+            if series is None:
+                # [per bucket counts (last one is +Inf), sum]
+                series = self._values[labels] = [
+                    [0] * (len(self.buckets) + 1), 0]
+            series[0][index] += 1
+            series[1] += value
+
+    def count(self, *labels):
+        series = self._values.get(labels)
+        return sum(series[0]) if series else 0
+
+    def samples(self):
+        with self._lock:
+            values = sorted((labels, (list(counts), total))
+                            for labels, (counts, total) in
+                            self._values.items())
+        names = self.labelnames + ('le',)
+        for labels, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                yield (f'{self.name}_bucket', names,
+                       labels + (format_value(bound),), cumulative)
+            yield f'{self.name}_sum', self.labelnames, labels, total
+            yield f'{self.name}_count', self.labelnames, labels, cumulative
+
+
+class Registry:
+    """
+    Collection of metrics rendered in the Prometheus text format
+    """
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        '''
+        Returns:
+            - the text exposition of all the registered metrics
+        '''
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            for name, labelnames, labels, value in metric.samples():
+                lines.append(f'{name}{format_labels(labelnames, labels)} '
+                             f'{format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+requests_total = registry.register(Counter(
+    'coffee_http_requests_total',
+    'HTTP requests by method, route and status code',
+    ('method', 'route', 'status')))
+
+request_duration = registry.register(Histogram(
+    'coffee_http_request_duration_seconds',
+    'HTTP request latency by method and route',
+    ('method', 'route')))
+
+phase_duration = registry.register(Histogram(
+    'coffee_http_request_phase_seconds',
+    'Time spent per request in the auth, validation, db and serialization '
+    'phases',
+    ('method', 'route', 'phase')))
+
+request_queries = registry.register(Histogram(
+    'coffee_db_queries_per_request',
+    'SQL statements executed per HTTP request',
+    ('method', 'route'), buckets=QUERY_COUNT_BUCKETS))
+
+query_duration = registry.register(Histogram(
+    'coffee_db_query_duration_seconds',
+    'SQL statement execution time'))
+
+# --------------------------------------------------------------------------- #
+# Request phases
+# --------------------------------------------------------------------------- #
+
+
+class RequestMetrics:
+    """
+    Per request accumulators, kept in flask.g.metrics
+    """
+
+    __slots__ = ('start', 'phases', 'queries', 'recorded')
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = {}
+        self.queries = 0
+        self.recorded = False
+
+    def add(self, phase, seconds):
+        self.phases[phase] = self.phases.get(phase, 0) + seconds
+
+
+def current_metrics():
+    '''
+    Returns:
+        - the RequestMetrics of the current request or None
+    '''
+    if not has_request_context():
+        return None
+    return g.get('metrics')
+
+
+@contextmanager
+def phase(name):
+    '''
+    Arguments:
+        - name: phase name (i.e. 'serialization')
+
+    - Adds the time spent in the block to the <name> phase of the current
+    request, a phase entered several times is summed up
+    '''
+    metrics = current_metrics()
+    if metrics is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.add(name, time.perf_counter() - start)
+
+
+def timed(name, decorator):
+    '''
+    Arguments:
+        - name: phase name (i.e. 'validation')
+        - decorator: view decorator to time (i.e. expects_json(schema))
+
+    - Only the work the decorator does before calling the view is added to
+    the <name> phase, the view itself is not
+
+    Returns:
+        - the decorator applying <decorator> with timing
+    '''
+    def timed_decorator(func):
+        @wraps(func)
+        def inner(*args, **kwargs):
+            metrics = current_metrics()
+            if metrics is not None:
+                metrics.add(name, time.perf_counter() - g.metrics_phase_start)
+                g.metrics_phase_start = None
+            return func(*args, **kwargs)
+
+        decorated = decorator(inner)
+
+        @wraps(func)
+        def outer(*args, **kwargs):
+            if current_metrics() is None:
+                return decorated(*args, **kwargs)
+            g.metrics_phase_start = start = time.perf_counter()
+            try:
+                return decorated(*args, **kwargs)
+            finally:
+                # The decorator rejected the request before the view
+                if g.metrics_phase_start is not None:
+                    g.metrics.add(name, time.perf_counter() - start)
+                    g.metrics_phase_start = None
+        return outer
+    return timed_decorator
+
+# --------------------------------------------------------------------------- #
+# Database events
+# --------------------------------------------------------------------------- #
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    conn.info.setdefault('metrics_query_start', []).append(
+        time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    starts = conn.info.get('metrics_query_start')
+    if not starts:
+        return
+    seconds = time.perf_counter() - starts.pop()
+    query_duration.observe(seconds)
+    metrics = current_metrics()
+    if metrics is not None:
+        metrics.queries += 1
+        metrics.add('db', seconds)
+
+
+def listen_engines():
+    '''
+    Times every SQL statement of every engine (the read-only engines
+    included)
+    '''
+    if not event.contains(Engine, 'before_cursor_execute',
+                          before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+
+# --------------------------------------------------------------------------- #
+# Flask integration
+# --------------------------------------------------------------------------- #
+
+
+def route_label():
+    # The url rule instead of the path keeps the label set bounded
+    rule = request.url_rule
+    return rule.rule if rule is not None else 'unmatched'
+
+
+def record(status):
+    metrics = g.metrics
+    metrics.recorded = True
+    method = request.method
+    route = route_label()
+    requests_total.inc(method, route, str(status))
+    request_duration.observe(time.perf_counter() - metrics.start,
+                             method, route)
+    request_queries.observe(metrics.queries, method, route)
+    for name, seconds in metrics.phases.items():
+        phase_duration.observe(seconds, method, route, name)
+
+
+def setup_metrics(app, path='/metrics'):
+    '''
+    Arguments:
+        - app: flask application
+        - path: address of the metrics endpoint
+
+    - Records the count, status code, latency, phase times and number of
+    SQL statements of every request
+    - Exposes the registry in the Prometheus text format on <path>
+    '''
+    listen_engines()
+
+    @app.before_request
+    def start_request_metrics():
+        g.metrics = RequestMetrics()
+
+    @app.after_request
+    def record_request_metrics(response):
+        if current_metrics() is not None:
+            record(response.status_code)
+        return response
+
+    @app.teardown_request
+    def record_failed_request_metrics(error):
+        metrics = current_metrics()
+        if metrics is not None and not metrics.recorded:
+            record(500)
+
+    @app.route(path)
+    def metrics():
+        return app.response_class(registry.render(),
+                                  content_type=CONTENT_TYPE)
@@ -0,0 +1,106 @@
+import base64
+import binascii
+import json
+
+
+DRINKS_PAGE_SIZE = 100
+DRINKS_MAX_PAGE_SIZE = 500
+
+
+def encode_cursor(drink_id):
+    '''
+    Arguments:
+        - drink_id: id of the last drink on the current page
+
+    Returns:
+        - opaque, url safe cursor string pointing after <drink_id>
+    '''
+    cursor = base64.urlsafe_b64encode(str(drink_id).encode())
+    return cursor.decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    '''
+    Arguments:
+        - cursor: string created by encode_cursor
+
+    - Raises a ValueError if the cursor is malformed
+
+    Returns:
+        - the drink id the next page starts after
+    '''
+    try:
+        padding = '=' * (-len(cursor) % 4)
+        drink_id = int(base64.urlsafe_b64decode(cursor + padding).decode())
+    except (binascii.Error, UnicodeDecodeError) as error:
+        raise ValueError('Malformed cursor') from error
+
+    if drink_id < 0:
+        raise ValueError('Malformed cursor')
+
+    return drink_id
+
+
+def parse_page_args(limit=None, cursor=None, unpaged=False):
+    '''
+    Arguments:
+        - limit: requested page size (string) or None for the default
+        - cursor: cursor string or None for the first page
+        - unpaged: True if a request without limit and cursor gets every
+        row, as the clients written before the pagination expect
+
+    - Raises a ValueError if any of them is malformed
+    - The limit is capped at DRINKS_MAX_PAGE_SIZE
+
+    Returns:
+        - (limit, after_id) tuple, limit is None for an unpaged request
+    '''
+    if unpaged and limit is None and not cursor:
+        return None, 0
+
+    limit = DRINKS_PAGE_SIZE if limit is None else int(limit)
+    if limit < 1:
+        raise ValueError('Invalid limit')
+
+    after_id = decode_cursor(cursor) if cursor else 0
+
+    return min(limit, DRINKS_MAX_PAGE_SIZE), after_id
+
+
+def encode_page(serializer, drinks, next_cursor):
+    '''
+    Arguments:
+        - serializer: Drink json method (Drink.short_json or
+        Drink.long_json)
+        - drinks: list of drink rows
+        - next_cursor: cursor of the next page or None
+
+    - Splices the stored json of the drinks into the body, no recipe is
+    decoded or encoded again
+
+    Returns:
+        - the {"drinks": [...], "next_cursor": cursor} body (bytes)
+    '''
+    drinks = ','.join(serializer(drink) for drink in drinks)
+    return (f'{{"drinks":[{drinks}],'
+            f'"next_cursor":{json.dumps(next_cursor)}}}\n').encode()
+
+
+def encode_changes(serializer, version, upserts, deleted, resync=False):
+    '''
+    Arguments:
+        - serializer: Drink json method (Drink.short_json or
+        Drink.long_json)
+        - version: current version of the change log
+        - upserts: list of the created or updated drink rows
+        - deleted: list of the deleted drink ids
+        - resync: True if the client has to fetch the whole menu
+
+    Returns:
+        - the {"deleted": ids, "drinks": [...], "resync": resync,
+        "version": version} body (bytes)
+    '''
+    drinks = ','.join(serializer(drink) for drink in upserts)
+    deleted = ','.join(str(drink_id) for drink_id in deleted)
+    return (f'{{"deleted":[{deleted}],"drinks":[{drinks}],'
+            f'"resync":{json.dumps(resync)},"version":{version}}}\n').encode()
@@ -0,0 +1,260 @@
+from .validation import compile_schema, validation_error
+
+
+# --------------------------------------------------------------------------- #
+# Validation schemas for payloads based on https://json-schema.org
+# --------------------------------------------------------------------------- #
+
+create_drinks_schema = {
+    'type': 'object',
+    'properties': {
+        'title': {'type': 'string'},
+        'recipe': {
+            'type': 'array',
+            'items': {
+                'type': 'object',
+                'properties': {
+                    'name': {'type': 'string'},
+                    'color': {'type': 'string'},
+                    'parts': {'type': 'number'}
+                },
+                'required': ['name', 'color', 'parts']
+            }
+        },
+    },
+    'required': ['title', 'recipe']
+}
+
+update_drinks_schema = {
+    'type': 'object',
+    'anyOf': [
+        {
+            'properties': {
+                'title': {'type': 'string'},
+            },
+            'required': ['title']
+        },
+        {
+            'properties': {
+                'recipe': {
+                    'type': 'array',
+                    'items': {
+                        'type': 'object',
+                        'properties': {
+                            'name': {'type': 'string'},
+                            'color': {'type': 'string'},
+                            'parts': {'type': 'number'}
+                        },
+                        'required': ['name', 'color', 'parts']
+                    }
+                },
+            },
+            'required': ['recipe']
+        }
+    ],
+}
+
+BATCH_MAX_OPERATIONS = 500
+
+batch_drinks_schema = {
+    'type': 'object',
+    'properties': {
+        'operations': {
+            'type': 'array',
+            'minItems': 1,
+            'maxItems': BATCH_MAX_OPERATIONS,
+            'items': {
+                'type': 'object',
+                'properties': {
+                    'op': {'enum': ['create', 'update', 'delete']},
+                    'id': {'type': 'integer'},
+                    'data': {'type': 'object'}
+                },
+                'required': ['op']
+            }
+        }
+    },
+    'required': ['operations']
+}
+
+# --------------------------------------------------------------------------- #
+# Fast paths, the drink schemas specialized by hand
+# --------------------------------------------------------------------------- #
+
+# Accept exactly the documents the schemas accept (json types: a bool is
+# not a number), the conformance is tested against jsonschema itself
+
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def is_valid_recipe(recipe):
+    '''
+    Returns:
+        - True if <recipe> is valid against the recipe property of
+        create_drinks_schema
+    '''
+    if not isinstance(recipe, list):
+        return False
+    for ingredient in recipe:
+        if not isinstance(ingredient, dict) or \
+                not isinstance(ingredient.get('name'), str) or \
+                not isinstance(ingredient.get('color'), str) or \
+                not is_number(ingredient.get('parts')):
+            return False
+    return True
+
+
+def is_valid_create(data):
+    '''
+    Returns:
+        - True if <data> is valid against create_drinks_schema
+    '''
+    return isinstance(data, dict) and \
+        isinstance(data.get('title'), str) and \
+        is_valid_recipe(data.get('recipe'))
+
+
+def is_valid_update(data):
+    '''
+    Returns:
+        - True if <data> is valid against update_drinks_schema: either
+        branch of the anyOf, the other property is not checked
+    '''
+    return isinstance(data, dict) and (
+        isinstance(data.get('title'), str) or
+        ('recipe' in data and is_valid_recipe(data['recipe'])))
+
+# --------------------------------------------------------------------------- #
+# Batch validation
+# --------------------------------------------------------------------------- #
+
+# Validators of the batch items, compiled once, and their fast paths
+batch_validators = {
+    'create': compile_schema(create_drinks_schema),
+    'update': compile_schema(update_drinks_schema)
+}
+batch_fast_checks = {
+    'create': is_valid_create,
+    'update': is_valid_update
+}
+
+batch_permissions = {
+    'create': 'post:drinks',
+    'update': 'patch:drinks',
+    'delete': 'delete:drinks'
+}
+
+
+def validate_batch(operations, results):
+    '''
+    Arguments:
+        - operations: list of batch operations
+        - results: list of per operation result dictionaries
+
+    - Validates the "data" of creates and updates against the schemas of
+    the single drink endpoints, updates and deletes require an "id"
+    - Marks the invalid operations in <results> with status 400
+
+    Returns:
+        - True if all operations are valid
+    '''
+    valid = True
+    for operation, result in zip(operations, results):
+        op = operation['op']
+        message = None
+
+        if op != 'create' and 'id' not in operation:
+            message = "'id' is a required property"
+        elif op != 'delete':
+            data = operation.get('data')
+            if data is None:
+                message = "'data' is a required property"
+            else:
+                error = validation_error(data, batch_validators[op],
+                                         batch_fast_checks[op])
+                if error is not None:
+                    message = error.message
+
+        if message:
+            result.update({'status': 400, 'message': message})
+            valid = False
+    return valid
+
+
+def batch_ids(operations):
+    '''
+    Returns:
+        - the drink ids of the updates and deletes in <operations>
+    '''
+    return [operation['id'] for operation in operations
+            if operation['op'] != 'create']
+
+
+def batch_titles(operations):
+    '''
+    Returns:
+        - the new titles of the creates and updates in <operations>
+    '''
+    return [operation['data']['title'] for operation in operations
+            if operation['op'] != 'delete' and 'title' in operation['data']]
+
+
+def check_batch_conflicts(operations, results, known_ids, existing):
+    '''
+    Arguments:
+        - operations: list of valid batch operations
+        - results: list of per operation result dictionaries
+        - known_ids: the ids of batch_ids(operations) which exist
+        - existing: dictionary of title -> id of the drinks which already
+        have one of the batch_titles(operations)
+
+    - Unknown ids are marked with status 404
+    - Titles which exist or repeat within the batch are marked with status
+    409, so are ids with more than one operation
+
+    Returns:
+        - True if there are no conflicts
+    '''
+    valid = True
+    seen_ids = set()
+    seen_titles = set()
+    for operation, result in zip(operations, results):
+        drink_id = operation.get('id')
+        title = operation.get('data', {}).get('title') \
+            if operation['op'] != 'delete' else None
+
+        if operation['op'] != 'create':
+            if drink_id not in known_ids:
+                result.update({'status': 404,
+                               'message': 'resource not found'})
+                valid = False
+                continue
+            if drink_id in seen_ids:
+                result.update({'status': 409,
+                               'message': 'conflicting operations'})
+                valid = False
+                continue
+            seen_ids.add(drink_id)
+
+        if title is not None:
+            if title in seen_titles or \
+                    existing.get(title, drink_id) != drink_id:
+                result.update({'status': 409,
+                               'message': 'resource already exists'})
+                valid = False
+                continue
+            seen_titles.add(title)
+
+    return valid
+
+
+def mark_not_applied(results):
+    '''
+    Marks the operations without an error of their own with status 424,
+    since nothing of a rejected batch is applied
+    '''
+    for result in results:
+        if 'status' not in result:
+            result.update({'status': 424, 'message': 'not applied'})
@@ -0,0 +1,79 @@
+from flask import abort, current_app, g, request
+from functools import wraps
+from jsonschema.validators import validator_for
+from jsonschema.exceptions import best_match
+
+
+# Largest json request body in bytes (MAX_CONTENT_LENGTH of the Flask app),
+# the body of the import route is streamed and not limited
+MAX_CONTENT_LENGTH = 1024 * 1024
+
+
+def compile_schema(schema):
+    '''
+    Arguments:
+        - schema: json schema
+
+    - The schema is checked once here instead of on every validation
+
+    Returns:
+        - the validator jsonschema.validate builds for <schema>
+    '''
+    cls = validator_for(schema)
+    cls.check_schema(schema)
+    return cls(schema)
+
+
+def validation_error(data, validator, fast_check=None):
+    '''
+    Arguments:
+        - data: decoded json document
+        - validator: compiled validator of the schema, see compile_schema
+        - fast_check: optional function telling if <data> is valid against
+        the schema, specialized for its shape (i.e. schemas.is_valid_create)
+
+    - A document the fast check accepts is not validated again, any other
+    is validated by <validator>, so the errors are the ones of the schema
+
+    Returns:
+        - the ValidationError jsonschema.validate raises or None
+    '''
+    if fast_check is not None and fast_check(data):
+        return None
+    return best_match(validator.iter_errors(data))
+
+
+def expects_json(schema, fast_check=None):
+    '''
+    Arguments:
+        - schema: json schema of the request body
+        - fast_check: optional fast path, see validation_error
+
+    - Drop-in for flask_expects_json.expects_json(schema) with the schema
+    compiled once: responds with 400 and the ValidationError as the
+    description for an invalid body, keeps the body in flask.g.data
+    - Responds with 413 for a body longer than MAX_CONTENT_LENGTH
+
+    Returns:
+        - the view decorator
+    '''
+    validator = compile_schema(schema)
+
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            limit = current_app.config.get('MAX_CONTENT_LENGTH')
+            if limit is not None and (request.content_length or 0) > limit:
+                return abort(413)
+            data = request.get_json()
+            if data is None:
+                return abort(400, 'Failed to decode JSON object')
+
+            error = validation_error(data, validator, fast_check)
+            if error is not None:
+                return abort(400, error)
+
+            g.data = data
+            return current_app.ensure_sync(f)(*args, **kwargs)
+        return decorated_function
+    return decorator
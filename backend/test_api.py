@@ -1,31 +1,106 @@
-from src.database.models import Drink, db
+from src.database.models import Drink, db, db_migrate, \
+    initialized_databases, create_drink_writer
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.engine import Engine
+from sqlalchemy import event, text
 from src.auth.auth import AuthError
 from flask_testing import TestCase
+from flask import g
 from unittest.mock import patch
 from functools import wraps
+from src.auth.local_keys import LocalSigner
+from src.auth.jwks import JWKSKeyManager
+from src.cache.cache import TTLCache, ResponseCache, timed_cache
+from src.cache.shared import SharedStore, SharedVersion, shared_cache_dir, \
+    open_shared_dir
+from src.metrics.metrics import Histogram, Registry, request_duration, \
+    phase_duration, request_queries
+from datetime import timedelta
 from src.auth import auth
+from src import compression
+from src.events import EventHub, stream_events, connection_closed
+from src.database import profiler as query_profiler
+from src.limits import TokenBucketLimiter, AdmissionGate, Limits
+from src.schemas import create_drinks_schema, update_drinks_schema, \
+    is_valid_create, is_valid_update, batch_validators
+from src.validation import compile_schema, validation_error, \
+    MAX_CONTENT_LENGTH
+from src.pagination import DRINKS_PAGE_SIZE
+from src.idempotency import idempotency_store, IDEMPOTENCY_DOCUMENT
+from jsonschema import ValidationError, validate
+from werkzeug.exceptions import Conflict, TooManyRequests
 
+import multiprocessing
+import random
+import threading
+import tempfile
+import shutil
+import sqlite3
+import socket
+import gzip
 import unittest
 import pathlib
+import json
+import time
 import os
 
 
+# Claims of the mocked authentication, grants every permission
+MOCK_CLAIMS = {
+    'sub': 'test|user',
+    'permissions': frozenset([
+        'get:drinks-detail', 'post:drinks', 'patch:drinks', 'delete:drinks'
+    ])
+}
+
+
 # Mock auth wrapper for testing app endpoint without authentication
 def mock_requires_auth(permission):
     """Mock authentication function for testing"""
     def requires_auth_decorator(func):
         @wraps(func)
         def wrapper(*args, **kwargs):
+            g.claims = MOCK_CLAIMS
             return func(*args, **kwargs)
+        wrapper.required_permission = permission
         return wrapper
     return requires_auth_decorator
 
 
+# Keep the real decorator for the auth module tests
+requires_auth = auth.requires_auth
+
+async def mock_authorize(request, permission):
+    """Mock authentication function of the ASGI app for testing"""
+    return MOCK_CLAIMS
+
+
+def flask_only(test):
+    """Marks test cases of Flask specific features"""
+    test.flask_only = True
+    return test
+
+
 # Replace the real authentication decorator with mock function
 patch('src.auth.auth.requires_auth', mock_requires_auth).start()
+patch('src.asgi.authorize', mock_authorize).start()
 
-# App must be imported after we mocked the authentication function
-from src.api import app
+# The routes must be imported after we mocked the authentication function
+from src.api import create_app
+from src.asgi import AsgiApp, create_asgi_app
+
+# The tests create and drop the tables themselves
+app = create_app({
+    'SQLALCHEMY_DATABASE_URI': 'sqlite:///{}'.format(os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        'src/database/test_database.db')),
+    'MENU_CACHE_ENABLED': False,
+    'EVENTS_HEARTBEAT': 0.01,
+    'DATABASE_INIT': False,
+    'RATE_LIMIT_ENABLED': False
+})
+menu_cache = app.extensions['menu_cache']
+claims_cache = app.extensions['claims_cache']
 
 
 class TestAuthModule(unittest.TestCase):
@@ -67,28 +142,587 @@ class TestAuthModule(unittest.TestCase):
             auth.check_permissions('get:drinks', payload)
         self.assertTrue(context.exception.status_code, 403)
 
+    def test_claims_cache(self):
+        cache = auth.ClaimsCache(maxsize=1)
+        payload = {'exp': time.time() + 60, 'permissions': ['get:drinks']}
+        self.assertIsNone(cache.get('token-1'))
+        cache.set('token-1', payload)
+        claims = cache.get('token-1')
+        self.assertEqual(claims['permissions'], frozenset(['get:drinks']))
+
+        # Least recently used entry is evicted above maxsize
+        cache.set('token-2', payload)
+        self.assertIsNone(cache.get('token-1'))
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_claims_cache_expired(self):
+        cache = auth.ClaimsCache()
+        cache.set('token', {'exp': time.time() - 1, 'permissions': []})
+        self.assertIsNone(cache.get('token'))
+
+    def test_requires_auth_claims_cache(self):
+        claims_cache.clear()
+        payload = {'exp': time.time() + 60, 'permissions': ['get:drinks']}
+        view = requires_auth('get:drinks')(lambda: 'ok')
+        headers = {'Authorization': 'Bearer <TOKEN>'}
+        with patch.object(auth, 'verify_jwt'), \
+                patch.object(auth, 'decode_token',
+                             return_value=payload) as decode_token:
+            for _ in range(2):
+                with app.test_request_context(headers=headers):
+                    self.assertEqual(view(), 'ok')
+        self.assertEqual(decode_token.call_count, 1)
+        self.assertEqual(claims_cache.stats()['hits'], 1)
+
+
+class TestCacheModule(unittest.TestCase):
+    def test_ttl_cache_expiry(self):
+        cache = TTLCache(maxsize=2, ttl=60)
+        cache.set('a', 1)
+        cache.set('b', 2, ttl=-1)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+
+        # Least recently used entry is evicted above maxsize
+        cache.set('c', 3)
+        cache.set('d', 4)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.stats()['size'], 2)
+
+    def test_shared_cache_across_processes(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        version = SharedVersion(os.path.join(directory.name, 'version'))
+        store = SharedStore(os.path.join(directory.name, 'cache.db'),
+                            open_shared_dir(directory.name))
+
+        # A bump of a forked worker is seen by the parent
+        process = multiprocessing.get_context('fork').Process(
+            target=version.bump)
+        process.start()
+        process.join(5)
+        self.assertEqual(version.value, 1)
+
+        # A response built by one worker is served by the other one
+        worker_1 = ResponseCache(store=store)
+        worker_2 = ResponseCache(store=store)
+        worker_1.set('/drinks', version.value, b'{"drinks":[]}')
+        entry = worker_2.get('/drinks', version.value)
+        self.assertEqual(entry.body, b'{"drinks":[]}')
+        self.assertEqual(worker_2.stats()['shared_hits'], 1)
+        self.assertIsNone(worker_2.get('/drinks', version.bump()))
+
+    def test_shared_dir_must_be_private(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        private = os.path.join(directory.name, 'private')
+        secret = open_shared_dir(private)
+        self.assertEqual(len(secret), 32)
+        self.assertEqual(open_shared_dir(private), secret)
+        self.assertEqual(os.stat(private).st_mode & 0o777, 0o700)
+
+        # Open to the others, or a symlink planted in place of the directory
+        shared = os.path.join(directory.name, 'shared')
+        os.mkdir(shared)
+        os.chmod(shared, 0o733)
+        self.assertIsNone(open_shared_dir(shared))
+        link = os.path.join(directory.name, 'link')
+        os.symlink(private, link)
+        self.assertIsNone(open_shared_dir(link))
+
+    def test_shared_store_rejects_unsigned_values(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, 'cache.db')
+        store = SharedStore(path, open_shared_dir(directory.name))
+        store.set_document('jwks url', {'keys': []}, 100.0)
+        self.assertEqual(store.get_document('jwks url'),
+                         ({'keys': []}, 100.0))
+        store.set_response('/drinks', 1, b'{}')
+        self.assertEqual(store.get_response('/drinks', 1), b'{}')
+
+        # Values written without the secret of the directory are misses
+        forged = SharedStore(path, b'x' * 32)
+        forged.set_document('jwks url', {'keys': [{'kid': 'forged'}]})
+        forged.set_response('/drinks', 2, b'{"drinks":[]}')
+        self.assertIsNone(store.get_document('jwks url'))
+        self.assertIsNone(store.get_response('/drinks', 2))
+        with sqlite3.connect(path) as connection:
+            connection.execute("UPDATE document SET value = '{\"keys\":[]}'")
+        self.assertIsNone(store.get_document('jwks url'))
+        self.assertEqual(store.errors, 3)
+
+    def test_timed_cache_single_flight(self):
+        calls = []
+        started = threading.Event()
+        release = threading.Event()
+
+        @timed_cache(minutes=1)
+        def load(key):
+            calls.append(key)
+            started.set()
+            release.wait(5)
+            return key.upper()
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(load('a')))
+                   for _ in range(4)]
+        threads[0].start()
+        started.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(calls, ['a'])
+        self.assertEqual(results, ['A'] * 4)
+        self.assertEqual(load.cache_info()['loads'], 1)
+
+    def test_timed_cache_stale_while_revalidate(self):
+        values = iter([1, 2])
+        reloaded = threading.Event()
+
+        @timed_cache(seconds=-1, stale_while_revalidate=timedelta(minutes=1))
+        def load():
+            try:
+                return next(values)
+            finally:
+                reloaded.set()
+
+        self.assertEqual(load(), 1)
+        reloaded.clear()
+        # Expired entry is served while it is reloaded in the background
+        self.assertEqual(load(), 1)
+        reloaded.wait(5)
+        self.assertEqual(load.cache_info()['stale_hits'], 1)
+
+
+class TestMetricsModule(unittest.TestCase):
+    def test_histogram_render(self):
+        registry = Registry()
+        histogram = registry.register(Histogram(
+            'test_seconds', 'Test latency', ('route',), buckets=(0.1, 1)))
+        histogram.observe(0.05, '/a')
+        histogram.observe(0.5, '/a')
+        histogram.observe(5, '/a')
+
+        lines = registry.render().splitlines()
+        self.assertEqual(lines[:2], ['# HELP test_seconds Test latency',
+                                     '# TYPE test_seconds histogram'])
+        self.assertIn('test_seconds_bucket{route="/a",le="0.1"} 1', lines)
+        self.assertIn('test_seconds_bucket{route="/a",le="1"} 2', lines)
+        self.assertIn('test_seconds_bucket{route="/a",le="+Inf"} 3', lines)
+        self.assertIn('test_seconds_sum{route="/a"} 5.55', lines)
+        self.assertIn('test_seconds_count{route="/a"} 3', lines)
+
+
+class TestEventHub(unittest.TestCase):
+    def test_slow_subscriber_dropped(self):
+        hub = EventHub(queue_size=1)
+        subscription = hub.subscribe()
+        hub.publish('delete', 1)
+        hub.publish('delete', 2)
+        self.assertTrue(subscription.dropped)
+        self.assertEqual(hub.stats(), {'subscribers': 0, 'last_id': 2,
+                                       'dropped': 1})
+
+        # The queued events are delivered, then the stream ends
+        frames = list(stream_events(hub, subscription, 'short', 0.01))
+        self.assertEqual(frames[1], 'id: 1\nevent: delete\n'
+                                    'data: {"id":1}\n\n')
+        self.assertEqual(len(frames), 2)
+
+    def test_closed_connection_ends_stream(self):
+        server, client = socket.socketpair()
+        self.addCleanup(server.close)
+        closed = connection_closed({'werkzeug.socket': server})
+        self.assertFalse(closed())
+        # Pipelined bytes are not a close
+        client.send(b'GET')
+        self.assertFalse(closed())
+        server.recv(3)
+        client.close()
+        self.assertTrue(closed())
+
+        # The idle stream ends before its first heartbeat
+        hub = EventHub()
+        subscription = hub.subscribe()
+        frames = list(stream_events(hub, subscription, 'short', 60, closed,
+                                    poll=0.01))
+        self.assertEqual(frames, ['retry: 3000\n\n'])
+        self.assertEqual(hub.stats()['subscribers'], 0)
+
+    def test_last_event_id_resume(self):
+        hub = EventHub(history_size=2)
+        for id in range(1, 4):
+            hub.publish('update', id, f'{{"id":{id}}}')
+        self.assertEqual([event.id for event in hub.subscribe(1).backlog],
+                         [2, 3])
+        self.assertEqual(hub.subscribe(3).backlog, [])
+        # Older than the history or unknown to the process
+        self.assertTrue(hub.subscribe(0).resync)
+        self.assertTrue(hub.subscribe(10).resync)
+
+
+class TestLimits(unittest.TestCase):
+    def test_token_bucket(self):
+        limiter = TokenBucketLimiter(rate=2, burst=2, maxsize=2)
+        self.assertEqual(limiter.acquire('a', now=0), 0)
+        self.assertEqual(limiter.acquire('a', now=0), 0)
+        self.assertEqual(limiter.acquire('a', now=0), 0.5)
+        # Refilled at the rate, other clients have their own bucket
+        self.assertEqual(limiter.acquire('a', now=0.5), 0)
+        self.assertEqual(limiter.acquire('b', now=0.5), 0)
+
+        # The least recently seen client is evicted
+        limiter.acquire('c', now=0.5)
+        self.assertEqual(len(limiter), 2)
+        self.assertEqual(limiter.acquire('a', now=0.5), 0)
+
+    def test_admission_gate(self):
+        gate = AdmissionGate(max_in_flight=1, max_queued=1, timeout=5)
+        self.assertTrue(gate.enter())
+        # Queued until the slot is free
+        waiter = threading.Thread(target=lambda: self.assertTrue(gate.enter()))
+        waiter.start()
+        while not gate.queued:
+            time.sleep(0.001)
+        # Beyond the queue depth
+        self.assertFalse(gate.enter())
+        gate.leave()
+        waiter.join()
+        self.assertEqual((gate.in_flight, gate.queued), (1, 0))
+
+        gate.timeout = 0.01
+        self.assertFalse(gate.enter())
+
+    def test_public_limit_by_forwarded_address(self):
+        # Off by default, every client of a proxy would share one bucket
+        self.assertNotIn('', Limits().limiters)
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        factory_app = create_app({
+            'SQLALCHEMY_DATABASE_URI':
+                f'sqlite:///{directory.name}/limits.db',
+            'RATE_LIMITS': {'': (1, 1)},
+            'TRUSTED_PROXIES': 1
+        })
+        client = factory_app.test_client()
+        statuses = [client.get('/drinks', headers={
+            'X-Forwarded-For': address}).status_code
+            for address in ('10.0.0.1', '10.0.0.2', '10.0.0.1')]
+        self.assertEqual(statuses, [200, 200, 429])
+
+
+# Values of every json type, the near misses of the drink schemas included
+JSON_VALUES = (None, True, False, 0, 1, -2.5, float('inf'), '', 'water',
+               [], {}, [1], {'name': 'water'})
+
+
+def random_value(rng):
+    return rng.choice(JSON_VALUES)
+
+
+def random_ingredient(rng):
+    if rng.random() < 0.1:
+        return random_value(rng)
+    ingredient = {}
+    for key, valid in (('name', 'water'), ('color', 'blue'), ('parts', 1)):
+        if rng.random() < 0.9:
+            ingredient[key] = valid if rng.random() < 0.8 else \
+                random_value(rng)
+    if rng.random() < 0.1:
+        ingredient['extra'] = random_value(rng)
+    return ingredient
+
+
+def random_drink(rng):
+    if rng.random() < 0.05:
+        return random_value(rng)
+    drink = {}
+    if rng.random() < 0.7:
+        drink['title'] = 'Water' if rng.random() < 0.7 else \
+            random_value(rng)
+    if rng.random() < 0.7:
+        drink['recipe'] = [random_ingredient(rng) for _ in range(
+            rng.randrange(4))] if rng.random() < 0.9 else random_value(rng)
+    if rng.random() < 0.1:
+        drink['extra'] = random_value(rng)
+    return drink
+
+
+class TestValidation(unittest.TestCase):
+    def test_fast_path_conformance(self):
+        rng = random.Random(0)
+        documents = [random_drink(rng) for _ in range(5000)]
+        for schema, fast_check in ((create_drinks_schema, is_valid_create),
+                                   (update_drinks_schema, is_valid_update)):
+            validator = compile_schema(schema)
+            accepted = 0
+            for document in documents:
+                self.assertEqual(fast_check(document),
+                                 validator.is_valid(document), document)
+                accepted += fast_check(document)
+            # Both outcomes are well covered
+            self.assertTrue(500 < accepted < 4500, accepted)
+
+    def test_error_messages(self):
+        validator = compile_schema(update_drinks_schema)
+        for document in ({'title': 1}, {'recipe': [{'name': 'water'}]}, []):
+            with self.assertRaises(ValidationError) as context:
+                validate(document, update_drinks_schema)
+            error = validation_error(document, validator, is_valid_update)
+            self.assertEqual(error.message, context.exception.message)
+
+    def test_one_draft(self):
+        # The batch items are validated under the draft of the request body
+        for op, schema in (('create', create_drinks_schema),
+                           ('update', update_drinks_schema)):
+            self.assertIs(type(batch_validators[op]),
+                          type(compile_schema(schema)))
+
+
+class TestQueryProfiler(unittest.TestCase):
+    def test_repeated_statements(self):
+        lines = []
+        profiler = query_profiler.QueryProfiler(
+            enabled=True, slow_query=0, repeated=3, log=lines.append)
+        with patch.dict(app.extensions, {'query_profiler': profiler}), \
+                app.test_request_context('/drinks'):
+            app.preprocess_request()
+            for name in ('drink', 'drink', 'drink_fts'):
+                db.session.execute(
+                    text('SELECT name FROM sqlite_master WHERE name = :name'),
+                    {'name': name})
+            app.do_teardown_request()
+
+        record = json.loads(lines[0])
+        self.assertEqual(record['reasons'], ['slow_query',
+                                             'repeated_statements'])
+        self.assertEqual((record['route'], record['statements']),
+                         ('/drinks', 3))
+        self.assertEqual(record['repeated'][0]['count'], 3)
+        self.assertEqual(record['slow_queries'][2]['parameters'],
+                         "('drink_fts',)")
+        self.assertIn('sqlite_master', record['slow_queries'][0]['plan'][0])
+
+    def test_toggle_file(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, 'profile')
+        profiler = query_profiler.QueryProfiler(toggle_file=path)
+        with patch.object(query_profiler, 'TOGGLE_CHECK_INTERVAL', 0):
+            self.assertFalse(profiler.active)
+            open(path, 'w').close()
+            self.assertTrue(profiler.active)
+
+
+class TestJWKSKeyManager(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.signer = LocalSigner(bits=1024)
+        cls.directory = tempfile.TemporaryDirectory()
+        cls.jwks_path = os.path.join(cls.directory.name, 'jwks.json')
+        cls.signer.write_jwks(cls.jwks_path)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.directory.cleanup()
+
+    def setUp(self):
+        self.manager = JWKSKeyManager(path=self.jwks_path)
+
+    def tearDown(self):
+        self.manager.stop()
+
+    def test_get_key(self):
+        self.assertTrue(self.manager.get_key(self.signer.kid))
+        self.assertIsNone(self.manager.get_key('unknown'))
+
+    def test_unknown_kid_fetch_rate_limited(self):
+        self.manager.get_key(self.signer.kid)
+        with patch.object(self.manager, 'fetch') as fetch:
+            self.manager.get_key('unknown')
+            self.manager.get_key('unknown')
+        self.assertEqual(fetch.call_count, 0)
+
+        self.manager.min_fetch_interval = 0
+        with patch.object(self.manager, 'fetch',
+                          return_value=self.signer.jwks()) as fetch:
+            self.manager.get_key('unknown')
+        self.assertEqual(fetch.call_count, 1)
+
+    def test_shared_jwks_fetched_once(self):
+        store = SharedStore(os.path.join(self.directory.name, 'cache.db'),
+                            os.urandom(32))
+        managers = [JWKSKeyManager(url='https://example.invalid/jwks.json',
+                                   store=store) for _ in range(2)]
+        with patch('src.auth.jwks.fetch_jwks',
+                   return_value=self.signer.jwks()) as fetch_jwks:
+            for manager in managers:
+                self.assertTrue(manager.refresh())
+        self.assertEqual(fetch_jwks.call_count, 1)
+        self.assertTrue(managers[1].keys[self.signer.kid])
+
+    def test_failed_refresh_keeps_keys(self):
+        self.manager.get_key(self.signer.kid)
+        with patch.object(self.manager, 'fetch', side_effect=OSError):
+            self.assertFalse(self.manager.refresh())
+        self.assertTrue(self.manager.get_key(self.signer.kid))
+
+    def test_empty_jwks_keeps_keys(self):
+        self.manager.get_key(self.signer.kid)
+        errors = self.manager.fetch_errors
+        for document in ({}, {'keys': []}, [], {'keys': [{'kid': 'k'}]}):
+            with patch.object(self.manager, 'fetch', return_value=document):
+                self.assertFalse(self.manager.refresh())
+        self.assertEqual(self.manager.fetch_errors, errors + 4)
+
+        # An empty remote document is not shared with the other workers
+        store = SharedStore(os.path.join(self.directory.name, 'empty.db'),
+                            os.urandom(32))
+        manager = JWKSKeyManager(url='https://example.invalid/jwks.json',
+                                 store=store)
+        with patch('src.auth.jwks.fetch_jwks', return_value={'keys': []}):
+            self.assertFalse(manager.refresh())
+        self.assertIsNone(store.get_document(f'jwks {manager.url}'))
+
+        # The unknown kid refetch backs off after the failure
+        with patch.object(self.manager, 'fetch') as fetch:
+            self.assertIsNone(self.manager.get_key('unknown'))
+        self.assertEqual(fetch.call_count, 0)
+
+        claims_cache.clear()
+        token = self.signer.token(permissions=['get:drinks'])
+        view = requires_auth('get:drinks')(lambda: 'ok')
+        headers = {'Authorization': f'Bearer {token}'}
+        with patch.dict(app.extensions, {'key_manager': self.manager}), \
+                app.test_request_context(headers=headers):
+            self.assertEqual(view(), 'ok')
+
+    def test_requires_auth_local_jwks(self):
+        claims_cache.clear()
+        token = self.signer.token(permissions=['get:drinks'])
+        view = requires_auth('get:drinks')(lambda: 'ok')
+        headers = {'Authorization': f'Bearer {token}'}
+        with patch.dict(app.extensions, {'key_manager': self.manager}), \
+                app.test_request_context(headers=headers):
+            self.assertEqual(view(), 'ok')
+
+            # Rate limited by the "sub" of the token
+            with patch.dict(app.config, {'RATE_LIMIT_ENABLED': True}), \
+                    patch.dict(app.extensions, {
+                        'limits': Limits({'get:drinks': (1, 1)})}):
+                self.assertEqual(view(), 'ok')
+                with self.assertRaises(TooManyRequests):
+                    view()
+
+
+class TestAppFactory(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = pathlib.Path(directory.name, 'factory.db')
+
+    def test_create_app(self):
+        factory_app = create_app({
+            'SQLALCHEMY_DATABASE_URI': f'sqlite:///{self.path}',
+            'MENU_CACHE_ENABLED': False
+        })
+        self.assertIn(os.path.realpath(self.path), initialized_databases)
+        response = factory_app.test_client().get('/drinks')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([drink['title'] for drink in
+                          response.get_json()['drinks']], ['Water'])
+
+        # The same file through another path is neither recreated nor
+        # seeded again
+        create_app({'SQLALCHEMY_DATABASE_URI':
+                    f'sqlite:///{self.path.parent}/./{self.path.name}'})
+        with factory_app.app_context():
+            self.assertEqual(Drink.query.count(), 1)
+
+    def test_create_app_shares_menu_version(self):
+        factory_app = create_app(
+            {'SQLALCHEMY_DATABASE_URI': f'sqlite:///{self.path}'})
+        directory = shared_cache_dir(None, str(self.path))
+        self.addCleanup(shutil.rmtree, directory, True)
+
+        # A write of another worker or of the ASGI app serving the same
+        # database file is seen at once
+        menu_version = factory_app.extensions['menu_version']
+        value = menu_version.value
+        SharedVersion(os.path.join(directory, 'version')).bump()
+        self.assertEqual(menu_version.value, value + 1)
+
+    def test_create_app_refuses_open_shared_dir(self):
+        directory = self.path.with_name('shared')
+        directory.mkdir(mode=0o777)
+        directory.chmod(0o777)
+        factory_app = create_app({
+            'SQLALCHEMY_DATABASE_URI': f'sqlite:///{self.path}',
+            'SHARED_CACHE_DIR': str(directory)
+        })
+        self.assertFalse(factory_app.config['MENU_CACHE_ENABLED'])
+        self.assertNotIn('shared_store', factory_app.extensions)
+        self.assertFalse(os.path.exists(directory / 'secret'))
+
+    def test_create_app_twice_in_one_process(self):
+        apps = []
+        for name in ('first', 'second'):
+            path = self.path.with_name(f'{name}.db')
+            self.addCleanup(shutil.rmtree,
+                            shared_cache_dir(None, str(path)), True)
+            apps.append(create_app({
+                'SQLALCHEMY_DATABASE_URI': f'sqlite:///{path}',
+                'RATE_LIMIT_ENABLED': False
+            }))
+        first, second = apps
+        with first.app_context():
+            Drink(title='First Only', recipe='[]').insert()
+
+        # Each app serves its own database, menu cache and menu version
+        for _ in range(2):
+            titles = [[drink['title'] for drink in
+                       factory_app.test_client().get('/drinks').get_json()[
+                           'drinks']] for factory_app in apps]
+            self.assertEqual(titles, [['Water', 'First Only'], ['Water']])
+        self.assertIsNot(first.extensions['menu_cache'],
+                         second.extensions['menu_cache'])
+        self.assertIsNot(first.extensions['key_manager'],
+                         second.extensions['key_manager'])
+
 
 class TestCoffeShopApp(TestCase):
 
     def create_app(self):
-        database_filename = pathlib.Path('src/database/test_database.db')
-        project_dir = os.path.dirname(os.path.abspath(__file__))
-        database_path = "sqlite:///{}".format(
-            os.path.join(project_dir, database_filename))
-        app.config['SQLALCHEMY_DATABASE_URI'] = database_path
-        app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-        db.init_app(app)
+        app.config['MENU_CACHE_ENABLED'] = False
         return app
 
     def setUp(self):
         db.create_all()
         db.session.commit()
+        # The idempotent responses outlive the tables
+        idempotency_store.clear()
+        app.extensions['shared_store'].delete_documents(
+            IDEMPOTENCY_DOCUMENT, float('inf'))
         drinks = [
             {'title': 'Blue Water',
              'recipe': '[{"name": "water", "color": "blue", "parts": 1}]'}]
         for drink in drinks:
             Drink(**drink).insert()
 
+    def enable_limits(self, limits):
+        """Turns the admission control on with <limits> for the test"""
+        patcher = patch.dict(app.config, {'RATE_LIMIT_ENABLED': True})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch.dict(app.extensions, {'limits': limits})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
     def test_get_drinks(self):
         response = self.client.get('/drinks')
         self.assertEqual(response.status_code, 200)
@@ -101,6 +735,371 @@ class TestCoffeShopApp(TestCase):
         data = response.get_json()
         self.assertTrue(type(data['drinks']), list)
 
+    def test_get_drinks_pagination(self):
+        Drink(title='Red Water',
+              recipe='[{"name": "water", "color": "red", "parts": 1}]'
+              ).insert()
+        response_1 = self.client.get('/drinks?limit=1')
+        self.assertEqual(response_1.status_code, 200)
+        data_1 = response_1.get_json()
+        self.assertEqual(len(data_1['drinks']), 1)
+        self.assertTrue(data_1['next_cursor'])
+
+        response_2 = self.client.get(
+            f'/drinks?limit=1&cursor={data_1["next_cursor"]}')
+        self.assertEqual(response_2.status_code, 200)
+        data_2 = response_2.get_json()
+        self.assertEqual(data_2['drinks'][0]['title'], 'Red Water')
+        self.assertIsNone(data_2['next_cursor'])
+
+    @flask_only
+    def test_menu_replica_sees_writes_of_other_processes(self):
+        self.assertIsNotNone(app.extensions.get('menu_replica'))
+        response = self.client.get('/drinks')
+        self.assertEqual(response.get_json()['drinks'][0]['title'],
+                         'Blue Water')
+
+        # A write of another process is served at once, not from the
+        # snapshot of this one
+        asgi_app = AsgiApp(database=db.engine.url.database)
+        client = asgi_app.test_client()
+        self.addCleanup(client.close)
+        client.patch('/drinks/1', json={'title': 'Patched Elsewhere'})
+        response = self.client.get('/drinks')
+        self.assertEqual(response.get_json()['drinks'][0]['title'],
+                         'Patched Elsewhere')
+
+    @flask_only
+    def test_menu_cache_sees_writes_of_other_processes(self):
+        patcher = patch.dict(app.config, {'MENU_CACHE_ENABLED': True})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        response_1 = self.client.get('/drinks')
+        self.assertEqual(self.client.get('/drinks').get_etag(),
+                         response_1.get_etag())
+
+        # The ASGI app serving the same database bumps the shared version
+        asgi_app = AsgiApp(database=db.engine.url.database)
+        client = asgi_app.test_client()
+        self.addCleanup(client.close)
+        client.patch('/drinks/1', json={'title': 'Patched Elsewhere'})
+        response_2 = self.client.get('/drinks')
+        self.assertNotEqual(response_2.get_etag(), response_1.get_etag())
+        self.assertEqual(response_2.get_json()['drinks'][0]['title'],
+                         'Patched Elsewhere')
+
+        # Without the shared tier the cache of a database file is off
+        other_app = create_app({
+            'SQLALCHEMY_DATABASE_URI': app.config['SQLALCHEMY_DATABASE_URI'],
+            'SHARED_CACHE_DIR': '',
+            'DATABASE_INIT': False
+        })
+        self.assertFalse(other_app.config['MENU_CACHE_ENABLED'])
+        self.assertNotIn('menu_replica', other_app.extensions)
+
+    def test_get_drinks_unpaged(self):
+        # Clients without limit and cursor get the whole menu
+        recipe = '[{"name": "water", "color": "red", "parts": 1}]'
+        for i in range(DRINKS_PAGE_SIZE):
+            Drink(title=f'Drink {i}', recipe=recipe).insert()
+        for path in ('/drinks', '/drinks-detail'):
+            data = self.client.get(path).get_json()
+            self.assertEqual(len(data['drinks']), DRINKS_PAGE_SIZE + 1)
+            self.assertIsNone(data['next_cursor'])
+        data = self.client.get('/drinks?limit=1').get_json()
+        cursor = data['next_cursor']
+        data = self.client.get(f'/drinks?cursor={cursor}').get_json()
+        self.assertEqual(len(data['drinks']), DRINKS_PAGE_SIZE)
+
+    def test_get_drinks_pagination_error_400(self):
+        response_1 = self.client.get('/drinks?limit=abc')
+        self.assertEqual(response_1.status_code, 400)
+        response_2 = self.client.get('/drinks?cursor=%%%')
+        self.assertEqual(response_2.status_code, 400)
+
+    def test_search_drinks(self):
+        self.client.post('/drinks', json={'title': 'Latte', 'recipe': [
+            {'name': 'milk', 'color': 'white', 'parts': 3},
+            {'name': 'coffee', 'color': 'brown', 'parts': 1}]})
+        self.client.post('/drinks', json={'title': 'Milk Shake', 'recipe': [
+            {'name': 'ice cream', 'color': 'white', 'parts': 1}]})
+
+        # Title matches rank above ingredient matches
+        response_1 = self.client.get('/drinks/search?q=milk&limit=1')
+        self.assertEqual(response_1.status_code, 200)
+        data_1 = response_1.get_json()
+        self.assertEqual(data_1['drinks'][0]['title'], 'Milk Shake')
+        self.assertNotIn('name', data_1['drinks'][0]['recipe'][0])
+        response_2 = self.client.get(
+            f'/drinks/search?q=milk&cursor={data_1["next_cursor"]}')
+        data_2 = response_2.get_json()
+        self.assertEqual(data_2['drinks'][0]['title'], 'Latte')
+        self.assertIsNone(data_2['next_cursor'])
+
+        # Words are prefixes, all of them must match
+        response_3 = self.client.get('/drinks/search?q=COF+lat')
+        self.assertEqual(len(response_3.get_json()['drinks']), 1)
+
+        # The index follows updates and deletes
+        self.client.patch('/drinks/1', json={'title': 'Sparkling Water'})
+        response_4 = self.client.get('/drinks/search?q=sparkling')
+        self.assertEqual(response_4.get_json()['drinks'][0]['id'], 1)
+        self.client.delete('/drinks/1')
+        response_5 = self.client.get('/drinks/search?q=water')
+        self.assertEqual(response_5.status_code, 404)
+
+    def test_search_drinks_error_400(self):
+        response_1 = self.client.get('/drinks/search')
+        self.assertEqual(response_1.status_code, 400)
+        response_2 = self.client.get('/drinks/search?q=%22*')
+        self.assertEqual(response_2.status_code, 400)
+
+    def test_get_drinks_error_404(self):
+        self.client.delete('/drinks/1')
+        response = self.client.get('/drinks')
+        self.assertEqual(response.status_code, 404)
+
+    @flask_only
+    def test_get_drinks_stream(self):
+        for index in range(3):
+            Drink(title=f'Stream Drink {index}',
+                  recipe='[{"name": "water", "color": "blue", "parts": 1}]'
+                  ).insert()
+        response = self.client.get('/drinks-detail?stream=1')
+        self.assertEqual(response.status_code, 200)
+        data = response.get_json()
+        self.assertEqual(len(data['drinks']), 4)
+        self.assertEqual(data['drinks'][1]['recipe'][0]['name'], 'water')
+        self.assertIsNone(data['next_cursor'])
+
+    @flask_only
+    def test_get_drinks_stream_error_404(self):
+        self.client.delete('/drinks/1')
+        response = self.client.get('/drinks?stream=1')
+        self.assertEqual(response.status_code, 404)
+
+    @flask_only
+    def test_stream_drinks(self):
+        response = self.client.get('/drinks/stream', buffered=False)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        frames = response.response
+        self.assertEqual(next(frames), b'retry: 3000\n\n')
+
+        self.client.patch('/drinks/1', json={'title': 'Stream Water'})
+        frame = next(frames).decode()
+        self.assertIn('event: update\n', frame)
+        self.assertIn('data: {"id":1,"recipe":[{"color":"blue","parts":1}],'
+                      '"title":"Stream Water"}\n', frame)
+        self.assertEqual(next(frames), b': heartbeat\n\n')
+        response.close()
+
+        # Resumes after the last event received
+        last_event_id = int(frame.split('\n')[0][len('id: '):])
+        self.client.delete('/drinks/1')
+        response = self.client.get(
+            '/drinks-detail/stream', buffered=False,
+            headers={'Last-Event-ID': str(last_event_id)})
+        frames = response.response
+        next(frames)
+        self.assertEqual(next(frames).decode(),
+                         f'id: {last_event_id + 1}\nevent: delete\n'
+                         'data: {"id":1}\n\n')
+        response.close()
+
+    @flask_only
+    def test_stream_drinks_error_400(self):
+        response = self.client.get('/drinks/stream',
+                                   headers={'Last-Event-ID': 'abc'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_get_drinks_etag_304(self):
+        response_1 = self.client.get('/drinks')
+        etag = response_1.headers.get('ETag')
+        self.assertTrue(etag)
+        response_2 = self.client.get(
+            '/drinks', headers={'If-None-Match': etag})
+        self.assertEqual(response_2.status_code, 304)
+        self.assertEqual(response_2.get_data(), b'')
+
+    @flask_only
+    def test_get_drinks_menu_cache(self):
+        app.config['MENU_CACHE_ENABLED'] = True
+        menu_cache.clear()
+        self.client.get('/drinks')
+        self.client.get('/drinks')
+        self.assertEqual(menu_cache.stats()['hits'], 1)
+        self.assertEqual(menu_cache.stats()['misses'], 1)
+
+        # Any write invalidates the cached menu
+        self.client.patch('/drinks/1', json={'title': 'Cached Drink'})
+        response = self.client.get('/drinks')
+        self.assertEqual(response.get_json()['drinks'][0]['title'],
+                         'Cached Drink')
+        self.assertEqual(menu_cache.stats()['misses'], 2)
+
+    @flask_only
+    def test_get_drinks_error_429(self):
+        self.enable_limits(Limits({'': (1, 2)}))
+        for _ in range(2):
+            self.assertEqual(self.client.get('/drinks').status_code, 200)
+        response = self.client.get('/drinks')
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.headers['Retry-After'], '1')
+        self.assertEqual(response.get_json()['error'], 429)
+
+        # The authenticated routes are limited by "sub" instead of the IP
+        self.assertEqual(self.client.get('/drinks-detail').status_code, 200)
+        self.assertEqual(self.client.get('/metrics').status_code, 200)
+
+    @flask_only
+    def test_get_drinks_error_503(self):
+        limits = Limits({}, max_in_flight=0, max_queued=0)
+        self.enable_limits(limits)
+        response = self.client.get('/drinks')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers['Retry-After'], '1')
+        self.assertEqual(response.get_json()['message'],
+                         'service unavailable')
+        self.assertEqual(limits.shed, 1)
+
+    @flask_only
+    def test_get_drinks_compression(self):
+        app.config['MENU_CACHE_ENABLED'] = True
+        menu_cache.clear()
+        headers = {'Accept-Encoding': 'gzip'}
+        # Below the size threshold
+        response = self.client.get('/drinks-detail', headers=headers)
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertIn('Accept-Encoding', response.vary)
+
+        for index in range(20):
+            Drink(title=f'Compressed Drink {index}',
+                  recipe='[{"name": "water", "color": "blue", "parts": 1}]'
+                  ).insert()
+        identity = self.client.get('/drinks-detail')
+        with patch('src.compression.compress',
+                   wraps=compression.compress) as compress:
+            for _ in range(2):
+                response = self.client.get('/drinks-detail', headers=headers)
+        # Compressed once per menu version
+        self.assertEqual(compress.call_count, 1)
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response.vary)
+        self.assertEqual(gzip.decompress(response.get_data()),
+                         identity.get_data())
+        etag = response.headers['ETag']
+        self.assertNotEqual(etag, identity.headers['ETag'])
+
+        response = self.client.get('/drinks-detail', headers=dict(
+            headers, **{'If-None-Match': etag}))
+        self.assertEqual(response.status_code, 304)
+
+        # A variant which does not shrink is not compressed again by the
+        # after_request hook, neither now nor on the next requests
+        Drink(title='Incompressible', recipe='[]').insert()
+        with patch('src.compression.compress',
+                   side_effect=lambda body, *args: body + b'!') as compress:
+            for _ in range(2):
+                response = self.client.get('/drinks-detail', headers=headers)
+        self.assertEqual(compress.call_count, 1)
+        self.assertNotIn('Content-Encoding', response.headers)
+
+        # A response encoded by its view is sent as it is
+        body = gzip.compress(identity.get_data())
+        with app.test_request_context(headers=headers):
+            response = app.process_response(app.response_class(
+                body, mimetype='application/json',
+                headers={'Content-Encoding': 'gzip'}))
+        self.assertEqual(response.get_data(), body)
+
+    @flask_only
+    def test_metrics(self):
+        route = ('GET', '/drinks')
+        requests = request_duration.count(*route)
+        serialization = phase_duration.count(*route, 'serialization')
+        self.client.get('/drinks')
+        self.client.post('/drinks', json={'title': 'Metrics Drink',
+                                          'recipe': []})
+
+        self.assertEqual(request_duration.count(*route), requests + 1)
+        self.assertEqual(phase_duration.count(*route, 'serialization'),
+                         serialization + 1)
+        self.assertGreater(phase_duration.count(
+            'POST', '/drinks', 'validation'), 0)
+        self.assertGreater(request_queries.count(*route), 0)
+
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content_type.startswith('text/plain'))
+        text = response.get_data(as_text=True)
+        self.assertIn('coffee_http_requests_total{method="GET",'
+                      'route="/drinks",status="200"}', text)
+        self.assertIn('coffee_http_requests_total{method="POST",'
+                      'route="/drinks",status="200"}', text)
+        self.assertIn('coffee_jwks_fetches_total', text)
+
+    def test_drink_json_fragments(self):
+        drink = Drink.query.get(1)
+        self.assertEqual(json.loads(drink.short_json()), drink.short())
+        self.assertEqual(json.loads(drink.long_json()), drink.long())
+
+        # Rows without fragments are served and backfilled by the migration
+        db.engine.execute(
+            'UPDATE drink SET short_fragment = NULL, long_fragment = NULL')
+        response = self.client.get('/drinks')
+        self.assertEqual(response.get_json()['drinks'][0]['title'],
+                         'Blue Water')
+        db_migrate()
+        db.session.expire_all()
+        self.assertEqual(Drink.query.get(1).long_json(), drink.long_json())
+        self.assertIsNotNone(Drink.query.get(1).long_fragment)
+
+    @flask_only
+    def test_menu_replica(self):
+        replica = app.extensions['menu_replica']
+        statements = []
+
+        def count(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(Engine, 'before_cursor_execute', count)
+        self.addCleanup(event.remove, Engine, 'before_cursor_execute', count)
+
+        # Served without a query
+        response = self.client.get('/drinks-detail')
+        self.assertEqual(response.get_json()['drinks'][0]['title'],
+                         'Blue Water')
+        self.assertEqual(statements, [])
+
+        # Patched by the writes
+        patches = replica.patches
+        self.client.patch('/drinks/1', json={'title': 'Replica Water'})
+        self.assertEqual(replica.patches, patches + 1)
+        statements.clear()
+        response = self.client.get('/drinks?stream=1')
+        self.assertEqual(response.get_json()['drinks'][0]['title'],
+                         'Replica Water')
+        self.assertEqual(statements, [])
+
+        # A write bypassing the models is found by the consistency check
+        db.engine.execute(
+            "INSERT INTO drink (title, recipe) VALUES ('Raw Water', '[]')")
+        self.assertEqual(replica.verify(), [2])
+        response = self.client.get('/drinks')
+        self.assertEqual(response.get_json()['drinks'][1]['title'],
+                         'Raw Water')
+
+    def test_engine_profile(self):
+        journal_mode = db.session.execute('PRAGMA journal_mode').scalar()
+        self.assertEqual(journal_mode, 'wal')
+
+    def test_get_request_read_only_connection(self):
+        with app.test_request_context('/drinks', method='GET'):
+            with self.assertRaises(OperationalError):
+                db.session.execute(
+                    "INSERT INTO drink (title, recipe) VALUES ('a', '[]')")
+            db.session.rollback()
+
     def test_post_drinks(self):
         body = {'title': 'Post Drink',
                 'recipe': [{'name': 'water', 'color': 'blue', 'parts': 1}]}
@@ -123,6 +1122,133 @@ class TestCoffeShopApp(TestCase):
         response = self.client.post('/drinks', json=body)
         self.assertEqual(response.status_code, 400)
 
+    def test_post_drinks_error_413(self):
+        body = {'title': 'x' * MAX_CONTENT_LENGTH,
+                'recipe': [{'name': 'water', 'color': 'blue', 'parts': 1}]}
+        response = self.client.post('/drinks', json=body)
+        self.assertEqual(response.status_code, 413)
+        self.assertEqual(response.get_json()['message'],
+                         'request entity too large')
+
+    @flask_only
+    def test_post_drinks_idempotency_key(self):
+        body = {'title': 'Retried Drink',
+                'recipe': [{'name': 'water', 'color': 'blue', 'parts': 1}]}
+        headers = {'Idempotency-Key': 'retry-1'}
+        response_1 = self.client.post('/drinks', json=body, headers=headers)
+        response_2 = self.client.post('/drinks', json=body, headers=headers)
+        self.assertEqual(response_1.status_code, 200)
+        self.assertEqual(response_2.status_code, 200)
+        self.assertEqual(response_2.get_json(), response_1.get_json())
+        self.assertEqual(response_2.headers['Idempotent-Replayed'], 'true')
+        self.assertEqual(Drink.query.filter(
+            Drink.title == 'Retried Drink').count(), 1)
+
+        # The same key with a different body
+        body['title'] = 'Other Drink'
+        response_3 = self.client.post('/drinks', json=body, headers=headers)
+        self.assertEqual(response_3.status_code, 422)
+
+    @flask_only
+    def test_post_drinks_idempotency_key_other_worker(self):
+        body = {'title': 'Retried Drink',
+                'recipe': [{'name': 'water', 'color': 'blue', 'parts': 1}]}
+        headers = {'Idempotency-Key': 'retry-2'}
+        response_1 = self.client.post('/drinks', json=body, headers=headers)
+        # The retry is served by a worker which did not see the first request
+        idempotency_store.clear()
+        response_2 = self.client.post('/drinks', json=body, headers=headers)
+        self.assertEqual(response_2.status_code, 200)
+        self.assertEqual(response_2.get_json(), response_1.get_json())
+        self.assertEqual(response_2.headers['Idempotent-Replayed'], 'true')
+        self.assertEqual(Drink.query.filter(
+            Drink.title == 'Retried Drink').count(), 1)
+
+    def test_get_drinks_changes(self):
+        response_1 = self.client.get('/drinks/changes?since=0')
+        self.assertEqual(response_1.status_code, 200)
+        data_1 = response_1.get_json()
+        self.assertEqual(data_1['drinks'][0]['title'], 'Blue Water')
+        self.assertEqual(data_1['drinks'][0]['recipe'][0]['name'], 'water')
+        self.assertFalse(data_1['resync'])
+
+        self.client.post('/drinks', json={'title': 'Green Water', 'recipe': [
+            {'name': 'water', 'color': 'green', 'parts': 1}]})
+        self.client.delete('/drinks/1')
+        response_2 = self.client.get(
+            f'/drinks/changes?since={data_1["version"]}')
+        data_2 = response_2.get_json()
+        self.assertEqual([drink['title'] for drink in data_2['drinks']],
+                         ['Green Water'])
+        self.assertEqual(data_2['deleted'], [1])
+        self.assertGreater(data_2['version'], data_1['version'])
+
+        # Nothing changed since the last sync
+        response_3 = self.client.get(
+            f'/drinks/changes?since={data_2["version"]}')
+        data_3 = response_3.get_json()
+        self.assertEqual((data_3['drinks'], data_3['deleted']), ([], []))
+
+        # A version the log does not know
+        response_4 = self.client.get('/drinks/changes?since=1000000')
+        self.assertTrue(response_4.get_json()['resync'])
+
+    def test_get_drinks_changes_error_400(self):
+        response = self.client.get('/drinks/changes?since=abc')
+        self.assertEqual(response.status_code, 400)
+
+    def test_batch_drinks(self):
+        body = {'operations': [
+            {'op': 'create', 'data': {
+                'title': 'Batch Drink',
+                'recipe': [{'name': 'water', 'color': 'blue', 'parts': 1}]}},
+            {'op': 'update', 'id': 1, 'data': {'title': 'Batch Update'}}
+        ]}
+        response = self.client.post('/drinks/batch', json=body)
+        self.assertEqual(response.status_code, 200)
+        results = response.get_json()['results']
+        self.assertEqual([result['status'] for result in results], [200, 200])
+        self.assertTrue(Drink.query.get(results[0]['drink']['id']))
+        self.assertEqual(Drink.query.get(1).title, 'Batch Update')
+
+        body = {'operations': [{'op': 'delete', 'id': 1}]}
+        response = self.client.post('/drinks/batch', json=body)
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(Drink.query.get(1))
+
+    def test_batch_drinks_error_400(self):
+        body = {'operations': [
+            {'op': 'create', 'data': {'title': 'Batch Drink'}},
+            {'op': 'delete', 'id': 1}
+        ]}
+        response = self.client.post('/drinks/batch', json=body)
+        self.assertEqual(response.status_code, 400)
+        results = response.get_json()['results']
+        self.assertEqual(results[0]['message'],
+                         "'recipe' is a required property")
+        self.assertEqual(results[1]['status'], 424)
+        # Nothing is applied
+        self.assertTrue(Drink.query.get(1))
+
+    def test_batch_drinks_error_409(self):
+        recipe = [{'name': 'water', 'color': 'blue', 'parts': 1}]
+        body = {'operations': [
+            {'op': 'create', 'data': {'title': 'Batch', 'recipe': recipe}},
+            {'op': 'create', 'data': {'title': 'Blue Water',
+                                      'recipe': recipe}}
+        ]}
+        response = self.client.post('/drinks/batch', json=body)
+        self.assertEqual(response.status_code, 409)
+        self.assertFalse(
+            Drink.query.filter(Drink.title == 'Batch').first())
+
+    def test_batch_drinks_error_403(self):
+        body = {'operations': [{'op': 'delete', 'id': 1}]}
+        claims = {'permissions': frozenset(['post:drinks'])}
+        with patch.dict(MOCK_CLAIMS, claims):
+            response = self.client.post('/drinks/batch', json=body)
+        self.assertEqual(response.status_code, 403)
+
     def test_patch_drinks(self):
         body = {'title': 'Patch Drink'}
         response = self.client.patch('/drinks/1', json=body)
@@ -141,14 +1267,176 @@ class TestCoffeShopApp(TestCase):
         drink = Drink.query.get(1)
         self.assertFalse(drink)
 
+    @flask_only
+    def test_write_coalescing(self):
+        writer = create_drink_writer(app)
+        writer.window = 0.05
+        self.addCleanup(writer.stop)
+        patcher = patch.dict(app.extensions, {'drink_writer': writer})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        recipe = [{'name': 'water', 'color': 'blue', 'parts': 1}]
+
+        response = self.client.post('/drinks', json={'title': 'Queued',
+                                                     'recipe': recipe})
+        self.assertEqual(response.status_code, 200)
+        response = self.client.post('/drinks', json={'title': 'Queued',
+                                                     'recipe': recipe})
+        self.assertEqual(response.status_code, 409)
+        response = self.client.patch('/drinks/1', json={'title': 'Queued'})
+        self.assertEqual(response.status_code, 422)
+        response = self.client.patch('/drinks/1', json={'title': 'Patched'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.delete('/drinks/2').status_code, 200)
+        response = self.client.get('/drinks')
+        self.assertEqual([drink['title'] for drink in
+                          response.get_json()['drinks']], ['Patched'])
+
+        # The writes queued within the window share a commit, a failed one
+        # fails alone
+        commits = writer.commits
+        futures = [writer.submit('create', title=title, recipe='[]',
+                                 short_fragment='', long_fragment='')
+                   for title in ('A', 'B', 'A', 'C')]
+        self.assertEqual(len({futures[i].result() for i in (0, 1, 3)}), 3)
+        with self.assertRaises(Conflict):
+            futures[2].result()
+        self.assertEqual(writer.commits, commits + 1)
+
     def test_delete_drinks_404(self):
         response = self.client.delete('/drinks/999')
         self.assertEqual(response.status_code, 404)
 
+    @flask_only
+    def test_export_drinks(self):
+        response = self.client.get('/drinks/export')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        lines = response.get_data(as_text=True).splitlines()
+        self.assertEqual([json.loads(line) for line in lines],
+                         [Drink.query.get(1).long()])
+
+    @flask_only
+    def test_import_drinks(self):
+        recipe = [{'name': 'milk', 'color': 'white', 'parts': 1}]
+        lines = [
+            json.dumps({'title': 'Blue Water', 'recipe': recipe}),
+            json.dumps({'title': 'Milk', 'recipe': recipe}),
+            '',
+            '{"title": ',
+            json.dumps({'title': 'No Recipe'}),
+            json.dumps({'title': 'Milk', 'recipe': []}),
+            json.dumps({'id': 7, 'title': 'Tea', 'recipe': recipe})
+        ]
+        body = '\n'.join(lines) + '\n'
+        response = self.client.post('/drinks/import?chunk_size=2', data=body)
+        self.assertEqual(response.status_code, 200)
+        report = response.get_json()
+        self.assertEqual({key: report[key] for key in (
+            'lines', 'created', 'updated', 'skipped', 'failed', 'chunks')},
+            {'lines': 7, 'created': 2, 'updated': 0, 'skipped': 2,
+             'failed': 2, 'chunks': 2})
+        self.assertEqual([error['line'] for error in report['errors']],
+                         [4, 5])
+        self.assertEqual(report['errors'][1]['message'],
+                         "'recipe' is a required property")
+        self.assertEqual(Drink.query.get(1).long()['recipe'][0]['name'],
+                         'water')
+
+        # The last line of a title wins
+        response = self.client.post('/drinks/import?mode=upsert', data=body)
+        report = response.get_json()
+        self.assertEqual((report['created'], report['updated'],
+                          report['failed']), (0, 4, 2))
+        self.assertEqual(Drink.query.get(1).long()['recipe'], recipe)
+        milk = Drink.query.filter(Drink.title == 'Milk').one()
+        self.assertEqual(milk.long()['recipe'], [])
+        self.assertEqual(Drink.query.count(), 3)
+
+        response = self.client.post('/drinks/import?mode=replace', data=body)
+        self.assertEqual(response.status_code, 400)
+        for chunk_size in ('0', 'abc', '1.5', '10001'):
+            response = self.client.post(
+                f'/drinks/import?chunk_size={chunk_size}', data=body)
+            self.assertEqual(response.status_code, 400)
+        claims = {'permissions': frozenset(['post:drinks'])}
+        with patch.dict(MOCK_CLAIMS, claims):
+            response = self.client.post('/drinks/import?mode=upsert',
+                                        data=body)
+        self.assertEqual(response.status_code, 403)
+
+    @flask_only
+    def test_drinks_cli(self):
+        runner = app.test_cli_runner()
+        result = runner.invoke(args=['drinks', 'export'])
+        self.assertEqual(result.exit_code, 0)
+        exported = result.stdout
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'drinks.ndjson')
+            with open(path, 'w') as drinks_file:
+                drinks_file.write(exported.replace('Blue Water', 'Copy'))
+                drinks_file.write('not json\n')
+            result = runner.invoke(args=['drinks', 'import', path,
+                                         '--chunk-size', '1'])
+        self.assertEqual(result.exit_code, 0)
+        report = json.loads(result.stdout.splitlines()[-1])
+        self.assertEqual((report['created'], report['failed']), (1, 1))
+        self.assertIn('line 2: invalid json', result.stderr)
+        copy = Drink.query.filter(Drink.title == 'Copy').one()
+        self.assertEqual(copy.long()['recipe'],
+                         Drink.query.get(1).long()['recipe'])
+
     def tearDown(self):
         db.session.remove()
         db.drop_all()
 
 
+class TestCoffeShopAsgiApp(TestCoffeShopApp):
+    """Runs the app test cases against the ASGI entry point"""
+
+    def setUp(self):
+        test = getattr(self, self._testMethodName)
+        if getattr(test, 'flask_only', False):
+            self.skipTest('Flask specific feature')
+        super().setUp()
+        self.asgi_app = create_asgi_app(database=db.engine.url.database)
+        self.client = self.asgi_app.test_client()
+
+    def test_writes_bump_shared_menu_version(self):
+        version = SharedVersion(os.path.join(shared_cache_dir(
+            None, db.engine.url.database), 'version'))
+        value = version.value
+        self.client.patch('/drinks/1', json={'title': 'Shared'})
+        self.client.post('/drinks', json={'title': 'Shared', 'recipe': []})
+        self.client.delete('/drinks/1')
+        # The conflicting create wrote nothing
+        self.assertEqual(version.value, value + 2)
+
+    def test_post_drinks_error_413_streamed(self):
+        # A body without Content-Length is cut off once it is too long
+        messages = [{'type': 'http.request', 'body': b'x' * 1024,
+                     'more_body': True}] * (MAX_CONTENT_LENGTH // 1024 + 2)
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        self.client.loop.run_until_complete(self.asgi_app({
+            'type': 'http', 'method': 'POST', 'path': '/drinks',
+            'headers': [(b'content-type', b'application/json')]
+        }, receive, send))
+        self.assertEqual(sent[0]['status'], 413)
+        self.assertTrue(messages)
+
+    def tearDown(self):
+        if hasattr(self, 'asgi_app'):
+            self.client.close()
+        super().tearDown()
+
+
 if __name__ == '__main__':
     unittest.main()